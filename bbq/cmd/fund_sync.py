@@ -1,11 +1,14 @@
 from functools import partial
 from datetime import datetime
 import click
+import os
 from bbq.common import run_until_complete
 from bbq.data.funddb import FundDB
-from bbq.common import setup_log, setup_db
+from bbq.common import setup_log, setup_db, setup_fetch_cache
+from bbq.data.gap_scanner import GapScanner, GapBackfillTask
+from bbq.data.sync_journal import SyncJournal
 from bbq.data.data_sync import DataSync, Task
-from typing import Dict
+from typing import Dict, List
 import bbq.fetch as fetch
 from bbq.config import init_def_config
 
@@ -18,46 +21,50 @@ class FundInfoTask(Task):
     async def task(self):
         self.log.info('开始基金基本信息同步任务: {}'.format(self.name))
         save_func = partial(self.db.save_fund_info, data=self.fund_info)
-        await self.data_sync.submit_db(save_func)
+        await self.data_sync.submit_db(save_func, task=self)
 
         self.log.info('基金基本信息{}, task完成'.format(self.name))
 
 
+def daily_sync_start_time(now: datetime) -> datetime:
+    return datetime(year=now.year, month=now.month, day=now.day, hour=15, minute=30)
+
+
+def net_sync_start_time(now: datetime) -> datetime:
+    return datetime(year=now.year, month=now.month, day=now.day, hour=0, minute=0)
+
+
 class FundDailyTask(Task):
-    def __init__(self, data_sync, name: str, code: str):
-        super().__init__(data_sync, name)
+    def __init__(self, data_sync, name: str, code: str, watermarks: Dict = None):
+        super().__init__(data_sync, name, watermarks)
         self.code = code
 
     async def task(self):
         self.log.info('开始场内基金日线{}({})同步任务'.format(self.name, self.code))
-        query_func = partial(self.db.load_fund_daily, filter={'code': self.code}, projection=['trade_date'],
-                             sort=[('trade_date', -1)], limit=1)
+        query_func = self.watermark_query(partial(self.db.load_fund_daily, filter={'code': self.code},
+                                                  projection=['trade_date'], sort=[('trade_date', -1)], limit=1))
         fetch_func = partial(self.to_async,
                              func=partial(fetch.fetch_fund_daily,
                                           code=self.code, start=datetime(year=1990, month=1, day=1)))
         save_func = self.db.save_fund_daily
         await self.incr_sync_on_trade_date(query_func=query_func, fetch_func=fetch_func, save_func=save_func,
-                                           sync_start_time_func=lambda now: datetime(year=now.year,
-                                                                                     month=now.month,
-                                                                                     day=now.day, hour=15,
-                                                                                     minute=30))
+                                           sync_start_time_func=daily_sync_start_time)
         self.log.info('开始场内基金日线{}({})同步任务完成'.format(self.name, self.code))
 
 
 class FundNetTask(Task):
-    def __init__(self, data_sync, name: str, code: str):
-        super().__init__(data_sync, name)
+    def __init__(self, data_sync, name: str, code: str, watermarks: Dict = None):
+        super().__init__(data_sync, name, watermarks)
         self.code = code
 
     async def task(self):
         self.log.info('开始基金净值{}({})同步任务'.format(self.name, self.code))
-        query_func = partial(self.db.load_fund_net, filter={'code': self.code}, projection=['trade_date'],
-                             sort=[('trade_date', -1)], limit=1)
-        fetch_func = partial(self.to_async, partial(fetch.fetch_fund_net, code=self.code))
+        query_func = self.watermark_query(partial(self.db.load_fund_net, filter={'code': self.code},
+                                                  projection=['trade_date'], sort=[('trade_date', -1)], limit=1))
+        fetch_func = partial(self.fetch_async, fetch.fetch_fund_net_async, code=self.code)
         save_func = self.db.save_fund_net
         await self.incr_sync_on_trade_date(query_func=query_func, fetch_func=fetch_func, save_func=save_func,
-                                           sync_start_time_func=lambda now: datetime(year=now.year, month=now.month,
-                                                                                     day=now.day, hour=0, minute=0))
+                                           sync_start_time_func=net_sync_start_time)
         self.log.info('基金净值{}({})同步任务完成'.format(self.name, self.code))
 
 
@@ -65,9 +72,33 @@ class FundSync(DataSync):
     def __init__(self, db: FundDB, config: Dict):
         super().__init__(db=db,
                          concurrent_fetch_count=config['con_fetch_num'],
-                         concurrent_save_count=config['con_save_num'])
+                         concurrent_save_count=config['con_save_num'],
+                         journal=config.get('journal'), resume=config.get('resume', True),
+                         metrics_path=config.get('metrics_path'), executor=config.get('executor'))
         self.config = config
         self.funcs = self.config['function'].split(',') if self.config['function'] is not None else None
+        self.gap_scanner = None
+
+    async def post_tasks(self) -> bool:
+        if self.gap_scanner is not None:
+            self.gap_scanner.save()
+        return True
+
+    async def prepare_backfill(self, codes: List[str]):
+        """
+        扫描场内基金日线/净值中间缺失的交易日, 按回补计划添加回补task
+        """
+        self.gap_scanner = GapScanner(self.db, path=self.config.get('gap_plan_path'))
+        targets = [('fund_daily', self.db.fund_daily, fetch.fetch_fund_daily, self.db.save_fund_daily),
+                   ('fund_net', self.db.fund_net, fetch.fetch_fund_net_async, self.db.save_fund_net)]
+        for name, coll, fetch_func, save_func in targets:
+            if self.funcs is not None and name not in self.funcs:
+                continue
+            plan = await self.gap_scanner.scan(coll, codes=codes)
+            for code, ranges in plan.items():
+                self.add_task(GapBackfillTask(self, scanner=self.gap_scanner, coll=name, code=code, ranges=ranges,
+                                              fetch_func=fetch_func, save_func=save_func))
+        self.gap_scanner.save()
 
     async def prepare_tasks(self) -> bool:
         self.log.info('获取基金列表...')
@@ -80,37 +111,70 @@ class FundSync(DataSync):
             self.add_task(FundInfoTask(data_sync=self, name='fund_info', fund_info=funds))
 
         if self.funcs is None or 'fund_daily' in self.funcs:
-            for _, fund in funds.iterrows():
-                self.add_task(FundDailyTask(data_sync=self, name=fund['name'], code=fund['code']))
+            need_codes, watermarks = await self.load_watermarks(self.db.fund_daily, funds['code'].tolist(),
+                                                                sync_start_time_func=daily_sync_start_time)
+            for _, fund in funds[funds['code'].isin(need_codes)].iterrows():
+                self.add_task(FundDailyTask(data_sync=self, name=fund['name'], code=fund['code'],
+                                            watermarks=watermarks))
 
         if self.funcs is None or 'fund_net' in self.funcs:
-            for _, fund in funds.iterrows():
-                self.add_task(FundNetTask(data_sync=self, name=fund['name'], code=fund['code']))
+            need_codes, watermarks = await self.load_watermarks(self.db.fund_net, funds['code'].tolist(),
+                                                                sync_start_time_func=net_sync_start_time)
+            for _, fund in funds[funds['code'].isin(need_codes)].iterrows():
+                self.add_task(FundNetTask(data_sync=self, name=fund['name'], code=fund['code'],
+                                          watermarks=watermarks))
+
+        if self.config.get('backfill', False):
+            await self.prepare_backfill(funds['code'].tolist())
 
         return True
 
 
 @click.command()
 @click.option('--uri', type=str, default='mongodb://localhost:27017/', help='mongodb connection uri')
-@click.option('--pool', default=10, type=int, help='mongodb connection pool size')
+@click.option('--pool', default=10, type=int,
+              help='mongodb connections kept open in the pool, the pool grows up to max(max_pool, con-save-num)')
 @click.option('--con-fetch-num', default=20, type=int, help='concurrent net fetch number')
 @click.option('--con-save-num', default=100, type=int, help='concurrent db save number')
 @click.option('--function', type=str,
               help='sync one, split by ",", available: fund_info,fund_net,fund_daily')
+@click.option('--journal/--no-journal', default=True, type=bool, help='record sync journal for resuming')
+@click.option('--resume/--no-resume', default=True, type=bool, help='skip tasks finished by the last unfinished run')
+@click.option('--metrics/--no-metrics', default=True, type=bool,
+              help='dump sync metrics as json/prometheus text when finished')
+@click.option('--http-cache', type=click.Choice(['rw', 'replay']),
+              help='cache http responses on disk, replay: only use cached responses, no network')
+@click.option('--backfill/--no-backfill', default=False, type=bool,
+              help='scan fund_daily/fund_net for missing trade dates and backfill them')
 @click.option('--debug/--no-debug', default=True, help='show debug log')
 def main(uri: str = 'mongodb://localhost:27017/', pool: int = 5,
          con_fetch_num: int = 10, con_save_num: int = 100,
-         function: str = None, debug: bool = True):
-    _, conf_dict = init_def_config()
-    conf_dict['mongo'].update(dict(uri=uri, pool=pool))
+         function: str = None, journal: bool = True, resume: bool = True, metrics: bool = True,
+         http_cache: str = None, backfill: bool = False,
+         debug: bool = True):
+    conf_file, conf_dict = init_def_config()
+    conf_dict['mongo'].update(dict(uri=uri, pool=pool,
+                                   max_pool=max(conf_dict['mongo'].get('max_pool', 100), con_save_num)))
     conf_dict['log'].update(dict(level="debug" if debug else "critical"))
     setup_log(conf_dict, 'fund_sync.log')
+    if http_cache is not None:
+        fetch_dict = conf_dict.setdefault('fetch', {})
+        fetch_dict['cache_mode'] = http_cache
+        if fetch_dict.get('cache_path') is None:
+            fetch_dict['cache_path'] = os.sep.join([os.path.dirname(conf_file), 'http_cache'])
+    setup_fetch_cache(conf_dict)
     db = setup_db(conf_dict, FundDB)
     if db is None:
         return
     config = dict(con_fetch_num=con_fetch_num,
                   con_save_num=con_save_num,
-                  function=function)
+                  function=function,
+                  journal=SyncJournal(path=os.sep.join([os.path.dirname(conf_file), 'journal', 'fund_sync.db']),
+                                      name='fund_sync') if journal else None,
+                  resume=resume,
+                  metrics_path=os.sep.join([os.path.dirname(conf_file), 'metrics', 'fund_sync']) if metrics else None,
+                  backfill=backfill,
+                  gap_plan_path=os.sep.join([os.path.dirname(conf_file), 'gaps', 'fund_sync.json']))
     fund_sync = FundSync(db=db, config=config)
     run_until_complete(fund_sync.sync())
 
@@ -30,7 +30,7 @@ async def select_async(js, config):
 @click.pass_context
 @click.option('--uri', type=str, default='mongodb://localhost:27017/',
               help='mongodb connection uri, default: mongodb://localhost:27017/')
-@click.option('--pool', default=10, type=int, help='mongodb connection pool size, default: 10')
+@click.option('--pool', default=10, type=int, help='mongodb connections kept open in the pool, default: 10')
 @click.option('--syn_type', default='stock', type=str, help='selector type, default: stock')
 @click.option('--debug/--no-debug', default=True, type=bool, help='show debug log, default: --debug')
 def main(ctx, uri: str, pool: int, syn_type: str, debug: bool):
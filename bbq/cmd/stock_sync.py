@@ -1,46 +1,55 @@
+import asyncio
 from datetime import datetime, timedelta
 from functools import partial
-from typing import Dict
+from typing import Dict, Optional
+import numpy as np
 import pandas as pd
 import click
+import os
 
 import bbq.fetch as fetch
-from bbq.common import run_until_complete, setup_db, setup_log
+from bbq.common import run_until_complete, setup_db, setup_log, setup_fetch_cache
 from bbq.config import init_def_config
+from bbq.data.gap_scanner import GapScanner, GapBackfillTask
+from bbq.data.sync_journal import SyncJournal
+from bbq.data.sync_shard import SyncShard, ShardReporter, shard_of
 from bbq.data.data_sync import DataSync
 from bbq.data.data_sync import Task
 from bbq.data.stockdb import StockDB
-from bbq.fetch.my_trade_date import is_trade_date
+from bbq.fetch.my_trade_date import trade_cal
+
+
+def daily_sync_start_time(now: datetime) -> datetime:
+    return datetime(year=now.year, month=now.month, day=now.day, hour=15, minute=30)
 
 
 class StockDailyTask(Task):
-    def __init__(self, data_sync, name: str, code: str):
-        super().__init__(data_sync, name)
+    def __init__(self, data_sync, name: str, code: str, watermarks: Dict = None):
+        super().__init__(data_sync, name, watermarks)
         self.code = code
 
     async def task(self):
         self.log.info('开始同步股票日线数据, code={}'.format(self.code))
-        query_func = partial(self.db.load_stock_daily, filter={'code': self.code}, projection=['trade_date'],
-                             sort=[('trade_date', -1)], limit=1)
+        query_func = self.watermark_query(partial(self.db.load_stock_daily, filter={'code': self.code},
+                                                  projection=['trade_date'], sort=[('trade_date', -1)], limit=1))
         fetch_func = partial(self.to_async, func=partial(fetch.fetch_stock_daily, code=self.code))
         save_func = self.db.save_stock_daily
         await self.incr_sync_on_trade_date(query_func=query_func,
                                            fetch_func=fetch_func,
                                            save_func=save_func,
-                                           sync_start_time_func=lambda now: datetime(year=now.year, month=now.month,
-                                                                                     day=now.day, hour=15, minute=30))
+                                           sync_start_time_func=daily_sync_start_time)
         self.log.info('股票日线数据task完成, code={}'.format(self.code))
 
 
 class StockIndexTask(Task):
-    def __init__(self, data_sync, name: str, code: str):
-        super().__init__(data_sync, name)
+    def __init__(self, data_sync, name: str, code: str, watermarks: Dict = None):
+        super().__init__(data_sync, name, watermarks)
         self.code = code
 
     async def task(self):
         self.log.info('开始同步股票指标数据, code={}'.format(self.code))
-        query_func = partial(self.db.load_stock_index, filter={'code': self.code}, projection=['trade_date'],
-                             sort=[('trade_date', -1)], limit=1)
+        query_func = self.watermark_query(partial(self.db.load_stock_index, filter={'code': self.code},
+                                                  projection=['trade_date'], sort=[('trade_date', -1)], limit=1))
         fetch_func = partial(self.to_async, func=partial(fetch.fetch_stock_index, code=self.code))
         save_func = self.db.save_stock_index
         await self.incr_sync_on_trade_date(query_func=query_func, fetch_func=fetch_func, save_func=save_func)
@@ -48,60 +57,85 @@ class StockIndexTask(Task):
 
 
 class StockFactorTask(Task):
-    def __init__(self, data_sync, name: str, code: str):
+    def __init__(self, data_sync, name: str, code: str, sync_date: datetime = None):
         super().__init__(data_sync, name)
         self.code = code
+        self.sync_date = sync_date
+
+    @staticmethod
+    def diff_factor(data: pd.DataFrame, data_db: Optional[pd.DataFrame],
+                    cols: tuple = ('hfq_factor', 'qfq_factor')) -> pd.DataFrame:
+        """
+        对比获取的复权因子和库里的复权因子
+        :param cols: 比较的因子列
+        :return: 新增或有变化的复权因子
+        """
+        if data_db is None or data_db.empty:
+            return data
+        data_db = data_db.assign(trade_date=pd.to_datetime(data_db['trade_date'])).drop_duplicates('trade_date')
+        merged = data.merge(data_db, how='left', on='trade_date', suffixes=('', '_db'))
+        same = np.ones(merged.shape[0], dtype=bool)
+        for col in cols:
+            same = same & np.isclose(merged[col].astype(float), merged[col + '_db'].astype(float), equal_nan=True)
+        return data[~same]
 
     async def task(self):
         self.log.info('开始获取复权因子数据')
 
-        # data = fetch.fetch_stock_adj_factor(code=self.code)
-        # if data is None:
-        #     return False
-        #
-        # data_db = await self.db.load_stock_fq_factor(filter={'code': self.code}, projection=['trade_date'])
-        # if data_db is None or data_db.shape[0] != data.shape[0]:
-        #     data_new = self.gen_incr_data('trade_date', data_db, data)
-        #     if data_new is not None:
-        #         self.log.info('删除原有{}复权因子'.format(self.code))
-        #         await self.db.do_delete(self.db.stock_fq_factor, filter={'code': self.code}, just_one=False)
-        #         await self.db.save_stock_fq_factor(data)
-
-        query_func = partial(self.db.load_stock_fq_factor, filter={'code': self.code}, projection=['sync_date'],
-                             sort=[('sync_date', -1)], limit=1)
-        fetch_func = partial(self.to_async, func=partial(fetch.fetch_stock_adj_factor, code=self.code))
-
-        async def _save_func(code, data):
-            self.log.info('全量同步复权因子: {}'.format(self.code))
-            await self.db.do_delete(self.db.stock_fq_factor, filter={'code': code}, just_one=False)
-            await self.db.save_stock_fq_factor(data)
+        if self.sync_date is not None:
+            start = trade_cal.next_trade_date(self.sync_date) or self.sync_date + timedelta(days=1)
+            if self.is_synced(start, datetime.now()):
+                self.log.info('复权因子已是最新: {}'.format(self.code))
+                return
 
-        save_func = partial(_save_func, code=self.code)
-
-        is_synced = await self.incr_sync_on_trade_date(cmp_key='sync_date',
-                                                       query_func=query_func,
-                                                       fetch_func=fetch_func,
-                                                       save_func=save_func)
+        data = await self.to_async(fetch.fetch_stock_adj_factor, code=self.code)
+        if data is None or data.empty:
+            return
+        data = data.assign(trade_date=pd.to_datetime(data['trade_date'])) \
+            .sort_values(by='trade_date').reset_index(drop=True)
+
+        data_db = await self.db.load_stock_fq_factor(filter={'code': self.code},
+                                                     projection=['trade_date', 'hfq_factor', 'qfq_factor'])
+        changed = self.diff_factor(data, data_db)
+
+        # 前复权因子每次除权除息都会整体重算, 只按新增/后复权因子变化的日期更新日线的后复权因子
+        ex_rights = None
+        hfq_changed = self.diff_factor(data, data_db, cols=('hfq_factor',))
+        if data_db is not None and not hfq_changed.empty:
+            next_date = data['trade_date'].shift(-1)
+            ex_rights = hfq_changed[['trade_date', 'hfq_factor']].assign(next_trade_date=next_date[hfq_changed.index])
+            self.log.info('股票{}除权除息/复权因子变化, 日期={}'.format(
+                self.code, [d.strftime('%Y-%m-%d') for d in hfq_changed['trade_date']]))
 
-        if not is_synced:
-            now = datetime.now()
-            now = datetime(year=now.year, month=now.month, day=now.day)
-            await self.db.do_update_many(coll=self.db.stock_fq_factor,
-                                         filter={'code': self.code},
-                                         update={'sync_date': now}, upsert=False)
+        now = datetime.now()
+        meta = dict(code=self.code, sync_date=datetime(year=now.year, month=now.month, day=now.day),
+                    last_trade_date=data['trade_date'].max().to_pydatetime())
+        if ex_rights is not None:
+            meta['ex_date'] = hfq_changed['trade_date'].max().to_pydatetime()
+        self.watermark = meta['last_trade_date']
+
+        async def _save_func():
+            if not changed.empty:
+                self.log.info('更新复权因子: {}, count={}'.format(self.code, changed.shape[0]))
+                await self.db.upsert_stock_fq_factor(changed)
+            if ex_rights is not None:
+                await self.db.update_stock_daily_hfq_factor(self.code, ex_rights)
+            await self.db.save_sync_meta('stock_fq_factor', meta)
+
+        await self.data_sync.submit_db(_save_func, task=self)
 
         self.log.info('获取复权因子数据完成')
 
 
 class IndexDailyTask(Task):
-    def __init__(self, data_sync, name: str, code: str):
-        super().__init__(data_sync, name)
+    def __init__(self, data_sync, name: str, code: str, watermarks: Dict = None):
+        super().__init__(data_sync, name, watermarks)
         self.code = code
 
     async def task(self):
         self.log.info('开始同步指数日线数据, code={}'.format(self.code))
-        query_func = partial(self.db.load_index_daily, filter={'code': self.code}, projection=['trade_date'],
-                             sort=[('trade_date', -1)], limit=1)
+        query_func = self.watermark_query(partial(self.db.load_index_daily, filter={'code': self.code},
+                                                  projection=['trade_date'], sort=[('trade_date', -1)], limit=1))
         fetch_func = partial(self.to_async, func=partial(fetch.fetch_stock_index_daily, code=self.code))
         save_func = self.db.save_index_daily
         await self.incr_sync_on_trade_date(query_func=query_func, fetch_func=fetch_func, save_func=save_func)
@@ -118,7 +152,7 @@ class StockNorthFlowTask(Task):
                              sort=[('trade_date', -1)], limit=1)
         filter_cond = None
         now = datetime.now()
-        if fetch.is_trade_date(now):
+        if trade_cal.is_trade_date(now):
             if now < datetime(year=now.year, month=now.month, day=now.day, hour=15, minute=30):
                 end = now - timedelta(days=1)
                 filter_cond = 'trade_date <= "{}"'.format(end.strftime('%Y-%m-%d'))
@@ -144,7 +178,7 @@ class StockHisDivEndTask(Task):
                              sort=[('sync_date', -1)], limit=1)
 
         async def fetch_func(*_1, **_2):
-            return fetch.fetch_stock_his_divend()
+            return await self.to_async(fetch.fetch_stock_his_divend)
 
         async def _save_func(data):
             self.log.info('全量同步历史分红数据')
@@ -190,13 +224,10 @@ class StockMarginTask(Task):
             now = datetime.now()
             now = datetime(year=now.year, month=now.month, day=now.day)
 
-            last_trade_date = now
-            while not is_trade_date(last_trade_date):
-                last_trade_date = last_trade_date + timedelta(days=-1)
+            last_trade_date = trade_cal.prev_trade_date(now, include=True)
 
             sync_start_date = trade_date['trade_date'].iloc[0] + timedelta(days=1)
-            while not is_trade_date(sync_start_date):
-                sync_start_date = sync_start_date + timedelta(days=1)
+            sync_start_date = trade_cal.next_trade_date(sync_start_date, include=True) or sync_start_date
 
             if self.code[:2] == 'sh':
                 delta = last_trade_date - sync_start_date
@@ -212,7 +243,7 @@ class StockMarginTask(Task):
         async def query_func():
             return trade_date
 
-        fetch_func = partial(self.to_async, func=partial(fetch.fetch_stock_margin, code=self.code))
+        fetch_func = partial(self.fetch_async, fetch.fetch_stock_margin_async, code=self.code)
         save_func = self.db.save_stock_margin
         await self.incr_sync_on_trade_date(query_func=query_func,
                                            fetch_func=fetch_func,
@@ -222,24 +253,173 @@ class StockMarginTask(Task):
         self.log.info('股票融资融券数据task完成, code={}'.format(self.code))
 
 
+class StockMarginDateTask(Task):
+    """
+    按交易日从沪深交易所获取全部标的融资融券明细, 每个交易日几个请求, 代替逐个股票从东方财富获取
+    """
+    _columns = ['code', 'name', 'trade_date', 'spj', 'zdf',
+                'rzye', 'rzyezb', 'rzmre', 'rzche', 'rzjme',
+                'rqye', 'rqyl', 'rqmcl', 'rqchl', 'rqjmg',
+                'rzrqye', 'rzrqyecz']
+
+    def __init__(self, data_sync, name: str = 'stock_margin_date'):
+        super().__init__(data_sync, name)
+
+    @classmethod
+    def normalize(cls, data: pd.DataFrame, prev: Optional[pd.DataFrame], daily: Optional[pd.DataFrame]) -> pd.DataFrame:
+        """
+        交易所明细补齐为stock_margin格式:
+            spj(收盘价)取日线, zdf由前一交易日spj计算, 上证融券余额=融券余量*收盘价,
+            深证融资偿还额/融券偿还量由前一交易日余额推算, rzyezb(余额占流通市值比)交易所没有
+        :param data: fetch_stock_margin_detail数据
+        :param prev: 前一交易日stock_margin数据(code,spj,rzye,rqyl)
+        :param daily: 当日日线(code,close)
+        """
+        data = data.copy()
+        for col in ['rzche', 'rqchl', 'rqye', 'rzrqye']:
+            if col not in data.columns:
+                data[col] = np.nan
+        if daily is not None and not daily.empty:
+            data = data.merge(daily[['code', 'close']].rename(columns={'close': 'spj'}), how='left', on='code')
+        else:
+            data['spj'] = np.nan
+        if prev is not None and not prev.empty:
+            prev = prev[['code', 'spj', 'rzye', 'rqyl']].rename(columns={'spj': 'spj_pre', 'rzye': 'rzye_pre',
+                                                                         'rqyl': 'rqyl_pre'})
+            data = data.merge(prev, how='left', on='code')
+        else:
+            data['spj_pre'], data['rzye_pre'], data['rqyl_pre'] = np.nan, np.nan, np.nan
+
+        data['zdf'] = ((data['spj'] / data['spj_pre'] - 1) * 100).round(2)
+        data['rzche'] = data['rzche'].fillna(data['rzye_pre'] + data['rzmre'] - data['rzye'])
+        data['rqchl'] = data['rqchl'].fillna(data['rqyl_pre'] + data['rqmcl'] - data['rqyl'])
+        data['rqye'] = data['rqye'].fillna(data['rqyl'] * data['spj'])
+        data['rzrqye'] = data['rzrqye'].fillna(data['rzye'] + data['rqye'])
+        data['rzjme'] = data['rzmre'] - data['rzche']
+        data['rqjmg'] = data['rqmcl'] - data['rqchl']
+        data['rzrqyecz'] = data['rzye'] - data['rqye']
+        data['rzyezb'] = np.nan
+        return data[cls._columns]
+
+    async def task(self):
+        self.log.info('开始按交易日同步融资融券数据')
+        last = await self.db.load_stock_margin(projection=['trade_date'], sort=[('trade_date', -1)], limit=1)
+        now = datetime.now()
+        # 融资融券明细下一交易日才公布
+        end = trade_cal.prev_trade_date(now)
+        if end is None:
+            return
+        if last is None or last.empty:
+            # 库里没有数据只同步最近交易日, 历史数据按代码同步
+            trade_dates, prev = [end], None
+        else:
+            last_date = last['trade_date'].iloc[0]
+            self.watermark = last_date
+            trade_dates = trade_cal.trade_dates_between(last_date + timedelta(days=1), end)
+            prev = await self.db.load_stock_margin(filter={'trade_date': last_date},
+                                                   projection=['code', 'spj', 'rzye', 'rqyl'])
+
+        # 交易所明细包含ETF/基金等, 只保存股票
+        codes = await self.db.load_stock_info(projection=['code'])
+        if codes is None or codes.empty:
+            self.log.error('股票信息为空, 请求先同步基础数据...')
+            return
+        codes = set(codes['code'])
+        for trade_date in trade_dates:
+            # spj/zdf/上证rqye取当日日线收盘价, 日线未同步时停止, 下次同步再补
+            daily = await self.db.load_stock_daily(filter={'trade_date': trade_date}, projection=['code', 'close'])
+            if daily is None or daily.empty:
+                self.log.info('日线未同步, 暂不同步融资融券明细, trade_date={}'.format(trade_date))
+                break
+            data = await self.to_async(fetch.fetch_stock_margin_detail, trade_date=trade_date)
+            if data is None or data.empty:
+                self.log.info('交易所融资融券明细未公布, trade_date={}'.format(trade_date))
+                break
+            data = data[data['code'].isin(codes)]
+            data = self.normalize(data, prev, daily)
+            data['sync_date'] = datetime.now()
+            await self.data_sync.submit_db(partial(self.db.save_stock_margin, data=data), task=self)
+            self.watermark = trade_date
+            prev = data
+        self.log.info('按交易日同步融资融券数据完成, watermark={}'.format(self.watermark))
+
+
 class StockConceptTask(Task):
-    def __init__(self, data_sync, name: str):
+    def __init__(self, data_sync, name: str, concurrency: int = 4):
+        """
+        :param concurrency: 并发获取概念成分股数
+        """
         super().__init__(data_sync, name)
+        self.concurrency = concurrency
+
+    @staticmethod
+    def diff_concept(data: pd.DataFrame, data_db: Optional[pd.DataFrame]):
+        """
+        概念成分股和库里比较, data_db只包含本次成功获取的概念
+        :return: (新增或变化的成分股, 已移出概念的成分股)
+        """
+        keys = ['concept_code', 'stock_code']
+        if data_db is None or data_db.empty:
+            return data, None
+        merged = data.merge(data_db, how='outer', on=keys, suffixes=('', '_db'), indicator=True)
+        changed = merged['_merge'] == 'left_only'
+        for col in ['concept_date', 'concept_name', 'stock_name']:
+            changed = changed | ((merged['_merge'] == 'both') & (merged[col] != merged[col + '_db']))
+        upsert = merged[changed][list(data.columns)]
+        removed = merged[merged['_merge'] == 'right_only']
+        return upsert.reset_index(drop=True), removed[keys].reset_index(drop=True)
 
     async def task(self):
         self.log.info('开始获取股票概念数据')
-        start = await self.db.load_stock_concept(projection=['concept_date'],
-                                                 limit=1, sort=[('concept_date', -1)])
-        start = None if start is None or start.empty else start.iloc[0]['concept_date']
+        # 增量: 只获取库里最新概念日期(含)之后的概念
+        start = None
+        data_db = await self.db.load_stock_concept(projection=['concept_date'], limit=1, sort=[('concept_date', -1)])
+        if data_db is not None and not data_db.empty:
+            start = data_db['concept_date'][0]
+
+        concepts = await self.to_async(fetch.fetch_stock_concept_name, start=start)
+        if concepts is None or concepts.empty:
+            self.log.info('获取股票概念数据为空')
+            return
 
-        async def query_func():
-            data = await self.db.stock_concept.distinct('concept_code')
-            if data is None or len(data) == 0:
-                return None
-            return pd.DataFrame([{'concept_code': code} for code in data])
-        await self.incr_sync_on_code(query_func=query_func,
-                                     fetch_func=partial(fetch.fetch_stock_concept, start=start),
-                                     save_func=self.db.save_stock_concept, cmp_key='concept_code')
+        # 成分股按概念获取, 限制并发, 不占满共享的fetch线程池
+        sem = asyncio.Semaphore(self.concurrency)
+
+        async def fetch_cons(item):
+            async with sem:
+                return await self.to_async(fetch.fetch_stock_concept_cons, **item)
+
+        cons = await asyncio.gather(*[fetch_cons(item) for item in concepts.to_dict('records')])
+        # 获取失败的概念不比较, 不删除库里的成分股
+        failed = [item['concept_name'] for item, df in zip(concepts.to_dict('records'), cons) if df is None]
+        fetched = [item['concept_code'] for item, df in zip(concepts.to_dict('records'), cons) if df is not None]
+        frames = [df for df in cons if df is not None and not df.empty]
+        data = pd.concat(frames, ignore_index=True) if len(frames) > 0 else None
+
+        upsert, removed = None, None
+        if len(fetched) > 0:
+            data_db = await self.db.load_stock_concept(filter={'concept_code': {'$in': fetched}},
+                                                       projection=['concept_code', 'concept_date', 'concept_name',
+                                                                   'stock_code', 'stock_name'])
+            if data is not None:
+                upsert, removed = self.diff_concept(data, data_db)
+            elif data_db is not None and not data_db.empty:
+                removed = data_db[['concept_code', 'stock_code']]
+        self.log.info('股票概念成分股: 概念数={}, 获取失败={}, 获取={}, 新增或变化={}, 移出={}'.format(
+            concepts.shape[0], len(failed), data.shape[0] if data is not None else 0,
+            upsert.shape[0] if upsert is not None else 0, removed.shape[0] if removed is not None else 0))
+
+        async def save_func():
+            if upsert is not None and not upsert.empty:
+                await self.db.upsert_stock_concept(data=upsert)
+            if removed is not None and not removed.empty:
+                await self.db.delete_stock_concept(data=removed)
+
+        if (upsert is not None and not upsert.empty) or (removed is not None and not removed.empty):
+            await self.data_sync.submit_db(save_func, task=self)
+        if len(failed) > 0:
+            # task失败, 同步日志不记录完成, 下次重新获取
+            raise Exception('获取概念成分股失败: {}'.format(failed))
         self.log.info('获取获取股票概念数据完成')
 
 
@@ -247,22 +427,122 @@ class StockSync(DataSync):
     def __init__(self, db: StockDB, config: Dict):
         super().__init__(db=db,
                          concurrent_fetch_count=config['con_fetch_num'],
-                         concurrent_save_count=config['con_save_num'])
+                         concurrent_save_count=config['con_save_num'],
+                         journal=config.get('journal'), resume=config.get('resume', True),
+                         metrics_path=config.get('metrics_path'), executor=config.get('executor'),
+                         report_interval=config.get('report_interval', 60), progress=config.get('progress'))
         self.config = config
         self.funcs = self.config['function'].split(',') if self.config['function'] is not None else None
+        # (分片, 分片数), 多进程同步时只同步本分片的代码, 不按代码的task只在分片0同步
+        self.shard = config.get('shard')
+        self.gap_scanner = None
+
+    def in_shard(self, codes: pd.DataFrame) -> pd.DataFrame:
+        if self.shard is None or codes is None:
+            return codes
+        shard, workers = self.shard
+        return codes[codes['code'].map(lambda code: shard_of(code, workers) == shard)].reset_index(drop=True)
+
+    @property
+    def main_shard(self) -> bool:
+        return self.shard is None or self.shard[0] == 0
 
     async def post_tasks(self) -> bool:
         """
         融资融券要容易封IP，和查询日K数据，特殊处理
         """
+        if self.gap_scanner is not None:
+            self.gap_scanner.save()
         return True
 
+    async def prepare_backfill(self, codes: pd.DataFrame, indexes: pd.DataFrame):
+        """
+        扫描日线/指标/指数日线中间缺失的交易日, 按回补计划添加回补task
+        """
+        self.gap_scanner = GapScanner(self.db, path=self.config.get('gap_plan_path'))
+        listing = await self.db.load_stock_info(projection=['code', 'listing_date'])
+        starts = dict(zip(listing['code'], listing['listing_date'])) if listing is not None else None
+        targets = [('stock_daily', self.db.stock_daily, codes, starts, fetch.fetch_stock_daily,
+                    self.db.save_stock_daily),
+                   ('stock_index', self.db.stock_index, codes, None, fetch.fetch_stock_index,
+                    self.db.save_stock_index),
+                   ('index_daily', self.db.index_daily, indexes, None, fetch.fetch_stock_index_daily,
+                    self.db.save_index_daily)]
+        for name, coll, target_codes, target_starts, fetch_func, save_func in targets:
+            if self.funcs is not None and name not in self.funcs:
+                continue
+            plan = await self.gap_scanner.scan(coll, codes=target_codes['code'].tolist(), starts=target_starts)
+            for code, ranges in plan.items():
+                self.add_task(GapBackfillTask(self, scanner=self.gap_scanner, coll=name, code=code, ranges=ranges,
+                                              fetch_func=fetch_func, save_func=save_func))
+        self.gap_scanner.save()
+
+    async def sync_daily_by_date(self, codes: pd.DataFrame) -> pd.DataFrame:
+        """
+        按交易日同步日线: 只缺最新交易日的股票用全市场快照一次获取并批量保存,
+        缺多个交易日/新股/除权除息的股票仍按代码同步(快照没有历史数据, 也算不了复权因子)
+        :param codes: 股票列表
+        :return: 仍需按代码同步的股票
+        """
+        latest = self.target_trade_date(sync_start_time_func=daily_sync_start_time)
+        prev = trade_cal.prev_trade_date(latest) if latest is not None else None
+        if prev is None:
+            return codes
+
+        last = await self.db.load_stock_daily_latest(start=trade_cal.offset(latest, -20))
+        if last is None:
+            return codes
+        last = last[last['code'].isin(codes['code'])]
+        synced = set(last[last['trade_date'] >= latest]['code'])
+        candidate = last[last['trade_date'] == prev]
+        self.log.info('按交易日同步日线: 最新交易日={}, 已同步={}, 只缺最新交易日={}'.format(
+            latest.strftime('%Y-%m-%d'), len(synced), candidate.shape[0]))
+
+        spot = None
+        if not candidate.empty:
+            spot = await self.to_async(fetch.fetch_stock_daily_spot)
+        if spot is None or spot.empty or spot['trade_date'].max() != latest:
+            self.log.info('全市场快照不是最新交易日数据, 按代码同步')
+            return codes[~codes['code'].isin(synced)]
+
+        # 停牌等股票快照中可能是之前交易日的数据, 只用最新交易日的行
+        spot = spot[spot['trade_date'] == latest]
+        data = candidate.merge(spot, on='code', suffixes=('_db', ''))
+        suspended = data[data['close'].isna() | (data['volume'].fillna(0) <= 0)]
+        data = data.drop(index=suspended.index)
+        # 昨收(已除权)和库里收盘价不一致说明有除权除息, 复权因子需要重新获取
+        ex_rights = data[(data['pre_close'] - data['close_db']).abs() > 0.005]
+        data = data.drop(index=ex_rights.index)
+        if not data.empty:
+            data = data[list(self.db._meta['stock_daily'].keys())].reset_index(drop=True)
+            await self.submit_db(partial(self.db.save_stock_daily, data=data))
+
+        done = synced | set(data['code']) | set(suspended['code'])
+        self.log.info('按交易日同步日线: 快照保存={}, 停牌={}, 除权除息={}, 按代码同步={}'.format(
+            data.shape[0], suspended.shape[0], ex_rights.shape[0], codes.shape[0] - len(done)))
+        return codes[~codes['code'].isin(done)]
+
+    async def fetch_stock_info(self):
+        """
+        股票信息(线程池)和融资融券标的(aiohttp)并发获取
+        """
+        data, margin_info = await asyncio.gather(
+            self.loop.run_in_executor(self.executor, partial(fetch.fetch_stock_info, with_margin=False)),
+            fetch.fetch_stock_margin_code())
+        if data is None:
+            return None
+        if margin_info is None or margin_info.empty:
+            # 融资融券标的获取失败时本次不同步股票信息, 避免新股票is_margin错误记为0
+            self.log.error('获取融资融券标的失败, 不同步股票信息')
+            return None
+        return fetch.merge_margin_flag(data, margin_info)
+
     async def prepare_tasks(self) -> bool:
         codes = None
         indexes = None
         if not self.config['skip_basic']:
             codes = await self.incr_sync_on_code(query_func=partial(self.db.load_stock_info, projection=['code']),
-                                                 fetch_func=fetch.fetch_stock_info,
+                                                 fetch_func=self.fetch_stock_info,
                                                  save_func=self.db.save_stock_info)
 
             indexes = await self.incr_sync_on_code(query_func=partial(self.db.load_index_info, projection=['code']),
@@ -272,79 +552,177 @@ class StockSync(DataSync):
             codes = await self.db.load_stock_info(projection=['code'])
             indexes = await self.db.load_index_info(projection=['code'])
 
-        if codes is None or indexes is None:
+        # incr_sync_on_code获取失败返回False
+        if not isinstance(codes, pd.DataFrame) or not isinstance(indexes, pd.DataFrame):
             self.log.error('股票信息和指数信息为空, 请求先同步基础数据...')
             return False
+        codes, indexes = self.in_shard(codes), self.in_shard(indexes)
 
         self.log.info('开始准备task...')
         if self.funcs is None or 'stock_daily' in self.funcs:
-            for _, item in codes.iterrows():
-                self.add_task(
-                    StockDailyTask(data_sync=self, name='stack_daily_{}'.format(item['code']), code=item['code']))
+            daily_codes = codes
+            if self.config.get('by_date', False):
+                daily_codes = await self.sync_daily_by_date(codes)
+            need_codes, watermarks = await self.load_watermarks(self.db.stock_daily, daily_codes['code'].tolist(),
+                                                                sync_start_time_func=daily_sync_start_time)
+            for code in need_codes:
+                self.add_task(StockDailyTask(data_sync=self, name='stack_daily_{}'.format(code), code=code,
+                                             watermarks=watermarks))
 
         if self.funcs is None or 'stock_index' in self.funcs:
-            for _, item in codes.iterrows():
-                self.add_task(StockIndexTask(self, name='stack_index_{}'.format(item['code']), code=item['code']))
+            need_codes, watermarks = await self.load_watermarks(self.db.stock_index, codes['code'].tolist())
+            for code in need_codes:
+                self.add_task(StockIndexTask(self, name='stack_index_{}'.format(code), code=code,
+                                             watermarks=watermarks))
 
         if self.funcs is None or 'index_daily' in self.funcs:
-            for _, item in indexes.iterrows():
-                self.add_task(IndexDailyTask(self, name='index_daily_{}'.format(item['code']), code=item['code']))
+            need_codes, watermarks = await self.load_watermarks(self.db.index_daily, indexes['code'].tolist())
+            for code in need_codes:
+                self.add_task(IndexDailyTask(self, name='index_daily_{}'.format(code), code=code,
+                                             watermarks=watermarks))
 
         if self.funcs is None or 'stock_fq_factor' in self.funcs:
+            sync_meta = await self.db.load_sync_meta('stock_fq_factor', projection=['code', 'sync_date'])
+            sync_dates = dict(zip(sync_meta['code'], sync_meta['sync_date'])) if sync_meta is not None else {}
             for _, item in codes.iterrows():
-                self.add_task(StockFactorTask(self, name='stock_fq_factor_{}'.format(item['code']), code=item['code']))
+                self.add_task(StockFactorTask(self, name='stock_fq_factor_{}'.format(item['code']), code=item['code'],
+                                              sync_date=sync_dates.get(item['code'])))
 
-        if self.funcs is None or 'stock_north_flow' in self.funcs:
+        if self.main_shard and (self.funcs is None or 'stock_north_flow' in self.funcs):
             self.add_task(StockNorthFlowTask(self))
 
-        if self.funcs is None or 'stock_his_divend' in self.funcs:
+        if self.main_shard and (self.funcs is None or 'stock_his_divend' in self.funcs):
             self.add_task(StockHisDivEndTask(self))
 
         if self.funcs is None or 'stock_margin' in self.funcs:
-            margin_codes = await self.db.load_stock_info(filter={'is_margin': 1}, projection=['code'])
-            for _, item in margin_codes.iterrows():
-                self.add_task(
-                    StockMarginTask(self, name='stock_margin_{}'.format(item['code']), code=item['code']))
-
-        if self.funcs is None or 'stock_concept' in self.funcs:
+            if self.config.get('by_date', False):
+                if self.main_shard:
+                    self.add_task(StockMarginDateTask(self))
+            else:
+                margin_codes = self.in_shard(await self.db.load_stock_info(filter={'is_margin': 1},
+                                                                           projection=['code']))
+                for _, item in margin_codes.iterrows():
+                    self.add_task(
+                        StockMarginTask(self, name='stock_margin_{}'.format(item['code']), code=item['code']))
+
+        if self.main_shard and (self.funcs is None or 'stock_concept' in self.funcs):
             self.add_task(StockConceptTask(self, name='stock_concept'))
 
         # 没有用
-        if self.funcs is not None and 'sw_index_info' in self.funcs:
+        if self.main_shard and self.funcs is not None and 'sw_index_info' in self.funcs:
             self.add_task(SWIndexInfoTask(self))
 
+        if self.config.get('backfill', False):
+            await self.prepare_backfill(codes, indexes)
+
         self.log.info('task count={}'.format(len(self.tasks)))
 
         return True
 
 
+def setup_sync(options: Dict, log_file: str):
+    conf_file, conf_dict = init_def_config()
+    conf_dict['mongo'].update(dict(uri=options['uri'], pool=options['pool'],
+                                   max_pool=max(conf_dict['mongo'].get('max_pool', 100), options['con_save_num'])))
+    conf_dict['log'].update(dict(level="debug" if options['debug'] else "critical"))
+    setup_log(conf_dict, log_file)
+    if options['http_cache'] is not None:
+        fetch_dict = conf_dict.setdefault('fetch', {})
+        fetch_dict['cache_mode'] = options['http_cache']
+        if fetch_dict.get('cache_path') is None:
+            fetch_dict['cache_path'] = os.sep.join([os.path.dirname(conf_file), 'http_cache'])
+    setup_fetch_cache(conf_dict)
+    return conf_file, conf_dict
+
+
+def sync_config(conf_file: str, options: Dict, name: str) -> Dict:
+    conf_path = os.path.dirname(conf_file)
+    return dict(skip_basic=options['skip_basic'],
+                con_fetch_num=options['con_fetch_num'],
+                con_save_num=options['con_save_num'],
+                function=options['function'],
+                by_date=options['by_date'],
+                # 每个分片(stock_sync_<分片>_<分片数>)独立的日志文件, 多进程不竞争sqlite写锁
+                journal=SyncJournal(path=os.sep.join([conf_path, 'journal', '{}.db'.format(name)]),
+                                    name=name) if options['journal'] else None,
+                resume=options['resume'],
+                metrics_path=os.sep.join([conf_path, 'metrics', name]) if options['metrics'] else None,
+                backfill=options['backfill'],
+                gap_plan_path=os.sep.join([conf_path, 'gaps', '{}.json'.format(name)]))
+
+
+def sync_worker(shard: int, workers: int, progress_queue, options: Dict):
+    """
+    多进程同步的worker进程: 独立的事件循环及mongodb连接, 只同步本分片的代码
+    """
+    name = 'stock_sync_{}_{}'.format(shard, workers)
+    conf_file, conf_dict = setup_sync(options, '{}.log'.format(name))
+    reporter = ShardReporter(progress_queue, shard)
+    try:
+        db = setup_db(conf_dict, StockDB)
+    except Exception:
+        reporter('error', dict(failed=[]))
+        raise
+    config = sync_config(conf_file, dict(options, skip_basic=True), name)
+    config.update(shard=(shard, workers), progress=reporter, report_interval=10)
+    sync = StockSync(db=db, config=config)
+    run_until_complete(sync.sync())
+
+
 @click.command()
 @click.option('--uri', type=str, default='mongodb://localhost:27017/', help='mongodb connection uri')
-@click.option('--pool', default=10, type=int, help='mongodb connection pool size')
+@click.option('--pool', default=10, type=int,
+              help='mongodb connections kept open in the pool, the pool grows up to max(max_pool, con-save-num)')
 @click.option('--skip-basic/--no-skip-basic', default=False, type=bool, help='skip sync basic')
 @click.option('--con-fetch-num', default=10, type=int, help='concurrent net fetch number')
 @click.option('--con-save-num', default=100, type=int, help='concurrent db save number')
 @click.option('--function', type=str,
-              help='sync one, split by ",", available: stock_daily,stock_index,index_daily,stock_fq_factor,'
-                   'stock_north_flow,stock_his_divend,sw_index_info,stock_margin,stock_concept')
+              help='sync one, split by ",", available: stock_info,stock_daily,stock_index,index_daily,'
+                   'stock_fq_factor,stock_north_flow,stock_his_divend,sw_index_info,stock_margin,stock_concept')
+@click.option('--by-date/--no-by-date', default=False, type=bool,
+              help='sync stock_daily of the latest trade date with one market snapshot, '
+                   'stock_margin with the exchange daily margin details')
+@click.option('--journal/--no-journal', default=True, type=bool, help='record sync journal for resuming')
+@click.option('--resume/--no-resume', default=True, type=bool, help='skip tasks finished by the last unfinished run')
+@click.option('--metrics/--no-metrics', default=True, type=bool,
+              help='dump sync metrics as json/prometheus text when finished')
+@click.option('--http-cache', type=click.Choice(['rw', 'replay']),
+              help='cache http responses on disk, replay: only use cached responses, no network')
+@click.option('--backfill/--no-backfill', default=False, type=bool,
+              help='scan stock_daily/stock_index/index_daily for missing trade dates and backfill them')
+@click.option('--workers', default=1, type=int,
+              help='worker process number, codes are sharded across processes, each with its own mongodb client')
 @click.option('--debug/--no-debug', default=True, type=bool, help='show debug log')
 def main(uri: str = 'mongodb://localhost:27017/', pool: int = 5,
          skip_basic: bool = False,
          con_fetch_num: int = 10, con_save_num: int = 100,
-         function: str = None, debug: bool = True):
-    _, conf_dict = init_def_config()
-    conf_dict['mongo'].update(dict(uri=uri, pool=pool))
-    conf_dict['log'].update(dict(level="debug" if debug else "critical"))
-    setup_log(conf_dict, 'stock_sync.log')
-    db = setup_db(conf_dict, StockDB)
-    if db is None:
+         function: str = None, by_date: bool = False, journal: bool = True, resume: bool = True,
+         metrics: bool = True, http_cache: str = None, backfill: bool = False, workers: int = 1,
+         debug: bool = True):
+    options = dict(uri=uri, pool=pool, skip_basic=skip_basic, con_fetch_num=con_fetch_num, con_save_num=con_save_num,
+                   function=function, by_date=by_date, journal=journal, resume=resume, metrics=metrics,
+                   http_cache=http_cache, backfill=backfill, debug=debug)
+    conf_file, conf_dict = setup_sync(options, 'stock_sync.log')
+    if workers <= 1:
+        db = setup_db(conf_dict, StockDB)
+        if db is None:
+            return
+        sync = StockSync(db=db, config=sync_config(conf_file, options, 'stock_sync'))
+        run_until_complete(sync.sync())
         return
-    config = dict(skip_basic=skip_basic,
-                  con_fetch_num=con_fetch_num,
-                  con_save_num=con_save_num,
-                  function=function)
-    sync = StockSync(db=db, config=config)
-    run_until_complete(sync.sync())
+
+    if not skip_basic:
+        # 基础数据在协调进程同步一次, worker进程从数据库读取代码后分片
+        db = setup_db(conf_dict, StockDB)
+        if db is None:
+            return
+        sync = StockSync(db=db, config=dict(sync_config(conf_file, dict(options, journal=False), 'stock_sync_basic'),
+                                            function='stock_info', backfill=False))
+        run_until_complete(sync.sync())
+        if sync.status not in ('done', 'partial'):
+            return
+
+    SyncShard('stock_sync', workers, sync_worker, args=(options,)).run()
 
 
 if __name__ == '__main__':
@@ -90,13 +90,34 @@ def setup_log(conf_dict, file_name, reset=False):
 
 
 def setup_db(conf_dict, cls):
-    db = cls(uri=conf_dict['mongo']['uri'], pool=conf_dict['mongo']['pool'])
+    db = cls(uri=conf_dict['mongo']['uri'], pool=conf_dict['mongo']['pool'],
+             max_pool=conf_dict['mongo'].get('max_pool', 100))
+    if conf_dict['mongo'].get('cache_path') is not None:
+        db.enable_cache(conf_dict['mongo']['cache_path'])
     if not db.init():
         raise Exception('初始化数据库失败')
 
     return db
 
 
+def setup_fetch_cache(conf_dict):
+    """
+    requests按上游限速, 配置了fetch.cache_path时开启http响应缓存(缓存在限速之外, 命中不占令牌)
+    """
+    import bbq.fetch as fetch
+    fetch.install_requests_limiter(fetch.rate_limiter)
+
+    fetch_dict = conf_dict.get('fetch', {})
+    if fetch_dict.get('cache_path') is None:
+        return None
+
+    cache = fetch.enable_http_cache(path=fetch_dict['cache_path'], ttl=fetch_dict.get('cache_ttl', 24 * 3600),
+                                    max_size=fetch_dict.get('cache_max_size', 1024 * 1024 * 1024),
+                                    mode=fetch_dict.get('cache_mode', 'rw'))
+    log.get_logger().info('开启http缓存: path={}, mode={}'.format(cache.path, cache.mode))
+    return cache
+
+
 def load_cmd_yml(value):
     js = None
     for i in range(2):
@@ -1,4 +1,9 @@
 from bbq.data.funddb import FundDB
 from bbq.data.stockdb import StockDB
 from bbq.data.mongodb import MongoDB
+from bbq.data.kdata_cache import KDataCache
 from bbq.data.data_sync import CommSync, Task, DataSync
+from bbq.data.sync_journal import SyncJournal
+from bbq.data.sync_dag import SyncDag
+from bbq.data.sync_shard import SyncShard, ShardReporter, shard_of
+from bbq.data.gap_scanner import GapScanner, GapBackfillTask
@@ -1,18 +1,34 @@
 import asyncio
+import time
 import traceback
 from abc import ABC
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from functools import partial
+from typing import Callable, Dict, Optional
 import numpy as np
+import pandas as pd
 
 from bbq import log
-from bbq.fetch import is_trade_date
+from bbq.data.save_buffer import SaveBuffer
+from bbq.data.sync_journal import SyncJournal
+from bbq.data.sync_metrics import SyncMetrics
+from bbq.fetch import trade_cal, rate_limiter, http_client
+
+
+def func_name(func) -> str:
+    while isinstance(func, partial):
+        func = func.func
+    return getattr(func, '__name__', str(func))
 
 
 class CommSync(ABC):
     def __init__(self, data_sync):
         self.data_sync = data_sync
         self.log = log.get_logger(self.__class__.__name__)
+        self.fetch_time = 0.0
+        self.watermark = None
+        self.pending_saves = []
 
     @staticmethod
     def is_synced(start, end, sync_start_time_func=None):
@@ -29,11 +45,8 @@ class CommSync(ABC):
 
         if not is_synced:
             if start is not None and end is not None:
-                while start <= end:
-                    if is_trade_date(start):
-                        break
-                    start = start + timedelta(days=1)
-                else:
+                next_trade_date = trade_cal.next_trade_date(start, include=True)
+                if next_trade_date is None or next_trade_date > end:
                     is_synced = True
 
         return is_synced
@@ -45,9 +58,9 @@ class CommSync(ABC):
         start = None
         end = datetime.now()
         if trade_date is not None:
+            self.watermark = trade_date[cmp_key].iloc[0]
             start = trade_date[cmp_key].iloc[0] + timedelta(days=1)
-            while not is_trade_date(start):
-                start = start + timedelta(days=1)
+            start = trade_cal.next_trade_date(start, include=True) or start
 
         is_synced = self.is_synced(start, end, sync_start_time_func)
 
@@ -59,8 +72,10 @@ class CommSync(ABC):
             data = await fetch_func(start=start, end=end)
             data = filter_data_func(data) if filter_data_func is not None else data
             if data is not None and not data.empty:
+                if cmp_key in data.columns:
+                    self.watermark = data[cmp_key].max()
                 save_func = partial(save_func, data=data)
-                await self.data_sync.submit_db(save_func)
+                await self.data_sync.submit_db(save_func, task=self)
                 return True
         return False
 
@@ -85,7 +100,10 @@ class CommSync(ABC):
         return data_new
 
     async def incr_sync_on_code(self, query_func, fetch_func, save_func, cmp_key='code'):
-        data = fetch_func()
+        if asyncio.iscoroutinefunction(fetch_func):
+            data = await self.fetch_async(fetch_func)
+        else:
+            data = await self.to_async(fetch_func)
         if data is None:
             return False
 
@@ -94,50 +112,141 @@ class CommSync(ABC):
             data_new = self.gen_incr_data(cmp_key, data_db, data)
             if data_new is not None:
                 save_func = partial(save_func, data=data_new)
-                await self.data_sync.submit_db(save_func)
+                await self.data_sync.submit_db(save_func, task=self)
         return data
 
-    @staticmethod
-    async def to_async(func, *args, **kwargs):
-        return func(*args, **kwargs)
+    async def to_async(self, func, *args, **kwargs):
+        """
+        同步函数(requests/akshare等阻塞调用)放到DataSync的线程池运行, 不阻塞事件循环
+        """
+        start = time.time()
+        try:
+            return await self.data_sync.loop.run_in_executor(self.data_sync.executor, partial(func, *args, **kwargs))
+        finally:
+            cost = time.time() - start
+            self.fetch_time = self.fetch_time + cost
+            self.data_sync.metrics.observe_fetch(func_name(func), cost)
+
+    async def fetch_async(self, func, *args, **kwargs):
+        """
+        原生异步(aiohttp)的fetch, 直接在事件循环运行, 同to_async统计fetch耗时
+        """
+        start = time.time()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            cost = time.time() - start
+            self.fetch_time = self.fetch_time + cost
+            self.data_sync.metrics.observe_fetch(func_name(func), cost)
 
 
 class Task(CommSync):
-    def __init__(self, data_sync, name):
+    def __init__(self, data_sync, name, watermarks: Dict = None):
+        """
+        :param watermarks: prepare_tasks预先聚合的水位 dict(code -> 最后trade_date), None时task自己查询
+        """
         super().__init__(data_sync)
         self.name = name
         self.db = self.data_sync.db
+        self.watermarks = watermarks
+
+    def watermark_query(self, query_func, cmp_key='trade_date'):
+        """
+        有预先聚合的水位时返回水位, 不再查询数据库
+        """
+        if self.watermarks is None:
+            return query_func
+
+        async def _query_func():
+            last = self.watermarks.get(self.code)
+            return pd.DataFrame({cmp_key: [last]}) if last is not None else None
+
+        return _query_func
+
+    @property
+    def key(self) -> str:
+        """
+        task唯一标识, 用于同步日志
+        """
+        code = getattr(self, 'code', None)
+        return '{}:{}'.format(self.__class__.__name__, code if code is not None else self.name)
 
     async def task(self):
         pass
 
+    async def journal_done(self):
+        # 数据保存成功后才记录完成
+        if len(self.pending_saves) > 0 and not all(await asyncio.gather(*self.pending_saves)):
+            return
+        self.data_sync.journal.done(self.key, self.watermark)
+
     async def run(self):
+        start, status = time.time(), 'done'
+        self.data_sync.metrics.task_start()
         try:
             self.log.info('开始运行task: {}'.format(self.name))
             # await self.data_sync.queue.get()
             await self.task()
             await self.data_sync.queue.get()
+            if self.data_sync.journal is not None:
+                self.data_sync.journal_tasks.append(self.data_sync.loop.create_task(self.journal_done()))
         except Exception as e:
+            status = 'error'
             self.log.error('运行task异常: ex={} stack={}'.format(e, traceback.format_exc()))
         finally:
+            self.data_sync.task_stat.append(dict(name=self.name, task=self.__class__.__name__, status=status,
+                                                 cost=time.time() - start, fetch_cost=self.fetch_time))
+            self.data_sync.metrics.task_end(status == 'done')
             self.data_sync.queue.task_done()
 
 
 class DataSync(CommSync):
     def __init__(self, db,
                  concurrent_fetch_count: int = 50,
-                 concurrent_save_count: int = 100, loop=None):
+                 concurrent_save_count: int = 100, loop=None,
+                 journal: SyncJournal = None, resume: bool = True,
+                 save_batch_rows: int = 5000, save_max_delay: float = 2.0, save_max_rows: int = 100000,
+                 metrics_path: str = None, report_interval: int = 60,
+                 executor: ThreadPoolExecutor = None, progress: Callable[[str, Dict], None] = None):
+        """
+        :param concurrent_fetch_count: 并发task数, 同时也是同步fetch线程池大小
+        :param concurrent_save_count: 并发保存数
+        :param journal: 同步日志, None不记录
+        :param resume: 上次同步未完成时跳过已完成的task
+        :param save_batch_rows: 跨task合并保存的行数阈值, 0不合并
+        :param save_max_delay: 合并保存最长缓存时间(秒)
+        :param save_max_rows: 合并保存缓存的最大行数, 超过时task等待
+        :param metrics_path: 同步结束时输出指标 {metrics_path}.json/.prom, None不输出
+        :param report_interval: 同步进度汇总日志间隔(秒), 0不输出
+        :param executor: 共享的fetch线程池(如多个同步在同一进程运行), 共享时同步结束不关闭线程池及http连接池
+        :param progress: 进度回调 progress(state, info), state为progress或同步结束状态(如多进程同步时发送给协调进程)
+        """
+        self.journal = journal
+        self.resume = resume
+        self.concurrent_fetch_count = concurrent_fetch_count
+        self.concurrent_save_count = concurrent_save_count
+        self.loop = asyncio.get_event_loop() if loop is None else loop
+        self.shared = executor is not None
+        self.executor = ThreadPoolExecutor(max_workers=concurrent_fetch_count, thread_name_prefix='fetch') \
+            if executor is None else executor
+        self.metrics = SyncMetrics(self.__class__.__name__)
+        self.metrics_path = metrics_path
+        self.report_interval = report_interval
+        self.progress = progress
+
         super().__init__(self)
 
         self.db = db
 
         self.tasks = []
+        self.task_stat = []
+        self.journal_tasks = []
+        self.status = None
 
-        self.concurrent_fetch_count = concurrent_fetch_count
-        self.concurrent_save_count = concurrent_save_count
-        self.loop = asyncio.get_event_loop() if loop is None else loop
         self.queue = asyncio.Queue(self.concurrent_fetch_count)
         self.queue_db = asyncio.Queue(self.concurrent_save_count)
+        self.save_buffer = SaveBuffer(self, batch_rows=save_batch_rows, max_delay=save_max_delay,
+                                      max_rows=save_max_rows) if save_batch_rows > 0 else None
 
     def add_task(self, task):
         self.tasks.append(task)
@@ -148,35 +257,174 @@ class DataSync(CommSync):
     async def post_tasks(self) -> bool:
         return True
 
-    async def db_task(self, save_func):
+    async def db_task(self, save_func, name: str = None) -> bool:
+        """
+        :param name: 指标中的集合名, None时取保存函数名
+        """
+        ok, rows = False, 0
+        data = save_func.keywords.get('data') if isinstance(save_func, partial) else None
+        if isinstance(data, pd.DataFrame):
+            rows = data.shape[0]
+        if name is None:
+            name = func_name(save_func)
+            name = name[len('save_'):] if name.startswith('save_') else name
         try:
             await self.queue_db.get()
             await save_func()
+            ok = True
         except Exception as e:
             self.log.error('同步数据库异常: ex={} stack={}'.format(e, traceback.format_exc()))
         finally:
+            self.metrics.observe_save(name, rows, ok)
             self.queue_db.task_done()
+        return ok
+
+    async def submit_db(self, save_func, task: CommSync = None, coalesce: bool = True):
+        """
+        :param save_func: 保存函数
+        :param task: 提交保存的task, 保存完成后task才在同步日志中记录完成
+        :param coalesce: partial(save_func, data=DataFrame)形式的保存是否和其它task合并保存
+        """
+        key = SaveBuffer.key(save_func) if coalesce and self.save_buffer is not None else None
+        if key is not None:
+            fut = await self.save_buffer.put(key, save_func.keywords['data'])
+        else:
+            await self.queue_db.put(True)
+            name = task.__class__.__name__ if task is not None and SaveBuffer.key(save_func) is None else None
+            fut = self.loop.create_task(self.db_task(save_func, name))
+        if task is not None:
+            task.pending_saves.append(fut)
+        return fut
+
+    def log_remaining(self, tasks):
+        total, remaining = {}, {}
+        for task in self.tasks:
+            name = task.__class__.__name__
+            total[name] = total.get(name, 0) + 1
+        for task in tasks:
+            name = task.__class__.__name__
+            remaining[name] = remaining.get(name, 0) + 1
+        self.log.info('待运行task: 总数={}, 已完成={}, 剩余={}'.format(len(self.tasks), len(self.tasks) - len(tasks),
+                                                               len(tasks)))
+        for name, count in total.items():
+            self.log.info('  {}: 总数={}, 剩余={}'.format(name, count, remaining.get(name, 0)))
 
-    async def submit_db(self, save_func):
-        await self.queue_db.put(True)
-        self.loop.create_task(self.db_task(save_func))
+    @staticmethod
+    def target_trade_date(sync_start_time_func=None) -> Optional[datetime]:
+        """
+        本次同步的目标交易日: 已到同步开始时间(默认15:30收盘后)的最新交易日
+        """
+        now = datetime.now()
+        now_tag = datetime(year=now.year, month=now.month, day=now.day, hour=15, minute=30) \
+            if sync_start_time_func is None else sync_start_time_func(now)
+        if trade_cal.is_trade_date(now) and now < now_tag:
+            return trade_cal.prev_trade_date(now)
+        return trade_cal.prev_trade_date(now, include=True)
+
+    def need_sync(self, last_date, sync_start_time_func=None) -> bool:
+        """
+        根据水位和交易日历判断是否需要同步, 与incr_sync_on_trade_date的判断一致
+        """
+        if last_date is None:
+            return True
+        start = trade_cal.next_trade_date(last_date) or last_date + timedelta(days=1)
+        return not self.is_synced(start, datetime.now(), sync_start_time_func)
+
+    async def load_watermarks(self, coll, codes, sync_start_time_func=None):
+        """
+        一次聚合获取集合所有代码的水位, 过滤掉已经是最新的代码
+        :return: (需要同步的代码, 水位dict), 聚合失败时水位为None
+        """
+        watermarks = await self.db.do_load_watermarks(coll)
+        if watermarks is None:
+            return codes, None
+        need_codes = [code for code in codes if self.need_sync(watermarks.get(code), sync_start_time_func)]
+        self.log.info('{}: 代码数={}, 已是最新={}'.format(coll.name, len(codes), len(codes) - len(need_codes)))
+        return need_codes, watermarks
+
+    def log_task_stat(self, top=10):
+        if len(self.task_stat) == 0:
+            return
+        stat = sorted(self.task_stat, key=lambda x: x['cost'], reverse=True)
+        errors = len([item for item in stat if item['status'] == 'error'])
+        self.log.info('task统计: 总数={}, 失败={}, 累计耗时={:.2f}s, 累计fetch耗时={:.2f}s'.format(
+            len(stat), errors, sum([item['cost'] for item in stat]), sum([item['fetch_cost'] for item in stat])))
+        for item in stat[:top]:
+            self.log.info('耗时task: {}({}), status={}, cost={:.2f}s, fetch_cost={:.2f}s'.format(
+                item['name'], item['task'], item['status'], item['cost'], item['fetch_cost']))
+        self.log.info('上游限速统计: {}'.format(rate_limiter.stat()))
+        self.log.info('http连接池统计: {}'.format(http_client.stat()))
+        if http_client.cache is not None:
+            self.log.info('http缓存统计: {}'.format(http_client.cache.stat()))
+        if self.save_buffer is not None:
+            for name, stat in self.save_buffer.stat().items():
+                self.log.info('合并保存统计: {}, {}'.format(name, stat))
+
+    async def report_progress(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            self.log.info('同步进度: {}'.format(self.metrics.summary()))
+            if self.progress is not None:
+                self.progress('progress', self.progress_info())
+
+    def progress_info(self) -> Dict:
+        """
+        :return: dict(tasks, rows, failed), failed为失败的task名称
+        """
+        return dict(tasks=dict(self.metrics.tasks), rows=sum(self.metrics.rows.values()),
+                    failed=[item['name'] for item in self.task_stat if item['status'] == 'error'])
 
     async def sync(self):
+        status, reporter = 'error', None
         try:
+            if self.journal is not None:
+                self.journal.start(resume=self.resume, trade_date=self.target_trade_date())
+
             if not await self.prepare_tasks():
                 self.log.error('准备task失败')
                 return None
 
-            for task in self.tasks:
+            tasks = self.tasks
+            if self.journal is not None:
+                tasks = [task for task in self.tasks if not self.journal.is_done(task.key)]
+            self.log_remaining(tasks)
+            self.metrics.task_queued(len(tasks))
+            if self.report_interval > 0:
+                reporter = self.loop.create_task(self.report_progress())
+
+            for task in tasks:
                 await self.queue.put(task.name)
                 self.log.info('准备运行task: {}'.format(task.name))
                 self.loop.create_task(task.run())
-            if len(self.tasks) > 0:
+            if len(tasks) > 0:
                 await self.queue.join()
-                await self.queue_db.join()
+            if self.save_buffer is not None:
+                await self.save_buffer.flush_all()
+            await self.queue_db.join()
+            await asyncio.gather(*self.journal_tasks)
 
             await self.post_tasks()
+            self.log_task_stat()
+            status = 'done' if len([item for item in self.task_stat if item['status'] == 'error']) == 0 else 'partial'
             self.log.info('同步完成')
 
         except Exception as e:
             self.log.error('同步数据失败: ex={}, stack={}'.format(e, traceback.format_exc()))
+        finally:
+            if reporter is not None:
+                reporter.cancel()
+            self.log.info('同步进度: {}'.format(self.metrics.summary()))
+            if self.metrics_path is not None:
+                try:
+                    self.metrics.dump(self.metrics_path)
+                except Exception as e:
+                    self.log.error('输出同步指标失败: ex={}'.format(e))
+            if self.journal is not None:
+                self.journal.finish(status)
+                self.journal.close()
+            self.status = status
+            if self.progress is not None:
+                self.progress(status, self.progress_info())
+            if not self.shared:
+                await http_client.close()
+                self.executor.shutdown(wait=False)
@@ -1,4 +1,6 @@
 from bbq.data.mongodb import MongoDB
+from typing import List, Optional, Dict, Union
+from datetime import datetime
 import pandas as pd
 
 
@@ -19,8 +21,14 @@ class FundDB(MongoDB):
     }
     _db = 'bbq_fund_db'  # 基金数据库
 
-    def __init__(self, uri='mongodb://localhost:27017/', pool=5):
-        super().__init__(uri, pool)
+    _indexes = {
+        'fund_info': [dict(keys=[('code', 1)])],
+        'fund_net': [dict(keys=[('code', 1), ('trade_date', -1)]), dict(keys=[('trade_date', -1)])],
+        'fund_daily': [dict(keys=[('code', 1), ('trade_date', -1)]), dict(keys=[('trade_date', -1)])]
+    }
+
+    def __init__(self, uri='mongodb://localhost:27017/', pool=5, **kwargs):
+        super().__init__(uri, pool, **kwargs)
 
     @property
     def fund_info(self):
@@ -56,6 +64,17 @@ class FundDB(MongoDB):
         self.log.debug('加载基金净值数据,成功, size={}'.format(df.shape[0] if df is not None else 0))
         return df
 
+    async def iter_fund_net(self, chunk_size=5000, **kwargs):
+        """
+        流式加载基金净值
+        :param chunk_size: 每批条数
+        :param kwargs:  filter=None, projection=None, skip=0, limit=0, sort=None, compact=False
+        :return: 异步生成器, 每次返回DataFrame
+        """
+        self.log.debug('流式加载基金净值数据, kwargs={}'.format(kwargs))
+        async for df in self.iter_load(self.fund_net, chunk_size=chunk_size, **kwargs):
+            yield df
+
     async def save_fund_net(self, data: pd.DataFrame):
         count = data.shape[0] if data is not None else 0
         inserted_ids = []
@@ -67,10 +86,29 @@ class FundDB(MongoDB):
 
     async def load_fund_daily(self, **kwargs):
         self.log.debug('加载场内基金日线数据, kwargs={}'.format(kwargs))
-        df = await self.do_load(self.fund_daily, **kwargs)
+        df = await self.do_cached_load(self.fund_daily, **kwargs)
         self.log.debug('加载场内基金日线数据,成功, size={}'.format(df.shape[0] if df is not None else 0))
         return df
 
+    async def load_fund_daily_many(self, codes: List[str], start: datetime = None, end: datetime = None,
+                                   limit: int = 0, panel: bool = False,
+                                   **kwargs) -> Optional[Union[Dict[str, pd.DataFrame], pd.DataFrame]]:
+        """
+        批量加载场内基金日线
+        :param codes: 基金代码列表
+        :param start: 开始交易日(含)
+        :param end: 结束交易日(含)
+        :param limit: 每个代码截止end最近limit条, 0为不限制
+        :param panel: True返回MultiIndex(code, trade_date)的DataFrame, False返回dict(code -> DataFrame)
+        :param kwargs: projection=None, chunk_size=500, compact=False
+        :return: 按trade_date升序的数据
+        """
+        self.log.debug('批量加载场内基金日线, count={}, start={}, end={}, limit={}'.format(len(codes), start, end, limit))
+        data = await self.do_load_daily_many(self.fund_daily, codes, start=start, end=end, limit=limit,
+                                             panel=panel, **kwargs)
+        self.log.debug('批量加载场内基金日线成功, size={}'.format(len(data) if data is not None else 0))
+        return data
+
     async def save_fund_daily(self, data: pd.DataFrame):
         count = data.shape[0] if data is not None else 0
         inserted_ids = []
@@ -0,0 +1,190 @@
+import asyncio
+import json
+import os
+from datetime import datetime
+from functools import partial
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from bbq import log
+from bbq.data.data_sync import Task
+from bbq.data.mongodb import MongoDB
+from bbq.fetch import trade_cal
+
+
+class GapScanner:
+    """
+    日线类集合(code, trade_date)中间缺失数据扫描:
+        1. 一次聚合获取每个代码的 最早/最新交易日及记录数, 和交易日历的交易日数比较, 记录数少的代码才有缺失
+        2. 有缺失的代码批量加载交易日, 按交易日位图找出缺失区间(连续缺失的交易日合并)
+    扫描范围为 开始日期(上市日期, 没有时为库里最早交易日) 到 库里最新交易日, 最新交易日之后由增量同步补全
+    回补计划保存为json: {plan: {集合: {代码: [[开始, 结束]]}}, empty: {集合: {代码: [[开始, 结束]]}}},
+    empty为回补时数据源也没有数据的区间(停牌等), 之后扫描不再算缺失
+    """
+
+    def __init__(self, db: MongoDB, path: str = None):
+        """
+        :param db: 数据库
+        :param path: 回补计划json文件路径, None不保存
+        """
+        self.log = log.get_logger(self.__class__.__name__)
+        self.db = db
+        if path is not None and len(path) > 0 and path[0] == '~':
+            path = os.path.expanduser('~') + path[1:]
+        self.path = path
+
+        self.plan: Dict[str, Dict[str, List[list]]] = {}
+        self.empty: Dict[str, Dict[str, List[list]]] = {}
+        if self.path is not None and os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    data = json.load(f)
+                self.plan = data.get('plan', {})
+                self.empty = data.get('empty', {})
+            except Exception as e:
+                self.log.error('加载回补计划失败: path={}, ex={}'.format(self.path, e))
+
+    @staticmethod
+    def to_ranges(ranges: List[list]) -> List[Tuple[datetime, datetime]]:
+        return [(datetime.strptime(start, '%Y-%m-%d'), datetime.strptime(end, '%Y-%m-%d')) for start, end in ranges]
+
+    @staticmethod
+    def from_ranges(ranges: List[Tuple[datetime, datetime]]) -> List[list]:
+        return [[start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')] for start, end in ranges]
+
+    async def scan(self, coll, codes: List[str] = None, starts: Dict[str, datetime] = None,
+                   batch: int = 50) -> Dict[str, List[Tuple[datetime, datetime]]]:
+        """
+        :param coll: 集合
+        :param codes: 只扫描这些代码, None扫描集合中全部代码
+        :param starts: 代码 -> 开始日期(如上市日期), 早于库里最早交易日时作为扫描开始日期
+        :param batch: 每次加载交易日的代码数
+        :return: 代码 -> 缺失区间[(开始交易日, 结束交易日)]
+        """
+        pipeline = [{'$group': {'_id': '$code', 'first': {'$min': '$trade_date'}, 'last': {'$max': '$trade_date'},
+                                'count': {'$sum': 1}}}]
+        if codes is not None:
+            pipeline.insert(0, {'$match': {'code': {'$in': list(codes)}}})
+        summary = await self.db.do_aggregate(coll, pipeline, to_frame=False)
+        if summary is None:
+            self.log.info('{}缺失扫描: 没有数据'.format(coll.name))
+            return {}
+
+        empty = self.empty.get(coll.name, {})
+        suspects = []
+        for item in summary:
+            code, start, end = item['_id'], item['first'], item['last']
+            if start is None or end is None:
+                continue
+            listing = starts.get(code) if starts is not None else None
+            if listing is not None and not pd.isna(listing) and \
+                    trade_cal.to_ordinal(listing) is not None and trade_cal.to_ordinal(listing) < start.toordinal():
+                start = listing
+            exclude = self.to_ranges(empty.get(code, []))
+            expected = trade_cal.count_between(start, end) - sum(trade_cal.count_between(s, e) for s, e in exclude)
+            if item['count'] < expected:
+                suspects.append((code, start, end, exclude))
+
+        plan = {}
+        for i in range(0, len(suspects), batch):
+            items = suspects[i:i + batch]
+            data = await self.db.do_load(coll, filter={'code': {'$in': [item[0] for item in items]}},
+                                         projection=['code', 'trade_date'])
+            dates = dict(list(data.groupby('code')['trade_date'])) if data is not None else {}
+            for code, start, end, exclude in items:
+                ranges = trade_cal.missing_ranges(dates.get(code, []), start, end, exclude=exclude)
+                if len(ranges) > 0:
+                    plan[code] = ranges
+
+        self.plan[coll.name] = {code: self.from_ranges(ranges) for code, ranges in plan.items()}
+        self.log.info('{}缺失扫描: 代码数={}, 记录数不足={}, 有缺失={}, 缺失区间={}, 缺失交易日={}'.format(
+            coll.name, len(summary), len(suspects), len(plan), sum(len(ranges) for ranges in plan.values()),
+            sum(trade_cal.count_between(s, e) for ranges in plan.values() for s, e in ranges)))
+        return plan
+
+    def backfilled(self, coll: str, code: str, empty: List[Tuple[datetime, datetime]]):
+        """
+        回补完成
+        :param empty: 回补时数据源也没有数据的区间
+        """
+        self.plan.get(coll, {}).pop(code, None)
+        if len(empty) > 0:
+            ranges = self.empty.setdefault(coll, {}).setdefault(code, [])
+            ranges.extend(self.from_ranges(empty))
+            ranges.sort()
+
+    def save(self):
+        if self.path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_file = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp_file, 'w') as f:
+                json.dump(dict(plan=self.plan, empty=self.empty), f, ensure_ascii=False, indent=1)
+            os.replace(tmp_file, self.path)
+            self.log.info('回补计划已保存: {}'.format(self.path))
+        except Exception as e:
+            self.log.error('保存回补计划失败: path={}, ex={}'.format(self.path, e))
+
+
+class GapBackfillTask(Task):
+    """
+    按回补计划补全一个代码的缺失区间: 一次获取覆盖全部缺失区间的数据, 只保存缺失区间内的交易日
+    """
+
+    def __init__(self, data_sync, scanner: GapScanner, coll: str, code: str,
+                 ranges: List[Tuple[datetime, datetime]], fetch_func: Callable, save_func: Callable):
+        """
+        :param fetch_func: fetch_func(code, start, end), 同步函数或协程函数
+        :param save_func: save_func(data)
+        """
+        super().__init__(data_sync, 'gap_{}_{}'.format(coll, code))
+        self.scanner = scanner
+        self.coll = coll
+        self.code = code
+        self.ranges = ranges
+        self.fetch_func = fetch_func
+        self.save_func = save_func
+
+    @property
+    def key(self) -> str:
+        return '{}:{}:{}'.format(self.__class__.__name__, self.coll, self.code)
+
+    async def task(self):
+        start, end = self.ranges[0][0], self.ranges[-1][1]
+        self.log.info('开始回补{}缺失数据, code={}, 区间数={}, start={}, end={}'.format(
+            self.coll, self.code, len(self.ranges), start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')))
+        fetch_func = partial(self.fetch_func, code=self.code, start=start, end=end)
+        if asyncio.iscoroutinefunction(self.fetch_func):
+            data = await self.fetch_async(fetch_func)
+        else:
+            data = await self.to_async(fetch_func)
+        if data is None:
+            # 获取失败(None也可能是数据源没有数据, 无法区分), 保留在回补计划中, 不记为没有数据, 下次扫描仍会回补
+            self.log.error('回补{}缺失数据获取失败, code={}'.format(self.coll, self.code))
+            return
+
+        ordinals = trade_cal.to_ordinals(data['trade_date']) if not data.empty else np.array([], dtype=np.int64)
+        mask, empty = np.zeros(len(ordinals), dtype=bool), []
+        for range_start, range_end in self.ranges:
+            hit = (ordinals >= range_start.toordinal()) & (ordinals <= range_end.toordinal())
+            mask = mask | hit
+            # 区间内数据源也没有的交易日
+            empty.extend(trade_cal.missing_ranges([trade_cal.to_datetime(o) for o in ordinals[hit]],
+                                                  range_start, range_end))
+        if mask.any():
+            data = data[mask].reset_index(drop=True)
+            fut = await self.data_sync.submit_db(partial(self.save_func, data=data), task=self)
+            fut.add_done_callback(self.invalidate_cache)
+        self.scanner.backfilled(self.coll, self.code, empty)
+        self.log.info('回补{}缺失数据完成, code={}, 回补={}, 没有数据的区间={}'.format(
+            self.coll, self.code, int(mask.sum()), len(empty)))
+
+    def invalidate_cache(self, fut: asyncio.Future):
+        """
+        回补保存成功后删除该代码的k线缓存, 同update_stock_daily_hfq_factor
+        """
+        if self.db.cache is not None and not fut.cancelled() and fut.exception() is None and fut.result():
+            self.db.cache.invalidate(self.db._db, self.coll, self.code)
@@ -0,0 +1,110 @@
+import os
+import time
+from datetime import datetime
+from typing import Optional, Dict
+
+import pandas as pd
+
+from bbq import log
+
+
+class KDataCache:
+    """
+    日线类数据本地列式缓存(parquet), 按 库/集合/代码 分区存储:
+        {path}/{db}/{coll}/{code}.parquet
+    缓存以trade_date最大值为水位，增量从mongodb补齐。
+    """
+    _date_ops = {'$gt': 'gt', '$gte': 'ge', '$lt': 'lt', '$lte': 'le', '$eq': 'eq'}
+
+    def __init__(self, path: str, refresh_interval: int = 3600):
+        """
+        :param path: 缓存根目录
+        :param refresh_interval: 同一代码两次增量刷新最小间隔(秒), 进程内有效
+        """
+        self.log = log.get_logger(self.__class__.__name__)
+        if len(path) > 0 and path[0] == '~':
+            path = os.path.expanduser('~') + path[1:]
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.refresh_time: Dict[str, float] = {}
+
+    def _file(self, db: str, coll: str, code: str) -> str:
+        return os.sep.join([self.path, db, coll, '{}.parquet'.format(code)])
+
+    def load(self, db: str, coll: str, code: str) -> Optional[pd.DataFrame]:
+        file = self._file(db, coll, code)
+        if not os.path.exists(file):
+            return None
+        try:
+            return pd.read_parquet(file, memory_map=True)
+        except Exception as e:
+            self.log.error('读取缓存失败, 删除缓存: file={}, ex={}'.format(file, e))
+            os.remove(file)
+        return None
+
+    def save(self, db: str, coll: str, code: str, data: pd.DataFrame):
+        file = self._file(db, coll, code)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        tmp_file = '{}.{}.tmp'.format(file, os.getpid())
+        data.reset_index(drop=True).to_parquet(tmp_file, index=False)
+        os.replace(tmp_file, file)
+
+    def need_refresh(self, db: str, coll: str, code: str) -> bool:
+        key = '{}.{}.{}'.format(db, coll, code)
+        last = self.refresh_time.get(key)
+        return last is None or time.time() - last >= self.refresh_interval
+
+    def mark_refresh(self, db: str, coll: str, code: str):
+        self.refresh_time['{}.{}.{}'.format(db, coll, code)] = time.time()
+
+    def invalidate(self, db: str, coll: str, code: str):
+        file = self._file(db, coll, code)
+        if os.path.exists(file):
+            os.remove(file)
+        self.refresh_time.pop('{}.{}.{}'.format(db, coll, code), None)
+
+    @staticmethod
+    def cacheable(filter, to_frame=True, **_) -> bool:
+        """
+        仅缓存 {'code': str, 'trade_date': datetime/{'$gte': .., '$lte': ..}} 形式的查询
+        """
+        if not to_frame or not isinstance(filter, dict) or not isinstance(filter.get('code'), str):
+            return False
+        for key, val in filter.items():
+            if key == 'code':
+                continue
+            if key != 'trade_date':
+                return False
+            if isinstance(val, dict):
+                if len(val) == 0 or not set(val.keys()).issubset(KDataCache._date_ops.keys()):
+                    return False
+            elif not isinstance(val, datetime):
+                return False
+        return True
+
+    @staticmethod
+    def query(data: pd.DataFrame, filter=None, projection=None, skip=0, limit=0, sort=None) -> Optional[pd.DataFrame]:
+        """
+        在缓存数据上执行与mongodb find等价的过滤/排序/分页
+        """
+        if data is None or data.empty:
+            return None
+        cond = filter.get('trade_date') if filter is not None else None
+        if cond is not None:
+            if not isinstance(cond, dict):
+                cond = {'$eq': cond}
+            mask = pd.Series(True, index=data.index)
+            for op, val in cond.items():
+                mask &= getattr(data['trade_date'], KDataCache._date_ops[op])(val)
+            data = data[mask]
+        if sort is not None and len(sort) > 0:
+            data = data.sort_values(by=[k for k, _ in sort], ascending=[v > 0 for _, v in sort])
+        if skip > 0:
+            data = data.iloc[skip:]
+        if limit > 0:
+            data = data.iloc[:limit]
+        if projection is not None:
+            data = data[[col for col in projection if col in data.columns]]
+        if data.empty:
+            return None
+        return data.reset_index(drop=True)
@@ -1,53 +1,145 @@
-from functools import wraps
-from collections import namedtuple
 import motor.motor_asyncio
-from pymongo.errors import ServerSelectionTimeoutError, AutoReconnect
+from pymongo import monitoring, UpdateOne
+from pymongo.errors import ServerSelectionTimeoutError, AutoReconnect, OperationFailure, BulkWriteError
+import threading
 import time
 import traceback
+import weakref
 import pandas as pd
 from bbq import log
+from bbq.data.kdata_cache import KDataCache
 from abc import ABC
 import asyncio
+from datetime import datetime
+from typing import Dict, List, Optional, Union
+from bbq.fetch.my_trade_date import trade_cal
 
 import nest_asyncio
 
 nest_asyncio.apply()
 
 
+class _PoolStat(monitoring.ConnectionPoolListener):
+    """
+    连接池统计, 事件来自驱动线程, 需加锁
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.created = 0
+        self.closed = 0
+        self.checked_out = 0
+        self.check_out_count = 0
+        self.check_out_failed = 0
+        self.wait_time = 0.0
+        self.wait_time_max = 0.0
+        self.wait_start = {}
+
+    def stat(self) -> Dict:
+        with self.lock:
+            return dict(created=self.created, closed=self.closed,
+                        checked_out=self.checked_out, check_out_count=self.check_out_count,
+                        check_out_failed=self.check_out_failed,
+                        wait_time=round(self.wait_time, 4), wait_time_max=round(self.wait_time_max, 4),
+                        wait_time_avg=round(self.wait_time / self.check_out_count, 6)
+                        if self.check_out_count > 0 else 0.0)
+
+    def _wait_end(self, address):
+        starts = self.wait_start.get(address)
+        if starts is not None and len(starts) > 0:
+            wait = time.time() - starts.pop(0)
+            self.wait_time = self.wait_time + wait
+            self.wait_time_max = max(self.wait_time_max, wait)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self.lock:
+            self.created = self.created + 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self.lock:
+            self.closed = self.closed + 1
+
+    def connection_check_out_started(self, event):
+        with self.lock:
+            self.wait_start.setdefault(event.address, []).append(time.time())
+
+    def connection_check_out_failed(self, event):
+        with self.lock:
+            self.check_out_failed = self.check_out_failed + 1
+            self._wait_end(event.address)
+
+    def connection_checked_out(self, event):
+        with self.lock:
+            self.checked_out = self.checked_out + 1
+            self.check_out_count = self.check_out_count + 1
+            self._wait_end(event.address)
+
+    def connection_checked_in(self, event):
+        with self.lock:
+            self.checked_out = self.checked_out - 1
+
+
 class MongoDB(ABC):
-    _MongoStat = namedtuple('_MongoStat', ['client', 'count', 'last'])
+    _db = None  # 数据库名称, 子类定义
+    # 索引定义, 子类定义: {集合: [dict(keys=[(字段, 1/-1), ...], unique=False), ...]}
+    _indexes = {}
+    # compact_frame转float32的价格/成交量列
+    _compact_float_cols = ('open', 'high', 'low', 'close', 'pre_close', 'volume')
 
-    def __init__(self, uri='mongodb://localhost:27017/', pool=5):
+    def __init__(self, uri='mongodb://localhost:27017/', pool=5, max_pool=100,
+                 connect_timeout=10000, server_timeout=30000, socket_timeout=None, wait_queue_timeout=None):
+        """
+        每个事件循环一个AsyncIOMotorClient, 连接池由驱动管理
+        :param uri: mongodb uri
+        :param pool: 连接池保持的最小连接数(minPoolSize)
+        :param max_pool: 连接池最大连接数(maxPoolSize), 需不小于并发保存数
+        :param connect_timeout: 连接超时(ms)
+        :param server_timeout: 选择服务器超时(ms)
+        :param socket_timeout: socket读写超时(ms), None不超时
+        :param wait_queue_timeout: 等待连接池空闲连接超时(ms), None不超时
+        """
         self.log = log.get_logger(self.__class__.__name__)
-        self.clients = []
 
         self.uri = uri
         self.pool = pool
+        self.max_pool = max(max_pool, pool)
+        self.client_opts = dict(maxPoolSize=self.max_pool, minPoolSize=pool,
+                                connectTimeoutMS=connect_timeout, serverSelectionTimeoutMS=server_timeout,
+                                socketTimeoutMS=socket_timeout, waitQueueTimeoutMS=wait_queue_timeout)
+        # motor client和事件循环绑定, loop -> (client, {(db, col): coll})
+        self.clients = weakref.WeakKeyDictionary()
+        self.pool_stat = _PoolStat()
 
-    def _best_client(func):
-        @wraps(func)
-        def wrapper(self, *args, **kwargs):
-            self.clients = sorted(self.clients, key=lambda stat: (stat.count, -stat.last))
-            stat_client = self.clients[0]
-            self.clients[0] = stat_client._replace(count=stat_client.count + 1, last=time.time())
-
-            kwargs['__client'] = stat_client.client
-            return func(self, *args, **kwargs)
-
-        return wrapper
+        self.cache = None
 
     def test_coll(self):
         return None
 
-    def init(self) -> bool:
+    def init(self, ensure_index=True) -> bool:
+        """
+        :param ensure_index: True创建缺失的索引, False仅打印缺失的索引
+        """
         try:
-            for _ in range(self.pool):
-                client = motor.motor_asyncio.AsyncIOMotorClient(self.uri)
-                self.clients.append(self._MongoStat(client=client, count=0, last=time.time()))
+            self.get_client()
             test_coll = self.test_coll()
             if test_coll is not None:
                 loop = asyncio.get_event_loop()
                 loop.run_until_complete(test_coll.count_documents({}))
+            if self._db is not None and len(self._indexes) > 0:
+                loop = asyncio.get_event_loop()
+                loop.run_until_complete(self.ensure_indexes(create=ensure_index))
         except Exception as e:
             self.log.error(type(e))
             raise e
@@ -56,17 +148,96 @@ class MongoDB(ABC):
 
         return True
 
-    @_best_client
-    def get_client(self, **kwargs):
-        return kwargs['__client'] if '__client' in kwargs else None
+    @staticmethod
+    def norm_index_keys(keys) -> list:
+        """
+        索引方向统一: mongodb返回的1.0/-1.0转为int, text/hashed/2dsphere等原样比较
+        """
+        return [(key, int(direction) if isinstance(direction, (int, float)) else direction)
+                for key, direction in keys]
+
+    async def ensure_indexes(self, create=True) -> Dict[str, list]:
+        """
+        根据_indexes检查/创建索引, 已存在的索引不重复创建
+        :param create: 是否创建缺失的索引
+        :return: 缺失的索引 {集合: [keys, ...]}
+        """
+        missing = {}
+        for name, indexes in self._indexes.items():
+            coll = self.get_coll(self._db, name)
+            info = await coll.index_information()
+            exists = [self.norm_index_keys(index['key']) for index in info.values()]
+            for index in indexes:
+                keys = self.norm_index_keys(index['keys'])
+                if keys in exists:
+                    continue
+                missing.setdefault(name, []).append(keys)
+                if not create:
+                    self.log.warning('缺失索引: {}.{} {}'.format(self._db, name, keys))
+                    continue
+                try:
+                    self.log.info('创建索引: {}.{} {}'.format(self._db, name, keys))
+                    await coll.create_index(keys, background=True, unique=index.get('unique', False))
+                except OperationFailure as e:
+                    self.log.error('创建索引失败: {}.{} {}, ex={}'.format(self._db, name, keys, e))
+        return missing
+
+    def get_client(self):
+        loop = asyncio.get_event_loop()
+        client = self.clients.get(loop)
+        if client is None:
+            client = (motor.motor_asyncio.AsyncIOMotorClient(self.uri, io_loop=loop,
+                                                             event_listeners=[self.pool_stat],
+                                                             **self.client_opts), {})
+            self.clients[loop] = client
+        return client[0]
 
     def get_coll(self, db: str, col: str):
-        client = self.get_client()
+        client = self.clients.get(asyncio.get_event_loop())
         if client is None:
-            return None
-        return client[db][col]
+            self.get_client()
+            client = self.clients[asyncio.get_event_loop()]
+        colls = client[1]
+        coll = colls.get((db, col))
+        if coll is None:
+            coll = client[0][db][col]
+            colls[(db, col)] = coll
+        return coll
+
+    def pool_stats(self) -> Dict:
+        """
+        连接池统计
+        :return: dict(created, closed, checked_out(当前借出连接数), check_out_count, check_out_failed,
+                      wait_time(累计等待秒), wait_time_max, wait_time_avg)
+        """
+        return self.pool_stat.stat()
+
+    @staticmethod
+    def compact_frame(df: Optional[pd.DataFrame], compact: Union[bool, str] = True) -> Optional[pd.DataFrame]:
+        """
+        按列转换为紧凑类型: code转category, 价格/成交量转float32(整数成交量转能容纳的最小整数类型),
+        日期转datetime64或int32(yyyymmdd), 其它列(市值/余额/复权因子/净值等)保持精度不转换
+        :param df: DataFrame
+        :param compact: False不转换, True日期为datetime64, 'int'日期为int32(yyyymmdd)
+        :return: DataFrame
+        """
+        if df is None or df.empty or not compact:
+            return df
+        for col in df.columns:
+            dtype = df[col].dtype
+            if col == 'code' and dtype == object:
+                df[col] = df[col].astype('category')
+            elif col in MongoDB._compact_float_cols and pd.api.types.is_float_dtype(dtype) and dtype != 'float32':
+                df[col] = df[col].astype('float32')
+            elif col == 'volume' and pd.api.types.is_integer_dtype(dtype):
+                df[col] = pd.to_numeric(df[col], downcast='integer')
+            elif pd.api.types.is_datetime64_any_dtype(dtype) and compact == 'int':
+                dt = df[col].dt
+                df[col] = (dt.year * 10000 + dt.month * 100 + dt.day).astype('int32')
+        return df
 
-    async def do_load(self, coll, filter=None, projection=None, skip=0, limit=0, sort=None, to_frame=True):
+    async def do_load(self, coll, filter=None, projection=None, skip=0, limit=0, sort=None, to_frame=True,
+                      compact: Union[bool, str] = False):
         for i in range(5):
             try:
                 cursor = coll.find(filter=filter, projection=projection, skip=skip, limit=limit, sort=sort)
@@ -79,7 +250,7 @@ class MongoDB(ABC):
                         if not df.empty:
                             if '_id' in df.columns:
                                 df.drop(columns=['_id'], inplace=True)
-                            return df
+                            return self.compact_frame(df, compact)
                     else:
                         if len(data) > 0:
                             for item in data:
@@ -93,9 +264,171 @@ class MongoDB(ABC):
                                                                                     e, traceback.format_exc(),
                                                                                     (i + 1) * 5))
                 await asyncio.sleep((i + 1) * 5)
-                self.init()
         return None
 
+    async def do_aggregate(self, coll, pipeline, to_frame=True):
+        for i in range(5):
+            try:
+                cursor = coll.aggregate(pipeline, allowDiskUse=True)
+                data = await cursor.to_list(None)
+                if to_frame:
+                    df = pd.DataFrame(data=data)
+                    return df if not df.empty else None
+                return data
+            except (ServerSelectionTimeoutError, AutoReconnect) as e:
+                self.log.error('mongodb 调用 {}, 连接异常: ex={}, call {}, {}s后重试'.format(self.do_aggregate.__name__,
+                                                                                    e, traceback.format_exc(),
+                                                                                    (i + 1) * 5))
+                await asyncio.sleep((i + 1) * 5)
+        return None
+
+    async def do_load_watermarks(self, coll, key='code', field='trade_date', filter=None) -> Optional[Dict]:
+        """
+        一次聚合计算每个key的最大field(同步水位), 代替逐个代码查询
+        :return: dict(key -> 最大field), 失败返回None
+        """
+        pipeline = [{'$group': {'_id': '$' + key, 'last': {'$max': '$' + field}}}]
+        if filter is not None:
+            pipeline.insert(0, {'$match': filter})
+        data = await self.do_aggregate(coll, pipeline, to_frame=False)
+        if data is None:
+            return None
+        return {item['_id']: item['last'] for item in data}
+
+    async def iter_load(self, coll, filter=None, projection=None, skip=0, limit=0, sort=None,
+                        chunk_size=5000, to_frame=True, compact: Union[bool, str] = False):
+        """
+        do_load的流式版本, 按chunk_size分批从游标读取, 内存占用只和chunk_size相关
+        用法: async for df in db.iter_load(coll, filter=...): ...
+        :param chunk_size: 每批条数, 同时作为游标batch_size
+        :param compact: 同compact_frame, 每批单独转换, category的类别各批不同
+        :return: 异步生成器, 每次返回DataFrame(to_frame=True)或list
+        """
+        yielded = False
+        for i in range(5):
+            cursor = None
+            try:
+                cursor = coll.find(filter=filter, projection=projection, skip=skip, limit=limit, sort=sort,
+                                   batch_size=chunk_size)
+                while True:
+                    data = await cursor.to_list(chunk_size)
+                    if len(data) == 0:
+                        break
+                    for item in data:
+                        item.pop('_id', None)
+                    yielded = True
+                    yield self.compact_frame(pd.DataFrame(data=data, columns=projection), compact) \
+                        if to_frame else data
+                break
+            except (ServerSelectionTimeoutError, AutoReconnect) as e:
+                # 已经返回过数据的不能重试, 否则数据重复
+                if yielded:
+                    raise e
+                self.log.error('mongodb 调用 {}, 连接异常: ex={}, call {}, {}s后重试'.format(self.iter_load.__name__,
+                                                                                    e, traceback.format_exc(),
+                                                                                    (i + 1) * 5))
+                await asyncio.sleep((i + 1) * 5)
+            finally:
+                if cursor is not None:
+                    await cursor.close()
+
+    def enable_cache(self, path: str, refresh_interval: int = 3600):
+        """
+        开启日线类数据本地缓存(parquet)
+        :param path: 缓存目录
+        :param refresh_interval: 增量刷新间隔(秒)
+        """
+        self.cache = KDataCache(path=path, refresh_interval=refresh_interval)
+
+    async def do_cached_load(self, coll, filter=None, projection=None, skip=0, limit=0, sort=None, to_frame=True,
+                             compact: Union[bool, str] = False):
+        """
+        带本地缓存的do_load, 单代码按trade_date查询时读缓存, 并以缓存最大trade_date增量刷新, 其他查询直接走do_load
+        """
+        if self.cache is None or not KDataCache.cacheable(filter=filter, to_frame=to_frame):
+            return await self.do_load(coll, filter=filter, projection=projection, skip=skip, limit=limit,
+                                      sort=sort, to_frame=to_frame, compact=compact)
+
+        db, name, code = coll.database.name, coll.name, filter['code']
+        data = self.cache.load(db, name, code)
+        if data is None or self.cache.need_refresh(db, name, code):
+            incr_filter = {'code': code}
+            if data is not None and not data.empty:
+                incr_filter['trade_date'] = {'$gt': data['trade_date'].max().to_pydatetime()}
+            incr = await self.do_load(coll, filter=incr_filter, sort=[('trade_date', 1)])
+            if incr is not None:
+                data = incr if data is None else pd.concat([data, incr], ignore_index=True)
+                self.cache.save(db, name, code, data)
+            self.cache.mark_refresh(db, name, code)
+
+        data = KDataCache.query(data, filter=filter, projection=projection, skip=skip, limit=limit, sort=sort)
+        return self.compact_frame(data, compact)
+
+    async def do_load_daily_many(self, coll, codes, start: datetime = None, end: datetime = None, limit: int = 0,
+                                 projection=None, chunk_size: int = 500, panel: bool = False,
+                                 compact: Union[bool, str] = False) -> Optional[Union[Dict[str, pd.DataFrame],
+                                                                                      pd.DataFrame]]:
+        """
+        多代码日线批量加载, 按chunk_size分批$in查询, 代替逐个代码查询
+        :param coll: 日线集合
+        :param codes: 代码列表
+        :param start: 开始交易日(含)
+        :param end: 结束交易日(含)
+        :param limit: 每个代码截止end最近limit条, 0为不限制
+        :param projection: 返回字段, code/trade_date总会返回
+        :param chunk_size: 每次$in查询代码个数
+        :param panel: True返回MultiIndex(code, trade_date)的DataFrame, False返回dict(code -> DataFrame)
+        :param compact: 同compact_frame, panel整体转换
+        :return: 按trade_date升序的数据
+        """
+        codes = list(codes)
+        if projection is not None:
+            projection = list(projection)
+            projection = projection + [col for col in ['code', 'trade_date'] if col not in projection]
+
+        # 有limit没有start时, 用交易日历推算下界, 停牌等不足limit条的再单独补查
+        start_hint = start
+        if limit > 0 and start is None:
+            start_hint = trade_cal.prev_trade_date(end if end is not None else datetime.now(), include=True)
+            if start_hint is not None:
+                start_hint = trade_cal.offset(start_hint, -(limit - 1))
+
+        trade_date = {}
+        if start_hint is not None:
+            trade_date['$gte'] = start_hint
+        if end is not None:
+            trade_date['$lte'] = end
+
+        data = {}
+        for i in range(0, len(codes), chunk_size):
+            flter = {'code': {'$in': codes[i:i + chunk_size]}}
+            if len(trade_date) > 0:
+                flter['trade_date'] = trade_date
+            df = await self.do_load(coll, filter=flter, projection=projection, sort=[('code', 1), ('trade_date', 1)])
+            if df is None:
+                continue
+            for code, group in df.groupby('code', sort=False):
+                data[code] = group.iloc[-limit:] if limit > 0 else group
+
+        if limit > 0 and start is None:
+            for code in codes:
+                if code in data and len(data[code]) >= limit:
+                    continue
+                flter = {'code': code}
+                if end is not None:
+                    flter['trade_date'] = {'$lte': end}
+                df = await self.do_load(coll, filter=flter, projection=projection,
+                                        sort=[('trade_date', -1)], limit=limit)
+                if df is not None:
+                    data[code] = df[::-1]
+
+        if panel:
+            if len(data) == 0:
+                return None
+            df = self.compact_frame(pd.concat(data.values(), ignore_index=True), compact)
+            return df.set_index(['code', 'trade_date'])
+        return {code: self.compact_frame(df.reset_index(drop=True), compact) for code, df in data.items()}
+
     async def do_update(self, coll, filter=None, update=None, upsert=True):
         for i in range(5):
             try:
@@ -110,7 +443,6 @@ class MongoDB(ABC):
                                                                                     e, traceback.format_exc(),
                                                                                     (i + 1) * 5))
                 await asyncio.sleep((i + 1) * 5)
-                self.init()
         return 0
 
     async def do_update_many(self, coll, filter=None, update=None, upsert=True):
@@ -127,20 +459,61 @@ class MongoDB(ABC):
                                                                                     e, traceback.format_exc(),
                                                                                     (i + 1) * 5))
                 await asyncio.sleep((i + 1) * 5)
-                self.init()
         return 0
 
-    async def do_batch_update(self, data, func):
+    async def do_bulk_upsert(self, coll, items, batch_size=1000) -> List:
+        """
+        批量upsert, 按batch_size分批bulk_write(ordered=False), 代替逐条update_one
+        :param coll: 集合
+        :param items: [(filter, update), ...], update为$set内容
+        :param batch_size: 每批条数
+        :return: 同do_update, 每条对应 matched_count(1) 或 upserted_id
+        """
         upsert_list = []
+        for start in range(0, len(items), batch_size):
+            batch = items[start:start + batch_size]
+            requests = [UpdateOne(filter, {'$set': update}, upsert=True) for filter, update in batch]
+            for i in range(5):
+                try:
+                    res = await coll.bulk_write(requests, ordered=False)
+                    upserted_ids = res.upserted_ids
+                    upsert_list = upsert_list + [upserted_ids[idx] if idx in upserted_ids else 1
+                                                 for idx in range(len(batch))]
+                    break
+                except BulkWriteError as e:
+                    self.log.error('mongodb 调用 {}, 部分写入失败: ex={}'.format(self.do_bulk_upsert.__name__,
+                                                                         e.details['writeErrors'][:5]))
+                    upserted_ids = {item['index']: item['_id'] for item in e.details['upserted']}
+                    error_idx = set(item['index'] for item in e.details['writeErrors'])
+                    upsert_list = upsert_list + [upserted_ids[idx] if idx in upserted_ids else 1
+                                                 for idx in range(len(batch)) if idx not in error_idx]
+                    break
+                except (ServerSelectionTimeoutError, AutoReconnect) as e:
+                    self.log.error('mongodb 调用 {}, 连接异常: ex={}, call {}, {}s后重试'.format(
+                        self.do_bulk_upsert.__name__, e, traceback.format_exc(), (i + 1) * 5))
+                    await asyncio.sleep((i + 1) * 5)
+        return upsert_list
+
+    async def do_batch_update(self, data, func, batch_size=1000):
+        """
+        批量upsert
+        :param data: DataFrame
+        :param func: func(item) -> (coll, filter, update)
+        :param batch_size: 每批条数
+        :return: list(matched_count/upserted_id) / None
+        """
+        colls, items = {}, {}
         for item in data.to_dict('records'):
             coll, filter, update = func(item)
-            upsert = await self.do_update(coll, filter=filter, update=update)
-            if upsert is None:
+            if update is None:
                 continue
-            if isinstance(upsert, list):
-                upsert_list = upsert_list + upsert
-            else:
-                upsert_list.append(upsert)
+            key = (coll.database.name, coll.name)
+            colls[key] = coll
+            items.setdefault(key, []).append((filter, update))
+
+        upsert_list = []
+        for key, coll_items in items.items():
+            upsert_list = upsert_list + await self.do_bulk_upsert(colls[key], coll_items, batch_size=batch_size)
         return upsert_list if len(upsert_list) > 0 else None
 
     async def do_delete(self, coll, filter=None, just_one=True):
@@ -156,11 +529,10 @@ class MongoDB(ABC):
                         res = await coll.drop()
                 return 0 if res is None else res.deleted_count
             except (ServerSelectionTimeoutError, AutoReconnect) as e:
-                self.log.error('mongodb 调用 {}, 连接异常: ex={}, call {}, {}s后重试').format(self.do_delete.__name__,
-                                                                                     e, traceback.format_exc(),
-                                                                                     (i + 1) * 5)
+                self.log.error('mongodb 调用 {}, 连接异常: ex={}, call {}, {}s后重试'.format(self.do_delete.__name__,
+                                                                                    e, traceback.format_exc(),
+                                                                                    (i + 1) * 5))
                 await asyncio.sleep((i + 1) * 5)
-                self.init()
         return 0
 
     async def do_insert(self, coll, data):
@@ -169,13 +541,12 @@ class MongoDB(ABC):
                 inserted_ids = []
                 if data is not None and not data.empty:
                     docs = data.to_dict('records')
-                    result = await coll.insert_many(docs)
+                    result = await coll.insert_many(docs, ordered=False)
                     inserted_ids = result.inserted_ids
                 return inserted_ids
             except (ServerSelectionTimeoutError, AutoReconnect) as e:
-                self.log.error('mongodb 调用 {}, 连接异常: ex={}, call {}, {}s后重试').format(self.do_insert.__name__,
-                                                                                     e, traceback.format_exc(),
-                                                                                     (i + 1) * 5)
+                self.log.error('mongodb 调用 {}, 连接异常: ex={}, call {}, {}s后重试'.format(self.do_insert.__name__,
+                                                                                    e, traceback.format_exc(),
+                                                                                    (i + 1) * 5))
                 await asyncio.sleep((i + 1) * 5)
-                self.init()
         return 0
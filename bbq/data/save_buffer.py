@@ -0,0 +1,126 @@
+import asyncio
+import time
+from functools import partial
+from typing import Dict, Optional
+
+import pandas as pd
+
+from bbq import log
+
+
+class SaveBuffer:
+    """
+    跨task合并保存: 同一保存函数(如db.save_stock_daily)提交的DataFrame先缓存,
+    行数达到batch_rows或最早一条等待超过max_delay秒时合并为一次保存(一次insert_many/批量upsert)
+    缓存及保存中的行数超过max_rows时, 提交方等待(fetch侧背压)
+    只合并 partial(save_func, data=DataFrame) 形式的保存, 其它保存函数不合并
+    """
+
+    def __init__(self, data_sync, batch_rows: int = 5000, max_delay: float = 2.0, max_rows: int = 100000):
+        """
+        :param data_sync: DataSync
+        :param batch_rows: 合并保存行数阈值
+        :param max_delay: 最长缓存时间(秒)
+        :param max_rows: 缓存及保存中的最大行数, 超过时提交方等待
+        """
+        self.log = log.get_logger(self.__class__.__name__)
+        self.data_sync = data_sync
+        self.batch_rows = batch_rows
+        self.max_delay = max_delay
+        self.max_rows = max(max_rows, batch_rows)
+
+        self.buffers: Dict[tuple, list] = {}
+        self.buffer_rows: Dict[tuple, int] = {}
+        self.timers: Dict[tuple, asyncio.Task] = {}
+        self.flushing = set()
+        self.pending_rows = 0
+        self.not_full = asyncio.Condition()
+
+        self.stats: Dict[str, Dict] = {}
+
+    @staticmethod
+    def key(save_func) -> Optional[tuple]:
+        """
+        可合并的保存函数返回 (保存函数, 列), 否则None
+        """
+        if not isinstance(save_func, partial) or len(save_func.args) > 0 or \
+                list(save_func.keywords.keys()) != ['data']:
+            return None
+        data = save_func.keywords['data']
+        if not isinstance(data, pd.DataFrame):
+            return None
+        return save_func.func, tuple(data.columns)
+
+    @staticmethod
+    def name(key: tuple) -> str:
+        name = getattr(key[0], '__name__', str(key[0]))
+        return name[len('save_'):] if name.startswith('save_') else name
+
+    async def put(self, key: tuple, data: pd.DataFrame) -> asyncio.Future:
+        """
+        :return: 合并保存完成后的结果(bool)
+        """
+        rows = data.shape[0]
+        async with self.not_full:
+            await self.not_full.wait_for(lambda: self.pending_rows < self.max_rows)
+            self.pending_rows = self.pending_rows + rows
+
+        fut = self.data_sync.loop.create_future()
+        self.buffers.setdefault(key, []).append((data, fut))
+        self.buffer_rows[key] = self.buffer_rows.get(key, 0) + rows
+        if self.buffer_rows[key] >= self.batch_rows:
+            self.flush(key)
+        elif key not in self.timers:
+            self.timers[key] = self.data_sync.loop.create_task(self._flush_later(key))
+        return fut
+
+    async def _flush_later(self, key: tuple):
+        await asyncio.sleep(self.max_delay)
+        self.timers.pop(key, None)
+        self.flush(key)
+
+    def flush(self, key: tuple):
+        items = self.buffers.pop(key, None)
+        rows = self.buffer_rows.pop(key, 0)
+        timer = self.timers.pop(key, None)
+        if timer is not None and timer is not asyncio.current_task():
+            timer.cancel()
+        if not items:
+            return
+        flush_task = self.data_sync.loop.create_task(self._save(key, items, rows))
+        self.flushing.add(flush_task)
+        flush_task.add_done_callback(self.flushing.discard)
+
+    async def _save(self, key: tuple, items: list, rows: int):
+        start, ok = time.time(), False
+        try:
+            data = pd.concat([item[0] for item in items], ignore_index=True) if len(items) > 1 else items[0][0]
+            fut = await self.data_sync.submit_db(partial(key[0], data=data), coalesce=False)
+            ok = await fut
+        finally:
+            stat = self.stats.setdefault(self.name(key), dict(rows=0, batches=0, submits=0, cost=0.0, failed=0))
+            stat['rows'] = stat['rows'] + rows
+            stat['batches'] = stat['batches'] + 1
+            stat['submits'] = stat['submits'] + len(items)
+            stat['cost'] = stat['cost'] + time.time() - start
+            stat['failed'] = stat['failed'] + (0 if ok else 1)
+            for _, item_fut in items:
+                if not item_fut.done():
+                    item_fut.set_result(ok)
+            async with self.not_full:
+                self.pending_rows = self.pending_rows - rows
+                self.not_full.notify_all()
+
+    async def flush_all(self):
+        for key in list(self.buffers.keys()):
+            self.flush(key)
+        while len(self.flushing) > 0:
+            await asyncio.gather(*list(self.flushing), return_exceptions=True)
+
+    def stat(self) -> Dict[str, Dict]:
+        """
+        :return: 集合 -> dict(rows, batches, submits, cost, failed, rows_per_sec)
+        """
+        return {name: dict(stat, cost=round(stat['cost'], 3),
+                           rows_per_sec=round(stat['rows'] / stat['cost'], 1) if stat['cost'] > 0 else 0.0)
+                for name, stat in self.stats.items()}
@@ -1,5 +1,6 @@
 from bbq.data.mongodb import MongoDB
-from typing import List, Optional
+from typing import List, Optional, Dict, Union
+from datetime import datetime
 import pandas as pd
 
 
@@ -49,13 +50,34 @@ class StockDB(MongoDB):
 
         # 申万行业数据
         'sw_index_info': {'index_code': '行业代码', 'index_name': '行业名称', 'stock_code': '股票代码', 'stock_name': '股票名称',
-                          'start_date': '开始日期', 'weight': '权重'}
+                          'start_date': '开始日期', 'weight': '权重'},
+
+        # 同步元数据(按代码的同步水位)
+        'sync_meta': {'name': '同步名称', 'code': '代码', 'sync_date': '最近同步时间', 'last_trade_date': '最新交易日',
+                      'ex_date': '最近除权除息日'}
     }
 
     _db = 'bbq_stock_db'  # 股票数据库
 
-    def __init__(self, uri='mongodb://localhost:27017/', pool=5):
-        super().__init__(uri, pool)
+    _indexes = {
+        'stock_info': [dict(keys=[('code', 1)])],
+        'stock_daily': [dict(keys=[('code', 1), ('trade_date', -1)]), dict(keys=[('trade_date', -1)])],
+        'stock_index': [dict(keys=[('code', 1), ('trade_date', -1)]), dict(keys=[('trade_date', -1)])],
+        'stock_fq_factor': [dict(keys=[('code', 1), ('trade_date', -1)]), dict(keys=[('trade_date', -1)])],
+        'index_info': [dict(keys=[('code', 1)])],
+        'index_daily': [dict(keys=[('code', 1), ('trade_date', -1)]), dict(keys=[('trade_date', -1)])],
+        'stock_ns_flow': [dict(keys=[('trade_date', -1)])],
+        'stock_his_divend': [dict(keys=[('code', 1)]), dict(keys=[('sync_date', -1)])],
+        'stock_margin': [dict(keys=[('code', 1), ('trade_date', -1)]), dict(keys=[('trade_date', -1)])],
+        'stock_concept': [dict(keys=[('concept_code', 1), ('stock_code', 1)]),
+                          dict(keys=[('stock_code', 1), ('concept_date', -1)]),
+                          dict(keys=[('concept_date', -1)])],
+        'sw_index_info': [dict(keys=[('index_code', 1)])],
+        'sync_meta': [dict(keys=[('name', 1), ('code', 1)], unique=True)]
+    }
+
+    def __init__(self, uri='mongodb://localhost:27017/', pool=5, **kwargs):
+        super().__init__(uri, pool, **kwargs)
 
     @property
     def stock_info(self):
@@ -101,13 +123,17 @@ class StockDB(MongoDB):
     def sw_index_info(self):
         return self.get_coll(self._db, 'sw_index_info')
 
+    @property
+    def sync_meta(self):
+        return self.get_coll(self._db, 'sync_meta')
+
     def test_coll(self):
         return self.stock_info
 
     async def load_stock_info(self, **kwargs) -> Optional[pd.DataFrame]:
         """
         kwargs参数同pymongo参数, 另外增加to_frame
-        :param kwargs:  filter=None, projection=None, skip=0, limit=0, sort=None, to_frame=True
+        :param kwargs:  filter=None, projection=None, skip=0, limit=0, sort=None, to_frame=True, compact=False
         :return: DataFrame
         """
         self.log.debug('加载股票信息, kwargs={} ...'.format(kwargs))
@@ -131,20 +157,39 @@ class StockDB(MongoDB):
     async def load_stock_daily(self, fq: str = None, **kwargs) -> Optional[pd.DataFrame]:
         """
         :param fq: qfq 前复权 hfq 后复权 None不复权
-        :param kwargs:  filter=None, projection=None, skip=0, limit=0, sort=None, to_frame=True
+        :param kwargs:  filter=None, projection=None, skip=0, limit=0, sort=None, to_frame=True, compact=False
         :return: DataFrame([code,trade_date,open,high,low,close,vol,amount])
         """
         self.log.debug('加载股票日线, kwargs={}'.format(kwargs))
 
+        # 复权计算后再转换, 避免float32再升回float64
+        compact = kwargs.pop('compact', False)
         proj_tmp = kwargs['projection'] if 'projection' in kwargs else None
         proj = self._meta['stock_daily'].keys()
         kwargs['projection'] = proj
 
-        df = await self.do_load(self.stock_daily, **kwargs)
+        df = await self.do_cached_load(self.stock_daily, **kwargs)
         if df is None or df.shape[0] == 0:
             self.log.debug('加载日线数据成功 size=0')
             return None
 
+        df = self.adjust_fq(df, fq)
+        if df is None:
+            return None
+
+        if proj_tmp is not None:
+            df = df[proj_tmp]
+        df = self.compact_frame(df, compact)
+        self.log.debug('加载日线数据成功 size={}'.format(df.shape[0]))
+        return df
+
+    def adjust_fq(self, df: pd.DataFrame, fq: str = None) -> Optional[pd.DataFrame]:
+        """
+        日线复权
+        :param df: 日线数据
+        :param fq: qfq 前复权 hfq 后复权 None不复权
+        :return: DataFrame
+        """
         # 需按trade_date升序
         if fq == 'qfq' or fq == 'hfq':
             if fq == 'qfq':
@@ -162,10 +207,58 @@ class StockDB(MongoDB):
                 df['low'] = df['low'] * df['hfq_factor']
                 df['close'] = df['close'] * df['hfq_factor']
                 df['volume'] = df['volume'] * df['hfq_factor']
+        return df
 
-        if proj_tmp is not None:
-            df = df[proj_tmp]
-        self.log.debug('加载日线数据成功 size={}'.format(df.shape[0]))
+    async def load_stock_daily_many(self, codes: List[str], start: datetime = None, end: datetime = None,
+                                    limit: int = 0, fq: str = None, panel: bool = False,
+                                    **kwargs) -> Optional[Union[Dict[str, pd.DataFrame], pd.DataFrame]]:
+        """
+        批量加载股票日线
+        :param codes: 股票代码列表
+        :param start: 开始交易日(含)
+        :param end: 结束交易日(含)
+        :param limit: 每个代码截止end最近limit条, 0为不限制
+        :param fq: qfq 前复权 hfq 后复权 None不复权
+        :param panel: True返回MultiIndex(code, trade_date)的DataFrame, False返回dict(code -> DataFrame)
+        :param kwargs: projection=None, chunk_size=500, compact=False
+        :return: 按trade_date升序的数据
+        """
+        self.log.debug('批量加载股票日线, count={}, start={}, end={}, limit={}'.format(len(codes), start, end, limit))
+        proj_tmp = kwargs.pop('projection', None)
+        compact = kwargs.pop('compact', False)
+        data = await self.do_load_daily_many(self.stock_daily, codes, start=start, end=end, limit=limit,
+                                             projection=self._meta['stock_daily'].keys(), **kwargs)
+        frames = {}
+        for code, df in data.items():
+            df = self.adjust_fq(df, fq)
+            if df is None:
+                return None
+            frames[code] = df[list(dict.fromkeys(list(proj_tmp) + ['code', 'trade_date']))] \
+                if proj_tmp is not None else df
+        self.log.debug('批量加载股票日线成功, size={}'.format(len(frames)))
+        if panel:
+            if len(frames) == 0:
+                return None
+            df = self.compact_frame(pd.concat(frames.values(), ignore_index=True), compact)
+            return df.set_index(['code', 'trade_date'])
+        return {code: self.compact_frame(df, compact) for code, df in frames.items()}
+
+    async def load_stock_daily_latest(self, start: datetime = None) -> Optional[pd.DataFrame]:
+        """
+        每个股票最新一条日线(未复权)
+        :param start: 只统计start之后的日线, 减少扫描量
+        :return: DataFrame([code,trade_date,close,hfq_factor])
+        """
+        self.log.debug('加载股票最新日线, start={}'.format(start))
+        pipeline = [{'$sort': {'trade_date': -1}},
+                    {'$group': {'_id': '$code', 'trade_date': {'$first': '$trade_date'},
+                                'close': {'$first': '$close'}, 'hfq_factor': {'$first': '$hfq_factor'}}}]
+        if start is not None:
+            pipeline.insert(0, {'$match': {'trade_date': {'$gte': start}}})
+        df = await self.do_aggregate(self.stock_daily, pipeline)
+        if df is not None:
+            df.rename(columns={'_id': 'code'}, inplace=True)
+        self.log.debug('加载股票最新日线成功 size={}'.format(df.shape[0] if df is not None else 0))
         return df
 
     async def save_stock_daily(self, data: pd.DataFrame) -> List[str]:
@@ -185,7 +278,7 @@ class StockDB(MongoDB):
     async def load_stock_index(self, **kwargs) -> Optional[pd.DataFrame]:
         """
         :param code:
-        :param kwargs:  filter=None, projection=None, skip=0, limit=0, sort=None, to_frame=True
+        :param kwargs:  filter=None, projection=None, skip=0, limit=0, sort=None, to_frame=True, compact=False
         :return: DataFrame([code,trade_date,open,high,low,close,vol,amount])
         """
         self.log.debug('加载股票指标, kwargs={}'.format(kwargs))
@@ -209,7 +302,7 @@ class StockDB(MongoDB):
 
     async def load_stock_fq_factor(self, **kwargs) -> Optional[pd.DataFrame]:
         """
-        :param kwargs:  filter=None, projection=None, skip=0, limit=0, sort=None, to_frame=True
+        :param kwargs:  filter=None, projection=None, skip=0, limit=0, sort=None, to_frame=True, compact=False
         :return: DataFrame([code,trade_date,open,high,low,close,vol,amount])
         """
         self.log.debug('加载股票复权因子, kwargs={}'.format(kwargs))
@@ -231,6 +324,63 @@ class StockDB(MongoDB):
         self.log.debug('保存复权因子数据成功, size = {}'.format(len(inserted_ids) if inserted_ids is not None else 0))
         return inserted_ids
 
+    async def upsert_stock_fq_factor(self, data: pd.DataFrame) -> List:
+        """
+        按(code, trade_date)upsert复权因子, 只保存有变化的数据
+        :param data: DataFrame([code,trade_date,hfq_factor,qfq_factor])
+        :return: None/list
+        """
+        count = data.shape[0] if data is not None else 0
+        self.log.debug('更新复权因子数据, count = {} ...'.format(count))
+        upsert_list = None
+        if count > 0:
+            upsert_list = await self.do_batch_update(
+                data=data, func=lambda x: (self.stock_fq_factor, {'code': x['code'], 'trade_date': x['trade_date']}, x))
+        self.log.debug('更新复权因子数据成功, size = {}'.format(len(upsert_list) if upsert_list is not None else 0))
+        return upsert_list
+
+    async def update_stock_daily_hfq_factor(self, code: str, factors: pd.DataFrame) -> int:
+        """
+        除权除息后更新日线的后复权因子, 每个因子作用于其trade_date到下一个因子trade_date之间的日线
+        :param code: 股票代码
+        :param factors: 有变化的复权因子DataFrame([trade_date,hfq_factor,next_trade_date])
+        :return: 更新条数
+        """
+        count = 0
+        for item in factors.to_dict('records'):
+            trade_date = {'$gte': item['trade_date']}
+            if item['next_trade_date'] is not None and not pd.isna(item['next_trade_date']):
+                trade_date['$lt'] = item['next_trade_date']
+            res = await self.do_update_many(self.stock_daily, filter={'code': code, 'trade_date': trade_date},
+                                            update={'hfq_factor': item['hfq_factor']}, upsert=False)
+            count = count + (res if res is not None else 0)
+        if self.cache is not None:
+            self.cache.invalidate(self._db, 'stock_daily', code)
+        self.log.debug('更新股票{}日线后复权因子, size = {}'.format(code, count))
+        return count
+
+    async def load_sync_meta(self, name: str, **kwargs) -> Optional[pd.DataFrame]:
+        """
+        :param name: 同步名称, 如stock_fq_factor
+        :param kwargs:  filter=None, projection=None, skip=0, limit=0, sort=None, to_frame=True
+        :return: DataFrame([name,code,sync_date,last_trade_date,ex_date])
+        """
+        filter = kwargs.pop('filter', None) or {}
+        filter['name'] = name
+        df = await self.do_load(self.sync_meta, filter=filter, **kwargs)
+        self.log.debug('加载同步元数据成功 name={}, size={}'.format(name, df.shape[0] if df is not None else 0))
+        return df
+
+    async def save_sync_meta(self, name: str, data: Union[Dict, List[Dict]]) -> List:
+        """
+        :param name: 同步名称
+        :param data: {code, sync_date, last_trade_date, ex_date} 或其列表
+        :return: None/list
+        """
+        data = data if isinstance(data, list) else [data]
+        items = [({'name': name, 'code': item['code']}, dict(item, name=name)) for item in data]
+        return await self.do_bulk_upsert(self.sync_meta, items)
+
     async def load_index_info(self, **kwargs) -> Optional[pd.DataFrame]:
         """
         指数基本信息
@@ -262,10 +412,22 @@ class StockDB(MongoDB):
         :return: None/DataFrame([code,trade_date,open,high,low,close,volume,amount])
         """
         self.log.debug('加载大盘日线数据, kwargs={} ...'.format(kwargs))
-        df = await self.do_load(self.index_daily, **kwargs)
+        df = await self.do_cached_load(self.index_daily, **kwargs)
         self.log.debug('加载大盘日线数据成功 size={}'.format(df.shape[0] if df is not None else 0))
         return df
 
+    async def load_index_daily_many(self, codes: List[str], start: datetime = None, end: datetime = None,
+                                    limit: int = 0, panel: bool = False,
+                                    **kwargs) -> Optional[Union[Dict[str, pd.DataFrame], pd.DataFrame]]:
+        """
+        批量加载大盘日线, 参数同load_stock_daily_many
+        """
+        self.log.debug('批量加载大盘日线, count={}, start={}, end={}, limit={}'.format(len(codes), start, end, limit))
+        data = await self.do_load_daily_many(self.index_daily, codes, start=start, end=end, limit=limit,
+                                             panel=panel, **kwargs)
+        self.log.debug('批量加载大盘日线成功, size={}'.format(len(data) if data is not None else 0))
+        return data
+
     async def save_index_daily(self, data: pd.DataFrame) -> List[str]:
         """
         :param code:
@@ -283,7 +445,7 @@ class StockDB(MongoDB):
     async def load_stock_north_south_flow(self, **kwargs) -> Optional[pd.DataFrame]:
         """
         kwargs参数同pymongo参数, 另外增加to_frame
-        :param kwargs:  filter=None, projection=None, skip=0, limit=0, sort=None, to_frame=True
+        :param kwargs:  filter=None, projection=None, skip=0, limit=0, sort=None, to_frame=True, compact=False
         :return: DataFrame
         """
         self.log.debug('加载北向资金信息, kwargs={} ...'.format(kwargs))
@@ -307,7 +469,7 @@ class StockDB(MongoDB):
     async def load_stock_his_divend(self, **kwargs) -> Optional[pd.DataFrame]:
         """
         kwargs参数同pymongo参数, 另外增加to_frame
-        :param kwargs:  filter=None, projection=None, skip=0, limit=0, sort=None, to_frame=True
+        :param kwargs:  filter=None, projection=None, skip=0, limit=0, sort=None, to_frame=True, compact=False
         :return: DataFrame
         """
         self.log.debug('加载历史分红信息, kwargs={} ...'.format(kwargs))
@@ -331,7 +493,7 @@ class StockDB(MongoDB):
     async def load_sw_index_info(self, **kwargs) -> Optional[pd.DataFrame]:
         """
         kwargs参数同pymongo参数, 另外增加to_frame
-        :param kwargs:  filter=None, projection=None, skip=0, limit=0, sort=None, to_frame=True
+        :param kwargs:  filter=None, projection=None, skip=0, limit=0, sort=None, to_frame=True, compact=False
         :return: DataFrame
         """
         self.log.debug('加载申万一级行业信息, kwargs={} ...'.format(kwargs))
@@ -354,7 +516,7 @@ class StockDB(MongoDB):
 
     async def load_stock_margin(self, **kwargs) -> Optional[pd.DataFrame]:
         """
-        :param kwargs:  filter=None, projection=None, skip=0, limit=0, sort=None, to_frame=True
+        :param kwargs:  filter=None, projection=None, skip=0, limit=0, sort=None, to_frame=True, compact=False
         :return: DataFrame
         """
         self.log.debug('加载股票融资融券数据, kwargs={}'.format(kwargs))
@@ -377,7 +539,7 @@ class StockDB(MongoDB):
 
     async def load_stock_concept(self, **kwargs) -> Optional[pd.DataFrame]:
         """
-        :param kwargs:  filter=None, projection=None, skip=0, limit=0, sort=None, to_frame=True
+        :param kwargs:  filter=None, projection=None, skip=0, limit=0, sort=None, to_frame=True, compact=False
         :return: DataFrame
         """
         self.log.debug('加载股票概念数据, kwargs={}'.format(kwargs))
@@ -398,6 +560,38 @@ class StockDB(MongoDB):
         self.log.debug('保存股票概念数据成功, size = {}'.format(len(inserted_ids) if inserted_ids is not None else 0))
         return inserted_ids
 
+    async def upsert_stock_concept(self, data: pd.DataFrame) -> List:
+        """
+        按(concept_code, stock_code)upsert概念成分股
+        :param data: DataFrame([concept_code,concept_date,concept_name,stock_code,stock_name])
+        :return: None/list
+        """
+        count = data.shape[0] if data is not None else 0
+        self.log.debug('更新股票概念数据, count = {} ...'.format(count))
+        upsert_list = None
+        if count > 0:
+            upsert_list = await self.do_batch_update(
+                data=data,
+                func=lambda x: (self.stock_concept, {'concept_code': x['concept_code'], 'stock_code': x['stock_code']}, x))
+        self.log.debug('更新股票概念数据成功, size = {}'.format(len(upsert_list) if upsert_list is not None else 0))
+        return upsert_list
+
+    async def delete_stock_concept(self, data: pd.DataFrame) -> int:
+        """
+        删除已移出概念的成分股
+        :param data: DataFrame([concept_code,stock_code])
+        :return: 删除条数
+        """
+        count = 0
+        if data is not None and not data.empty:
+            for concept_code, group in data.groupby('concept_code'):
+                count = count + await self.do_delete(self.stock_concept,
+                                                     filter={'concept_code': concept_code,
+                                                             'stock_code': {'$in': group['stock_code'].tolist()}},
+                                                     just_one=False)
+        self.log.debug('删除股票概念成分股, size = {}'.format(count))
+        return count
+
 
 if __name__ == '__main__':
     from bbq.common import run_until_complete
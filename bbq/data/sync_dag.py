@@ -0,0 +1,90 @@
+import asyncio
+import time
+import traceback
+from typing import Callable, Dict, Iterable, List
+
+from bbq import log
+
+
+class SyncDag:
+    """
+    进程内同步编排: 按依赖关系运行各个阶段(协程), 依赖的阶段都完成后立即开始, 不依赖的阶段并发运行
+    依赖的阶段失败时, 该阶段及其后续阶段跳过
+    """
+
+    def __init__(self):
+        self.log = log.get_logger(self.__class__.__name__)
+        self.stages: Dict[str, Callable] = {}
+        self.deps: Dict[str, List[str]] = {}
+        self.status: Dict[str, str] = {}
+        self.cost: Dict[str, float] = {}
+
+    def add(self, name: str, func: Callable, deps: Iterable[str] = ()):
+        """
+        :param name: 阶段名称
+        :param func: async func() -> bool, 返回False视为失败
+        :param deps: 依赖的阶段
+        """
+        if name in self.stages:
+            raise ValueError('阶段{}已存在'.format(name))
+        self.stages[name] = func
+        self.deps[name] = list(deps)
+
+    def check(self):
+        """
+        检查依赖是否存在及是否有环
+        """
+        for name, deps in self.deps.items():
+            for dep in deps:
+                if dep not in self.stages:
+                    raise ValueError('阶段{}依赖的阶段{}不存在'.format(name, dep))
+        visited, visiting = set(), set()
+
+        def visit(name):
+            if name in visited:
+                return
+            if name in visiting:
+                raise ValueError('阶段依赖有环: {}'.format(name))
+            visiting.add(name)
+            for dep in self.deps[name]:
+                visit(dep)
+            visiting.discard(name)
+            visited.add(name)
+
+        for name in self.stages:
+            visit(name)
+
+    async def _run_stage(self, name: str, events: Dict[str, asyncio.Event]):
+        try:
+            for dep in self.deps[name]:
+                await events[dep].wait()
+            failed = [dep for dep in self.deps[name] if self.status[dep] != 'done']
+            if len(failed) > 0:
+                self.status[name] = 'skipped'
+                self.log.error('阶段{}依赖的阶段{}未完成, 跳过'.format(name, failed))
+                return
+
+            self.log.info('开始阶段: {}'.format(name))
+            start = time.time()
+            try:
+                ok = await self.stages[name]()
+                self.status[name] = 'failed' if ok is False else 'done'
+            except Exception as e:
+                self.status[name] = 'failed'
+                self.log.error('阶段{}异常: ex={}, stack={}'.format(name, e, traceback.format_exc()))
+            self.cost[name] = time.time() - start
+            self.log.info('阶段{}结束: status={}, cost={:.2f}s'.format(name, self.status[name], self.cost[name]))
+        finally:
+            events[name].set()
+
+    async def run(self) -> Dict[str, str]:
+        """
+        :return: 阶段 -> done/failed/skipped
+        """
+        self.check()
+        events = {name: asyncio.Event() for name in self.stages}
+        self.status = {name: 'pending' for name in self.stages}
+        start = time.time()
+        await asyncio.gather(*[self._run_stage(name, events) for name in self.stages])
+        self.log.info('同步编排完成: cost={:.2f}s, status={}'.format(time.time() - start, self.status))
+        return dict(self.status)
@@ -0,0 +1,97 @@
+import os
+import sqlite3
+from datetime import datetime
+from typing import Dict, Optional
+
+from bbq import log
+
+
+class SyncJournal:
+    """
+    同步日志(SQLite), 记录每次运行已完成的task及水位:
+        run(run_id, name, start_time, end_time, status, trade_date)
+        task(run_id, task_key, watermark, update_time)
+    上次运行未完成且同步的目标交易日相同时继续使用该run, 已完成的task不再运行(也不查询mongodb)
+    """
+
+    def __init__(self, path: str, name: str):
+        """
+        :param path: SQLite文件路径
+        :param name: 同步名称, 如stock_sync/fund_sync
+        """
+        self.log = log.get_logger(self.__class__.__name__)
+        if len(path) > 0 and path[0] == '~':
+            path = os.path.expanduser('~') + path[1:]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.name = name
+
+        # 同一文件有其他连接写入时等待写锁, 不直接报database is locked
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS run (run_id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                          'name TEXT, start_time TEXT, end_time TEXT, status TEXT, trade_date TEXT)')
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(run)').fetchall()]
+        if 'trade_date' not in columns:
+            self.conn.execute('ALTER TABLE run ADD COLUMN trade_date TEXT')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS task (run_id INTEGER, task_key TEXT, watermark TEXT, '
+                          'update_time TEXT, PRIMARY KEY (run_id, task_key))')
+        self.conn.commit()
+
+        self.run_id = None
+        self.finished: Dict[str, Optional[str]] = {}
+
+    def start(self, resume: bool = True, trade_date: datetime = None) -> int:
+        """
+        开始运行, resume为True且上次运行未完成时继续上次运行
+        :param trade_date: 本次同步的目标交易日(已收盘的最新交易日), 和上次运行不同时(已有新交易日数据)不再继续
+        :return: run_id
+        """
+        trade_date = trade_date.strftime('%Y-%m-%d') if trade_date is not None else None
+        row = self.conn.execute('SELECT run_id, status, trade_date FROM run WHERE name = ? '
+                                'ORDER BY run_id DESC LIMIT 1', (self.name,)).fetchone()
+        if resume and row is not None and row[1] != 'done' and row[2] == trade_date:
+            self.run_id = row[0]
+            self.finished = dict(self.conn.execute('SELECT task_key, watermark FROM task WHERE run_id = ?',
+                                                   (self.run_id,)).fetchall())
+            self.log.info('继续上次未完成的同步: run_id={}, 已完成task={}'.format(self.run_id, len(self.finished)))
+        else:
+            cursor = self.conn.execute('INSERT INTO run (name, start_time, status, trade_date) VALUES (?, ?, ?, ?)',
+                                       (self.name, datetime.now().isoformat(), 'running', trade_date))
+            self.conn.commit()
+            self.run_id = cursor.lastrowid
+            self.finished = {}
+        return self.run_id
+
+    def is_done(self, key: str) -> bool:
+        return key in self.finished
+
+    def done(self, key: str, watermark=None):
+        """
+        记录task完成
+        :param key: task key
+        :param watermark: 同步水位(一般为最后同步的trade_date)
+        """
+        if self.run_id is None:
+            return
+        if isinstance(watermark, datetime):
+            watermark = watermark.isoformat()
+        watermark = str(watermark) if watermark is not None else None
+        self.conn.execute('INSERT OR REPLACE INTO task (run_id, task_key, watermark, update_time) '
+                          'VALUES (?, ?, ?, ?)', (self.run_id, key, watermark, datetime.now().isoformat()))
+        self.conn.commit()
+        self.finished[key] = watermark
+
+    def finish(self, status: str = 'done'):
+        """
+        结束运行, status不为done时下次运行会继续本次运行
+        """
+        if self.run_id is None:
+            return
+        self.conn.execute('UPDATE run SET end_time = ?, status = ? WHERE run_id = ?',
+                          (datetime.now().isoformat(), status, self.run_id))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,172 @@
+import json
+import os
+import time
+from typing import Dict, List
+
+from bbq import log
+
+
+class Histogram:
+    """
+    累积直方图(同prometheus histogram), 单位秒
+    """
+    _buckets = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self._buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        idx = len(self._buckets)
+        for i, bucket in enumerate(self._buckets):
+            if value <= bucket:
+                idx = i
+                break
+        self.counts[idx] = self.counts[idx] + 1
+        self.sum = self.sum + value
+        self.count = self.count + 1
+        self.max = max(self.max, value)
+
+    def cumulative(self) -> List[tuple]:
+        """
+        :return: [(le, 累积次数)], 最后一个le为+Inf
+        """
+        result, total = [], 0
+        for le, count in zip(list(self._buckets) + ['+Inf'], self.counts):
+            total = total + count
+            result.append((le, total))
+        return result
+
+    def to_dict(self) -> Dict:
+        return dict(count=self.count, sum=round(self.sum, 3), max=round(self.max, 3),
+                    avg=round(self.sum / self.count, 3) if self.count > 0 else 0.0,
+                    buckets={str(le): count for le, count in self.cumulative()})
+
+
+class SyncMetrics:
+    """
+    同步运行指标:
+        task数(queued/running/done/failed), 每个fetch函数的耗时直方图, 每个集合写入行数/保存次数,
+        重试次数(retry装饰器), http请求数/下载字节数, 上游限速
+    定期输出汇总日志, 结束时输出json及prometheus文本文件
+    """
+
+    def __init__(self, name: str):
+        """
+        :param name: 同步名称, 如stock_sync/fund_sync
+        """
+        self.log = log.get_logger(self.__class__.__name__)
+        self.name = name
+        self.start_time = time.time()
+        self.tasks = dict(queued=0, running=0, done=0, failed=0)
+        self.fetch_latency: Dict[str, Histogram] = {}
+        self.rows: Dict[str, int] = {}
+        self.saves: Dict[str, Dict[str, int]] = {}
+
+    def task_queued(self, count: int):
+        self.tasks['queued'] = self.tasks['queued'] + count
+
+    def task_start(self):
+        self.tasks['queued'] = max(0, self.tasks['queued'] - 1)
+        self.tasks['running'] = self.tasks['running'] + 1
+
+    def task_end(self, ok: bool):
+        self.tasks['running'] = max(0, self.tasks['running'] - 1)
+        state = 'done' if ok else 'failed'
+        self.tasks[state] = self.tasks[state] + 1
+
+    def observe_fetch(self, fetcher: str, seconds: float):
+        if fetcher not in self.fetch_latency:
+            self.fetch_latency[fetcher] = Histogram()
+        self.fetch_latency[fetcher].observe(seconds)
+
+    def observe_save(self, coll: str, rows: int, ok: bool):
+        if ok:
+            self.rows[coll] = self.rows.get(coll, 0) + rows
+        saves = self.saves.setdefault(coll, dict(ok=0, failed=0))
+        state = 'ok' if ok else 'failed'
+        saves[state] = saves[state] + 1
+
+    def snapshot(self) -> Dict:
+        from bbq.fetch import http_client, rate_limiter
+        from bbq.retry import retry_stat
+
+        return dict(name=self.name, start_time=self.start_time, duration=round(time.time() - self.start_time, 3),
+                    tasks=dict(self.tasks),
+                    fetch_latency={name: hist.to_dict() for name, hist in self.fetch_latency.items()},
+                    rows=dict(self.rows), saves={coll: dict(saves) for coll, saves in self.saves.items()},
+                    retries=retry_stat(), http=http_client.stat(), rate_limit=rate_limiter.stat())
+
+    def summary(self) -> str:
+        duration = time.time() - self.start_time
+        rows = sum(self.rows.values())
+        fetches = sum(hist.count for hist in self.fetch_latency.values())
+        return 'task: 等待={queued}, 运行={running}, 完成={done}, 失败={failed}; ' \
+               'fetch={fetches}; 写入行数={rows}({speed:.1f}行/秒); 耗时={duration:.0f}s'.format(
+                fetches=fetches, rows=rows, speed=rows / duration if duration > 0 else 0.0, duration=duration,
+                **self.tasks)
+
+    def to_prometheus(self) -> str:
+        snap = self.snapshot()
+        sync = 'sync="{}"'.format(self.name)
+        lines = ['# TYPE bbq_sync_duration_seconds gauge',
+                 'bbq_sync_duration_seconds{{{}}} {}'.format(sync, snap['duration']),
+                 '# TYPE bbq_sync_tasks gauge']
+        for state, count in snap['tasks'].items():
+            lines.append('bbq_sync_tasks{{{},state="{}"}} {}'.format(sync, state, count))
+
+        lines.append('# TYPE bbq_sync_fetch_seconds histogram')
+        for fetcher, hist in self.fetch_latency.items():
+            labels = '{},fetcher="{}"'.format(sync, fetcher)
+            for le, count in hist.cumulative():
+                lines.append('bbq_sync_fetch_seconds_bucket{{{},le="{}"}} {}'.format(labels, le, count))
+            lines.append('bbq_sync_fetch_seconds_sum{{{}}} {}'.format(labels, round(hist.sum, 3)))
+            lines.append('bbq_sync_fetch_seconds_count{{{}}} {}'.format(labels, hist.count))
+
+        lines.append('# TYPE bbq_sync_rows_written_total counter')
+        for coll, rows in snap['rows'].items():
+            lines.append('bbq_sync_rows_written_total{{{},collection="{}"}} {}'.format(sync, coll, rows))
+        lines.append('# TYPE bbq_sync_saves_total counter')
+        for coll, saves in snap['saves'].items():
+            for state, count in saves.items():
+                lines.append('bbq_sync_saves_total{{{},collection="{}",status="{}"}} {}'.format(
+                    sync, coll, state, count))
+
+        lines.append('# TYPE bbq_sync_retries_total counter')
+        for func, count in snap['retries'].items():
+            lines.append('bbq_sync_retries_total{{{},func="{}"}} {}'.format(sync, func, count))
+
+        http = snap['http']
+        lines.append('# TYPE bbq_sync_http_requests_total counter')
+        lines.append('bbq_sync_http_requests_total{{{}}} {}'.format(sync, http['requests']))
+        lines.append('# TYPE bbq_sync_http_failed_total counter')
+        lines.append('bbq_sync_http_failed_total{{{}}} {}'.format(sync, http['failed']))
+        lines.append('# TYPE bbq_sync_http_bytes_total counter')
+        lines.append('bbq_sync_http_bytes_total{{{}}} {}'.format(sync, http['bytes']))
+
+        lines.append('# TYPE bbq_sync_upstream_rate gauge')
+        for upstream, stat in snap['rate_limit'].items():
+            lines.append('bbq_sync_upstream_rate{{{},upstream="{}"}} {}'.format(sync, upstream, stat['rate']))
+        lines.append('# TYPE bbq_sync_upstream_failed_total counter')
+        for upstream, stat in snap['rate_limit'].items():
+            lines.append('bbq_sync_upstream_failed_total{{{},upstream="{}"}} {}'.format(sync, upstream, stat['fail']))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path: str):
+        """
+        输出 {path}.json 及 {path}.prom
+        :param path: 文件路径(不含扩展名)
+        """
+        if len(path) > 0 and path[0] == '~':
+            path = os.path.expanduser('~') + path[1:]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        for ext, content in (('json', json.dumps(self.snapshot(), ensure_ascii=False, indent=2, default=str)),
+                             ('prom', self.to_prometheus())):
+            file = '{}.{}'.format(path, ext)
+            tmp_file = '{}.{}.tmp'.format(file, os.getpid())
+            with open(tmp_file, 'w') as f:
+                f.write(content)
+            os.replace(tmp_file, file)
+        self.log.info('同步指标已输出: {}.json, {}.prom'.format(path, path))
@@ -0,0 +1,126 @@
+import multiprocessing
+import queue
+import time
+import zlib
+from typing import Callable, Dict
+
+from bbq import log
+
+
+def shard_of(code: str, workers: int) -> int:
+    """
+    代码所属分片(crc32, 与进程/运行无关, 分片数不变时同步日志可以续跑)
+    """
+    return zlib.crc32(code.encode('utf-8')) % workers
+
+
+class ShardReporter:
+    """
+    worker进程端: 把同步进度/结果发送给协调进程, 作为DataSync的progress回调
+    """
+
+    def __init__(self, progress_queue, shard: int):
+        self.progress_queue = progress_queue
+        self.shard = shard
+
+    def __call__(self, state: str, info: Dict):
+        """
+        :param state: progress/done/partial/error
+        :param info: dict(tasks, rows, failed)
+        """
+        try:
+            self.progress_queue.put(dict(info, shard=self.shard, state=state))
+        except Exception:
+            pass
+
+
+class SyncShard:
+    """
+    按代码分片的多进程同步协调:
+        启动workers个进程(spawn, 每个进程独立的事件循环及mongodb连接), 每个进程同步 shard_of(code) == shard 的代码,
+        协调进程汇总各进程的进度及失败task, 进程异常退出视为该分片失败
+    """
+
+    def __init__(self, name: str, workers: int, target: Callable, args: tuple = (), report_interval: int = 60):
+        """
+        :param name: 同步名称
+        :param workers: 进程数
+        :param target: 模块级函数 target(shard, workers, progress_queue, *args)
+        :param report_interval: 汇总进度日志间隔(秒)
+        """
+        self.log = log.get_logger(self.__class__.__name__)
+        self.name = name
+        self.workers = workers
+        self.target = target
+        self.args = args
+        self.report_interval = report_interval
+
+        self.progress: Dict[int, Dict] = {}
+        self.status: Dict[int, str] = {}
+
+    def summary(self) -> str:
+        tasks = dict(queued=0, running=0, done=0, failed=0)
+        rows = 0
+        for info in self.progress.values():
+            for state in tasks.keys():
+                tasks[state] = tasks[state] + info.get('tasks', {}).get(state, 0)
+            rows = rows + info.get('rows', 0)
+        return 'task: 等待={queued}, 运行={running}, 完成={done}, 失败={failed}; 写入行数={rows}; ' \
+               '进程: 运行={alive}, 结束={finished}'.format(rows=rows, alive=self.workers - len(self.status),
+                                                     finished=len(self.status), **tasks)
+
+    def on_message(self, msg: Dict):
+        shard = msg['shard']
+        self.progress[shard] = msg
+        if msg['state'] != 'progress':
+            self.status[shard] = msg['state']
+            self.log.info('{}分片{}结束: status={}, 失败task数={}'.format(self.name, shard, msg['state'],
+                                                                   len(msg.get('failed', []))))
+
+    def run(self) -> Dict[int, str]:
+        """
+        :return: 分片 -> done/partial/error
+        """
+        ctx = multiprocessing.get_context('spawn')
+        progress_queue = ctx.Queue()
+        procs = {}
+        for shard in range(self.workers):
+            proc = ctx.Process(target=self.target, args=(shard, self.workers, progress_queue) + tuple(self.args),
+                               name='{}_{}'.format(self.name, shard), daemon=False)
+            proc.start()
+            procs[shard] = proc
+        self.log.info('{}启动{}个同步进程'.format(self.name, self.workers))
+
+        start, last_report = time.time(), time.time()
+        try:
+            while len(self.status) < self.workers:
+                try:
+                    self.on_message(progress_queue.get(timeout=1))
+                except queue.Empty:
+                    pass
+                for shard, proc in procs.items():
+                    if shard not in self.status and not proc.is_alive():
+                        # 进程退出前发送的结果可能还在队列里
+                        try:
+                            while True:
+                                self.on_message(progress_queue.get(timeout=1))
+                        except queue.Empty:
+                            pass
+                        if shard not in self.status:
+                            self.status[shard] = 'error'
+                            self.log.error('{}分片{}进程异常退出: exitcode={}'.format(self.name, shard, proc.exitcode))
+                if self.report_interval > 0 and time.time() - last_report >= self.report_interval:
+                    last_report = time.time()
+                    self.log.info('{}同步进度: {}'.format(self.name, self.summary()))
+        finally:
+            for proc in procs.values():
+                proc.join()
+
+        failed = []
+        for shard in sorted(self.progress.keys()):
+            failed.extend(self.progress[shard].get('failed', []))
+        self.log.info('{}同步完成: {}, 耗时={:.0f}s, 分片状态={}'.format(self.name, self.summary(),
+                                                                time.time() - start, self.status))
+        if len(failed) > 0:
+            self.log.error('{}失败task({}): {}'.format(self.name, len(failed), failed))
+        return dict(self.status)
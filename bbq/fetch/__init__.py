@@ -1,10 +1,13 @@
 import pandas as pd
 
-from .my_trade_date import is_trade_date
+from .my_trade_date import is_trade_date, trade_cal
+from .rate_limiter import rate_limiter, install_requests_limiter
+from .http_client import http_client
+from .http_cache import HttpCache, HttpCacheMiss, install_requests_cache
 from .my_fetch import MyFetch
 from .fund_eastmoney import FundEastmoney
 from .sina import Sina
-from typing import List
+from typing import List, Optional
 
 my_fetch = MyFetch()
 eastmoney_fund_fetch = FundEastmoney()
@@ -13,6 +16,7 @@ sina_fetch = Sina()
 fetch_stock_listing_date = my_fetch.fetch_stock_listing_date
 fetch_stock_info = my_fetch.fetch_stock_info
 fetch_stock_daily = my_fetch.fetch_stock_daily
+fetch_stock_daily_spot = my_fetch.fetch_stock_daily_spot
 fetch_stock_index = my_fetch.fetch_stock_index
 fetch_stock_index_daily = my_fetch.fetch_stock_index_daily
 fetch_stock_north_south_flow = my_fetch.fetch_stock_north_south_flow
@@ -23,13 +27,34 @@ fetch_stock_new_quote = my_fetch.fetch_stock_new_quote
 fetch_stock_adj_factor = my_fetch.fetch_stock_adj_factor
 fetch_stock_minute = my_fetch.fetch_stock_minute
 fetch_stock_margin = my_fetch.fetch_stock_margin
-fetch_stock_concept = my_fetch.fetch_stock_concept
+fetch_stock_margin_async = my_fetch.fetch_stock_margin_async
+fetch_stock_margin_code = my_fetch.fetch_stock_margin_code
+fetch_stock_margin_detail = my_fetch.fetch_stock_margin_detail
+merge_margin_flag = my_fetch.merge_margin_flag
+fetch_stock_concept_name = my_fetch.fetch_stock_concept_name
+fetch_stock_concept_cons = my_fetch.fetch_stock_concept_cons
 
 fetch_fund_net = my_fetch.fetch_fund_net
+fetch_fund_net_async = my_fetch.fetch_fund_net_async
 fetch_fund_info = my_fetch.fetch_fund_info
 fetch_fund_daily = my_fetch.fetch_fund_daily_xueqiu
 
 
+def enable_http_cache(path: str, ttl: int = 24 * 3600, max_size: int = 1024 * 1024 * 1024,
+                      mode: str = 'rw') -> Optional[HttpCache]:
+    """
+    开启fetch层http响应本地缓存(requests及http_client)
+    :param path: 缓存根目录
+    :param ttl: 缓存有效期(秒)
+    :param max_size: 缓存总大小上限(字节)
+    :param mode: rw(读写)/replay(只读缓存, 不访问网络)
+    """
+    cache = HttpCache(path=path, ttl=ttl, max_size=max_size, mode=mode)
+    install_requests_cache(cache)
+    http_client.enable_cache(cache)
+    return cache
+
+
 def fetch_index_info(codes: List[str] = None) -> pd.DataFrame:
     data = pd.DataFrame(dict(
         code=['sh000001', 'sz399001', 'sz399006', 'sz399102', 'sz399005', 'sh000300', 'sh000688',
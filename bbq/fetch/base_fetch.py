@@ -1,8 +1,8 @@
 from abc import ABC
-from datetime import datetime, timedelta
+from datetime import datetime
 
 import bbq.log as log
-from bbq.fetch.my_trade_date import is_trade_date
+from bbq.fetch.my_trade_date import trade_cal
 
 
 class BaseFetch(ABC):
@@ -31,12 +31,8 @@ class BaseFetch(ABC):
             return True
         if end < start:
             return False
-        tmp = start
-        while tmp <= end:
-            if is_trade_date(tmp):
-                return True
-            tmp = tmp + timedelta(days=1)
-        return False
+        next_trade_date = trade_cal.next_trade_date(start, include=True)
+        return next_trade_date is not None and next_trade_date.date() <= end.date()
 
     @staticmethod
     def df_size(df):
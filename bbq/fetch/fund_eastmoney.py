@@ -1,6 +1,5 @@
 import re
 import asyncio
-import aiohttp
 import pandas as pd
 from datetime import datetime
 import traceback
@@ -10,6 +9,7 @@ import json
 from bbq import log
 import random
 from bbq.common import singleton
+from bbq.fetch.http_client import http_client
 
 
 @singleton
@@ -41,14 +41,13 @@ class FundEastmoney:
         ex = None
         for i in range(5):
             try:
-                async with aiohttp.ClientSession() as session:
-                    for _ in range(15):
-                        async with session.get(url=url, headers=self.headers) as req:
-                            text = await req.text()
-                            redirect = re.findall(r'location\.href.*?\"(.*?)";', text)
-                            if len(redirect) == 0:
-                                return text
-                            url = redirect[0]
+                for _ in range(15):
+                    async with http_client.request('GET', url, headers=self.headers) as req:
+                        text = await req.text()
+                        redirect = re.findall(r'location\.href.*?\"(.*?)";', text)
+                        if len(redirect) == 0:
+                            return text
+                        url = redirect[0]
             except ClientConnectorError as e:
                 ex = e
                 self.log.error('连接错误, url={}, 第{}次重试'.format(url, i + 1))
@@ -152,20 +151,62 @@ class FundEastmoney:
             frame = frame[[x.strip() for x in fields.split(',')]]
         return frame
 
-    async def fetch_fund_net(self, code, start=None, end=None, fields=None):
+    def _parse_fund_net(self, code, resp):
         """
-        基金净值
+        解析一页净值
+        :return: (净值列表, (records, pages, curpage)), 无分页信息时为None
+        """
+        net_list = []
+        rows = self.fund_net_row_re.findall(resp)
+        for row in rows:
+            # 净值日期	单位净值	累计净值	日增长率	申购状态	赎回状态	分红送配
+            details = self.fund_net_detail_re.findall(row)
+            if len(details) != 7:
+                break
+
+            net_val = dict(code=code,
+                           trade_date=datetime.strptime(details[0], '%Y-%m-%d'),
+                           net=None if len(details[1].strip()) == 0 else float(details[1]),
+                           net_accumulate=None if len(details[2].strip()) == 0 else float(details[2]),
+                           day_grow_rate=float(details[3][:-1]) if details[3].find('%') > 0 else 0.0,
+                           apply_status=details[4],
+                           redeem_status=details[5],
+                           dividend=details[6],
+                           dividend_rate=0)
+            if net_val['dividend'] is not None and len(net_val['dividend']) > 0:
+                v = net_val['dividend']
+                m = 0
+                if '每份派现金' in v:
+                    s = v.replace('每份派现金', '')
+                    s = s.replace('元', '')
+                    m = float(s)
+
+                if net_val['net'] > 0:
+                    net_val['dividend_rate'] = round(m / net_val['net'] * 100, 2)
+
+            net_list.append(net_val)
+
+        page_details = self.fund_net_page_re.findall(resp)
+        if len(page_details) != 1:
+            return net_list, None
+        page_details = page_details[0]
+        return net_list, (int(page_details[0]), int(page_details[1]), int(page_details[2]))
+
+    async def fetch_fund_net(self, code, start=None, end=None, fields=None, concurrency=5):
+        """
+        基金净值, 先取第一页得到总页数, 剩余分页并发获取后按页序合并
         :param code: 基金代码
         :param start: 开始时间 datetime
         :param end: 结束时间 datetime
         :param fields: 过滤字段: 代码(code) 净值日期(trade_date) 单位净值(net) 累计净值(net_accumulate) 日增长率(day_grow_rate)
                        申购状态(apply_status) 赎回状态(redeem_status) 分红送配(dividend)
+        :param concurrency: 分页并发数
 
         :return DataFrame
         """
-        records, total_page, page, per = 0, 0, 1, 20
+        per = 20
 
-        def build_url():
+        def build_url(page):
             url = '{url}{code}&page={page}&per={per}'.format(url=self.fund_net_url, code=code, page=page, per=per)
             if start is not None:
                 url = url + '&sdate=' + start.strftime('%Y-%m-%d')
@@ -174,57 +215,20 @@ class FundEastmoney:
 
             return url
 
-        net_list = []
-        while True:
-            req_url = build_url()
-            # print('url=' + req_url)
-            resp = await self.retry_request(req_url)
-            rows = self.fund_net_row_re.findall(resp)
-            for row in rows:
-                # 净值日期	单位净值	累计净值	日增长率	申购状态	赎回状态	分红送配
-                details = self.fund_net_detail_re.findall(row)
-                if len(details) != 7:
-                    break
-
-                # net_list.append(dict(code=code,
-                #                      trade_date=datetime.strptime(details[0], '%Y-%m-%d'),
-                #                      net=0.0 if len(details[1].strip()) == 0 else float(details[1]),
-                #                      net_accumulate=0.0 if len(details[2].strip()) == 0 else float(details[2]),
-                #                      day_grow_rate=float(details[3][:-1]) if details[3].find('%') > 0 else 0.0,
-                #                      apply_status=details[4],
-                #                      redeem_status=details[5],
-                #                      dividend=details[6]
-                #                      ))
-                net_val = dict(code=code,
-                               trade_date=datetime.strptime(details[0], '%Y-%m-%d'),
-                               net=None if len(details[1].strip()) == 0 else float(details[1]),
-                               net_accumulate=None if len(details[2].strip()) == 0 else float(details[2]),
-                               day_grow_rate=float(details[3][:-1]) if details[3].find('%') > 0 else 0.0,
-                               apply_status=details[4],
-                               redeem_status=details[5],
-                               dividend=details[6],
-                               dividend_rate=0)
-                if net_val['dividend'] is not None and len(net_val['dividend']) > 0:
-                    v = net_val['dividend']
-                    m = 0
-                    if '每份派现金' in v:
-                        s = v.replace('每份派现金', '')
-                        s = s.replace('元', '')
-                        m = float(s)
-
-                    if net_val['net'] > 0:
-                        net_val['dividend_rate'] = round(m / net_val['net'] * 100, 2)
-
-                net_list.append(net_val)
-
-            page_details = self.fund_net_page_re.findall(resp)
-            if len(page_details) != 1:
-                break
-            page_details = page_details[0]
-            records, total_page, page = int(page_details[0]), int(page_details[1]), int(page_details[2])
-            if len(net_list) >= records:
-                break
-            page += 1
+        resp = await self.retry_request(build_url(1))
+        net_list, page_details = self._parse_fund_net(code, resp)
+        if page_details is not None:
+            records, total_page, _ = page_details
+            if len(net_list) < records and total_page > 1:
+                sem = asyncio.Semaphore(concurrency)
+
+                async def fetch_page(page):
+                    async with sem:
+                        return await self.retry_request(build_url(page))
+
+                resps = await asyncio.gather(*[fetch_page(page) for page in range(2, total_page + 1)])
+                for resp in resps:
+                    net_list.extend(self._parse_fund_net(code, resp)[0])
 
         if len(net_list) == 0:
             return None
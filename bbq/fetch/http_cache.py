@@ -0,0 +1,226 @@
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+from functools import wraps
+from http.cookies import SimpleCookie
+from typing import Dict, Optional
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+import bbq.log as log
+
+
+class HttpCacheMiss(Exception):
+    """
+    replay模式下缓存未命中, 不重试
+    """
+    retryable = False
+
+
+class HttpCache:
+    """
+    http响应本地缓存, 按 method+url(参数排序, 去掉随机参数)+body 的sha1存储:
+        {path}/{key[:2]}/{key}.pkl
+    只缓存GET且状态码200的响应, 超过ttl视为过期, 总大小超过max_size时按最近访问时间淘汰(LRU)
+    mode:
+        rw: 命中且未过期时使用缓存, 否则请求上游并写入缓存
+        replay: 只使用缓存(忽略ttl), 未命中抛HttpCacheMiss, 不访问网络
+    """
+    # 时间戳/随机数/jsonp回调等每次请求都不同的参数, 不参与key计算
+    _ignore_params = {'_', 'v', 'tm', 'rt', 'callback', 'cb'}
+
+    def __init__(self, path: str, ttl: int = 24 * 3600, max_size: int = 1024 * 1024 * 1024, mode: str = 'rw'):
+        """
+        :param path: 缓存根目录
+        :param ttl: 缓存有效期(秒)
+        :param max_size: 缓存总大小上限(字节)
+        :param mode: rw/replay
+        """
+        self.log = log.get_logger(self.__class__.__name__)
+        if mode not in ('rw', 'replay'):
+            raise ValueError('不支持的缓存模式: {}'.format(mode))
+        if len(path) > 0 and path[0] == '~':
+            path = os.path.expanduser('~') + path[1:]
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.mode = mode
+
+        self.lock = threading.Lock()
+        self.size = sum(os.path.getsize(file) for file in self._files())
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evicted = 0
+
+    @property
+    def replay(self) -> bool:
+        return self.mode == 'replay'
+
+    def _files(self):
+        for root_path, _, files in os.walk(self.path):
+            for file_name in files:
+                if file_name.endswith('.pkl'):
+                    yield os.path.join(root_path, file_name)
+
+    def _file(self, key: str) -> str:
+        return os.sep.join([self.path, key[:2], '{}.pkl'.format(key)])
+
+    def key(self, method: str, url: str, params=None, data=None) -> str:
+        parts = urlsplit(url)
+        query = parse_qsl(parts.query, keep_blank_values=True)
+        if params is not None:
+            query.extend(params.items() if isinstance(params, dict) else params)
+        query = sorted((str(k), str(v)) for k, v in query if k not in self._ignore_params)
+        url = urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), ''))
+        if data is not None and not isinstance(data, (str, bytes)):
+            data = json.dumps(data, sort_keys=True, default=str)
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        sha1 = hashlib.sha1('{} {}'.format(method.upper(), url).encode('utf-8'))
+        if data is not None:
+            sha1.update(data)
+        return sha1.hexdigest()
+
+    def get(self, key: str) -> Optional[Dict]:
+        """
+        :return: dict(url, status, headers, encoding, content, time), 未命中或过期返回None
+        """
+        file = self._file(key)
+        item = None
+        if os.path.exists(file):
+            try:
+                with open(file, 'rb') as f:
+                    item = pickle.load(f)
+            except Exception as e:
+                self.log.error('读取http缓存失败, 删除缓存: file={}, ex={}'.format(file, e))
+                self._remove(file)
+        if item is not None and not self.replay and time.time() - item['time'] > self.ttl:
+            item = None
+        with self.lock:
+            if item is None:
+                self.misses = self.misses + 1
+                return None
+            self.hits = self.hits + 1
+        # 访问时间用于LRU淘汰
+        os.utime(file)
+        return item
+
+    def put(self, key: str, url: str, status: int, headers: Dict, content: bytes, encoding: str = None):
+        if self.replay or status != 200:
+            return
+        file = self._file(key)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        tmp_file = '{}.{}.{}.tmp'.format(file, os.getpid(), threading.get_ident())
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(dict(url=url, status=status, headers=dict(headers), encoding=encoding,
+                             content=content, time=time.time()), f)
+        old_size = os.path.getsize(file) if os.path.exists(file) else 0
+        os.replace(tmp_file, file)
+        with self.lock:
+            self.stores = self.stores + 1
+            self.size = self.size + os.path.getsize(file) - old_size
+            need_evict = self.size > self.max_size
+        if need_evict:
+            self.evict()
+
+    def _remove(self, file: str) -> int:
+        try:
+            size = os.path.getsize(file)
+            os.remove(file)
+            return size
+        except OSError:
+            return 0
+
+    def evict(self):
+        """
+        按最近访问时间淘汰到max_size的90%
+        """
+        files = []
+        for file in self._files():
+            try:
+                files.append((os.path.getmtime(file), file))
+            except OSError:
+                continue
+        files.sort()
+        target = self.max_size * 0.9
+        for _, file in files:
+            with self.lock:
+                if self.size <= target:
+                    break
+            size = self._remove(file)
+            with self.lock:
+                self.size = self.size - size
+                self.evicted = self.evicted + 1
+
+    def stat(self) -> Dict:
+        with self.lock:
+            return dict(mode=self.mode, hits=self.hits, misses=self.misses, stores=self.stores,
+                        evicted=self.evicted, size=self.size)
+
+
+class CachedResponse:
+    """
+    缓存的aiohttp响应, 提供HttpClient调用方用到的接口
+    """
+
+    def __init__(self, item: Dict):
+        self.url = item['url']
+        self.status = item['status']
+        self.headers = CaseInsensitiveDict(item['headers'])
+        self.cookies = SimpleCookie()
+        self.encoding = item['encoding']
+        self.content = item['content']
+
+    def get_encoding(self) -> str:
+        return self.encoding or 'utf-8'
+
+    async def read(self) -> bytes:
+        return self.content
+
+    async def text(self, encoding=None, errors='strict') -> str:
+        return self.content.decode(encoding or self.get_encoding(), errors=errors)
+
+    async def json(self, encoding=None, loads=json.loads, content_type=None):
+        return loads(await self.text(encoding))
+
+
+def install_requests_cache(cache: HttpCache):
+    """
+    requests(hiakshare/akshare/StockEastmoney等)的GET请求经过缓存
+    """
+    request = requests.Session.request
+    if getattr(request, 'http_cache', None) is not None:
+        request = request.origin
+
+    @wraps(request)
+    def cached_request(self, method, url, params=None, data=None, **kwargs):
+        if method.upper() != 'GET':
+            return request(self, method, url, params=params, data=data, **kwargs)
+
+        key = cache.key(method, url, params, data)
+        item = cache.get(key)
+        if item is None:
+            if cache.replay:
+                raise HttpCacheMiss('缓存未命中: {} {}'.format(method, url))
+            resp = request(self, method, url, params=params, data=data, **kwargs)
+            cache.put(key, resp.url, resp.status_code, resp.headers, resp.content, resp.encoding)
+            return resp
+
+        resp = requests.Response()
+        resp.url = item['url']
+        resp.status_code = item['status']
+        resp.headers = CaseInsensitiveDict(item['headers'])
+        resp.encoding = item['encoding']
+        resp._content = item['content']
+        return resp
+
+    cached_request.http_cache = cache
+    cached_request.origin = request
+    requests.Session.request = cached_request
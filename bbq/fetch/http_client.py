@@ -0,0 +1,167 @@
+import asyncio
+import threading
+import time
+import weakref
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+import aiohttp
+
+import bbq.log as log
+from bbq.fetch.http_cache import HttpCache, CachedResponse, HttpCacheMiss
+from bbq.fetch.rate_limiter import rate_limiter
+
+
+class _HttpStat:
+    """
+    aiohttp TraceConfig统计: 请求数/失败数/延迟/连接复用率/下载字节数
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failed = 0
+        self.latency = 0.0
+        self.latency_max = 0.0
+        self.conn_created = 0
+        self.conn_reused = 0
+        self.bytes = 0
+
+    def add_bytes(self, size: int):
+        with self.lock:
+            self.bytes = self.bytes + size
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(self._on_request_start)
+        trace.on_request_end.append(self._on_request_end)
+        trace.on_request_exception.append(self._on_request_exception)
+        trace.on_connection_create_end.append(self._on_connection_create_end)
+        trace.on_connection_reuseconn.append(self._on_connection_reuseconn)
+        trace.on_response_chunk_received.append(self._on_response_chunk_received)
+        return trace
+
+    async def _on_request_start(self, session, ctx, params):
+        ctx.start = time.monotonic()
+
+    async def _on_request_end(self, session, ctx, params):
+        cost = time.monotonic() - ctx.start
+        with self.lock:
+            self.requests = self.requests + 1
+            self.latency = self.latency + cost
+            self.latency_max = max(self.latency_max, cost)
+
+    async def _on_request_exception(self, session, ctx, params):
+        with self.lock:
+            self.requests = self.requests + 1
+            self.failed = self.failed + 1
+
+    async def _on_connection_create_end(self, session, ctx, params):
+        with self.lock:
+            self.conn_created = self.conn_created + 1
+
+    async def _on_connection_reuseconn(self, session, ctx, params):
+        with self.lock:
+            self.conn_reused = self.conn_reused + 1
+
+    async def _on_response_chunk_received(self, session, ctx, params):
+        self.add_bytes(len(params.chunk))
+
+    def stat(self) -> Dict:
+        with self.lock:
+            conn = self.conn_created + self.conn_reused
+            succeed = self.requests - self.failed
+            return dict(requests=self.requests, failed=self.failed,
+                        latency_avg=round(self.latency / succeed, 3) if succeed > 0 else 0.0,
+                        latency_max=round(self.latency_max, 3),
+                        conn_created=self.conn_created, conn_reused=self.conn_reused,
+                        reuse_ratio=round(self.conn_reused / conn, 3) if conn > 0 else 0.0, bytes=self.bytes)
+
+
+class HttpClient:
+    """
+    进程内共享的异步http客户端, 每个事件循环一个keep-alive的ClientSession:
+        连接池(总数/单host限制), dns缓存, 超时, gzip, 上游限速
+    用法:
+        async with http_client.request('GET', url, headers=headers) as resp:
+            text = await resp.text()
+    """
+
+    def __init__(self, limit: int = 100, limit_per_host: int = 10, timeout: float = 30, dns_ttl: int = 300,
+                 keepalive_timeout: float = 30):
+        """
+        :param limit: 连接池总连接数
+        :param limit_per_host: 单个host连接数
+        :param timeout: 单个请求超时(秒)
+        :param dns_ttl: dns缓存时间(秒)
+        :param keepalive_timeout: 空闲连接保持时间(秒)
+        """
+        self.log = log.get_logger(self.__class__.__name__)
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.dns_ttl = dns_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.headers = {'Accept-Encoding': 'gzip, deflate'}
+
+        self.sessions = weakref.WeakKeyDictionary()
+        self.http_stat = _HttpStat()
+        self.cache: Optional[HttpCache] = None
+
+    def enable_cache(self, cache: Optional[HttpCache]):
+        self.cache = cache
+
+    def session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_event_loop()
+        session = self.sessions.get(loop)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host,
+                                             ttl_dns_cache=self.dns_ttl, keepalive_timeout=self.keepalive_timeout)
+            session = aiohttp.ClientSession(connector=connector, headers=self.headers,
+                                            timeout=aiohttp.ClientTimeout(total=self.timeout),
+                                            auto_decompress=True, trace_configs=[self.http_stat.trace_config()])
+            self.sessions[loop] = session
+        return session
+
+    @asynccontextmanager
+    async def request(self, method: str, url: str, **kwargs):
+        """
+        参数同aiohttp.ClientSession.request, 请求经过上游限速, 并根据状态码/连接异常调整限速
+        开启缓存时GET请求优先使用缓存(CachedResponse)
+        """
+        cache, key = self.cache if method.upper() == 'GET' else None, None
+        if cache is not None:
+            key = cache.key(method, url, kwargs.get('params'), kwargs.get('data'))
+            item = cache.get(key)
+            if item is not None:
+                yield CachedResponse(item)
+                return
+            if cache.replay:
+                raise HttpCacheMiss('缓存未命中: {} {}'.format(method, url))
+
+        await rate_limiter.acquire_async(url)
+        try:
+            async with self.session().request(method, url, **kwargs) as resp:
+                rate_limiter.feedback(url, rate_limiter.is_ok_status(resp.status))
+                if cache is not None and resp.status == 200:
+                    content = await resp.read()
+                    cache.put(key, str(resp.url), resp.status, resp.headers, content, resp.get_encoding())
+                yield resp
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            rate_limiter.feedback(url, False)
+            raise
+
+    async def close(self):
+        for session in list(self.sessions.values()):
+            if not session.closed:
+                await session.close()
+        self.sessions.clear()
+
+    def stat(self) -> Dict:
+        """
+        :return: dict(requests, failed, latency_avg, latency_max, conn_created, conn_reused, reuse_ratio, bytes)
+        """
+        return self.http_stat.stat()
+
+
+http_client = HttpClient()
@@ -7,6 +7,7 @@ from opendatatools import stock
 
 import bbq.fetch.hiakshare as hiak
 from bbq.fetch.base_fetch import BaseFetch
+from bbq.fetch.fund_eastmoney import FundEastmoney
 from bbq.fetch.stock_eastmoney import StockEastmoney
 from bbq.retry import retry
 from bbq.fetch.my_trade_date import is_trade_date
@@ -26,6 +27,7 @@ class MyFetch(BaseFetch):
     def __init__(self):
         super().__init__()
         self.eastmoney = StockEastmoney()
+        self.fund_eastmoney = FundEastmoney()
 
     @retry(name='MyFetch')
     def fetch_stock_listing_date(self, code: str) -> Optional[datetime]:
@@ -61,11 +63,12 @@ class MyFetch(BaseFetch):
         return None
 
     @retry(name='MyFetch')
-    def fetch_stock_info(self, codes: List[str] = None) -> Optional[pd.DataFrame]:
+    def fetch_stock_info(self, codes: List[str] = None, with_margin: bool = True) -> Optional[pd.DataFrame]:
         """
         股票信息
         :param codes: 需要获取股票代码, None为全部
-        :return: code(股票代码)  name(股票名称) listing_date(股票上市日期) block(板块)
+        :param with_margin: 是否获取融资融券标的(is_margin), False时可由fetch_stock_margin_code异步获取后merge_margin_flag
+        :return: code(股票代码)  name(股票名称) listing_date(股票上市日期) block(板块) is_margin(融资融券标的)
         """
         data, market = None, 'shsz'
         if codes is not None:
@@ -130,10 +133,9 @@ class MyFetch(BaseFetch):
             cond = 'code in ["{}"]'.format("\",\"".join(codes))
             data = data.query(cond)
 
-        self.log.info('获取东方财富融资融券标的')
-        margin_info = self.eastmoney.get_stock_margin_code()
-        data = data.merge(margin_info, how='left', on='code')
-        data['is_margin'].fillna(value=0, inplace=True)
+        if with_margin:
+            self.log.info('获取东方财富融资融券标的')
+            data = self.merge_margin_flag(data, self.eastmoney.get_stock_margin_code())
 
         data = data.reset_index(drop=True)
         self.log.debug('获取股票成功, count={}'.format(self.df_size(data)))
@@ -712,6 +714,41 @@ class MyFetch(BaseFetch):
         self.log.debug('获取雪球场内基金{}日线数据, count={}'.format(code, self.df_size(df)))
         return df
 
+    @retry(name='MyFetch')
+    def fetch_stock_daily_spot(self) -> Optional[pd.DataFrame]:
+        """
+        全市场最新交易日未复权日线快照(东方财富), 一次请求获取所有股票
+
+        :return: code, trade_date, open, high, low, close, pre_close(昨收, 已除权), volume(股), turnover(换手率)
+        """
+        self.log.debug('获取全市场日线快照...')
+        df = self.eastmoney.get_stock_spot()
+        self.log.debug('获取全市场日线快照, count={}'.format(self.df_size(df)))
+        return df
+
+    @staticmethod
+    def merge_margin_flag(data: pd.DataFrame, margin_info: Optional[pd.DataFrame]) -> pd.DataFrame:
+        """
+        股票信息合并融资融券标的标识is_margin, 只有成功获取的标的列表中没有的代码才为0
+        """
+        if margin_info is None or margin_info.empty:
+            # 获取失败不能全部记为非标的(股票信息只新增不更新)
+            raise Exception('获取融资融券标的失败')
+        data = data.merge(margin_info[['code', 'is_margin']], how='left', on='code')
+        data['is_margin'] = data['is_margin'].fillna(value=0)
+        return data
+
+    @retry(name='MyFetch')
+    async def fetch_stock_margin_code(self) -> Optional[pd.DataFrame]:
+        """
+        东方财富融资融券标的(异步)
+        :return: code is_margin
+        """
+        self.log.info('获取东方财富融资融券标的')
+        df = await self.eastmoney.get_stock_margin_code_async()
+        self.log.debug('获取东方财富融资融券标的, count={}'.format(self.df_size(df)))
+        return df
+
     @retry(name='MyFetch')
     def fetch_stock_margin(self, code: str, start: datetime = None, end: datetime = None) -> Optional[pd.DataFrame]:
         """
@@ -732,28 +769,89 @@ class MyFetch(BaseFetch):
         return df
 
     @retry(name='MyFetch')
-    def fetch_stock_concept(self, start=None) -> Optional[pd.DataFrame]:
-        q_items = []
-        # 概念
+    def fetch_stock_margin_detail(self, trade_date: datetime) -> Optional[pd.DataFrame]:
+        """
+        沪深交易所某个交易日全部标的融资融券明细, 两个交易所都有数据才返回
+
+        :param trade_date: 交易日
+        :return: code name trade_date
+            上证: rzye(融资余额) rzmre(融资买入额) rzche(融资偿还额) rqyl(融券余量) rqmcl(融券卖出量) rqchl(融券偿还量)
+            深证: rzye rzmre rqyl rqmcl rqye(融券余额) rzrqye(融资融券余额)
+        """
+        date = trade_date.strftime('%Y%m%d')
+        self.log.debug('获取交易所融资融券明细, trade_date={}...'.format(date))
+        sh = hiak.stock_margin_detail_sse(date=date)
+        if sh is None or sh.empty:
+            self.log.debug('上交所融资融券明细为空, trade_date={}'.format(date))
+            return None
+        sh = sh.rename(columns={'标的证券代码': 'code', '标的证券简称': 'name', '融资余额': 'rzye', '融资买入额': 'rzmre',
+                                '融资偿还额': 'rzche', '融券余量': 'rqyl', '融券卖出量': 'rqmcl', '融券偿还量': 'rqchl'})
+        sh['code'] = 'sh' + sh['code'].astype(str).str.zfill(6)
+        sh = sh[['code', 'name', 'rzye', 'rzmre', 'rzche', 'rqyl', 'rqmcl', 'rqchl']]
+
+        sz = hiak.stock_margin_detail_szse(date=date)
+        if sz is None or sz.empty:
+            self.log.debug('深交所融资融券明细为空, trade_date={}'.format(date))
+            return None
+        sz = sz.rename(columns={'证券代码': 'code', '证券简称': 'name', '融资买入额': 'rzmre', '融资余额': 'rzye',
+                                '融券卖出量': 'rqmcl', '融券余量': 'rqyl', '融券余额': 'rqye', '融资融券余额': 'rzrqye'})
+        sz['code'] = 'sz' + sz['code'].astype(str).str.zfill(6)
+        sz = sz[['code', 'name', 'rzye', 'rzmre', 'rqyl', 'rqmcl', 'rqye', 'rzrqye']]
+
+        df = pd.concat((sh, sz), ignore_index=True)
+        for col in ['rzye', 'rzmre', 'rzche', 'rqyl', 'rqmcl', 'rqchl', 'rqye', 'rzrqye']:
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+        df['trade_date'] = datetime(year=trade_date.year, month=trade_date.month, day=trade_date.day)
+        self.log.debug('获取交易所融资融券明细, trade_date={}, count={}'.format(date, self.df_size(df)))
+        return df
+
+    @retry(name='MyFetch')
+    async def fetch_stock_margin_async(self, code: str, start: datetime = None,
+                                       end: datetime = None) -> Optional[pd.DataFrame]:
+        """
+        fetch_stock_margin的异步版本, 分页并发获取, 不占用线程池
+        """
+        self.log.debug('获取东方财富{}融资融券数据, start={}, end={}...'.format(code, start, end))
+        df = await self.eastmoney.get_stock_margin_async(code=code, start=start, end=end)
+        if not df.empty:
+            df['sync_date'] = datetime.now()
+        self.log.debug('获取东方财富{}融资融券数据, count={}'.format(code, self.df_size(df)))
+        return df
+
+    @retry(name='MyFetch')
+    def fetch_stock_concept_name(self, start=None) -> Optional[pd.DataFrame]:
+        """
+        同花顺概念
+        :param start: 只获取start(含)之后新增的概念, None为全部
+        :return: concept_code concept_date concept_name
+        """
         df = hiak.stock_board_concept_name_ths()
         if df is None or df.empty:
             return None
         df['日期'] = df['日期'].apply(lambda x: datetime(year=x.year, month=x.month, day=x.day))
         if start is not None:
             df = df[df['日期'] >= start]
+        data = pd.DataFrame(dict(concept_code=df['代码'].apply(lambda x: x.split('/')[6]), concept_date=df['日期'],
+                                 concept_name=df['概念名称'])).reset_index(drop=True)
+        self.log.debug('获取同花顺概念, count={}'.format(self.df_size(data)))
+        return data
 
-        for item in df.to_dict('records'):
-            name = item['概念名称']
-            code_df = hiak.stock_board_concept_cons_ths(symbol=name)
-            if code_df is None or code_df.empty:
-                continue
-            concept_code = item['代码'].split('/')[6]
-            for code_item in code_df.to_dict('records'):
-                code, stock_name = code_item['代码'], code_item['名称']
-                code = 'sh' + code if code.startswith('6') else 'sz' + code
-                q_items.append(dict(concept_code=concept_code, concept_date=item['日期'], concept_name=name,
-                                    stock_code=code, stock_name=stock_name))
-        return pd.DataFrame(q_items)
+    @retry(name='MyFetch')
+    def fetch_stock_concept_cons(self, concept_code: str, concept_date: datetime,
+                                 concept_name: str) -> Optional[pd.DataFrame]:
+        """
+        同花顺概念成分股
+        :return: concept_code concept_date concept_name stock_code stock_name, 获取失败返回None, 没有成分股返回空DataFrame
+        """
+        df = hiak.stock_board_concept_cons_ths(symbol=concept_name)
+        if df is None:
+            raise Exception('获取概念{}成分股失败'.format(concept_name))
+        if df.empty:
+            return pd.DataFrame(columns=['concept_code', 'concept_date', 'concept_name', 'stock_code', 'stock_name'])
+        codes = df['代码'].astype(str)
+        return pd.DataFrame(dict(concept_code=concept_code, concept_date=concept_date, concept_name=concept_name,
+                                 stock_code=codes.str.startswith('6').map({True: 'sh', False: 'sz'}) + codes,
+                                 stock_name=df['名称'].values))
 
     @retry(name='MyFetch')
     def fetch_fund_info(self, codes: List[str] = None, types: List[str] = None) -> Optional[pd.DataFrame]:
@@ -835,11 +933,35 @@ class MyFetch(BaseFetch):
         self.log.debug('获取天天基金净值信息, count={}'.format(self.df_size(df)))
         return df
 
+    @retry(name='MyFetch')
+    async def fetch_fund_net_async(self, code: str, start: datetime = None,
+                                   end: datetime = None) -> Optional[pd.DataFrame]:
+        """
+        fetch_fund_net的异步版本, 天天基金净值分页并发获取, 不占用线程池
+
+        :param code: 基金代码
+        :param start: 开始时间
+        :param end: 结束时间
+        :return:
+            代码(code) 净值日期(trade_date) 单位净值(net) 累计净值(net_acc) 日增长率(rise)
+            申购状态(apply_status) 赎回状态(redeem_status)
+        """
+        self.log.debug('获取天天基金净值信息, code={}, start={} end={}...'.format(code, start, end))
+        df = await self.fund_eastmoney.fetch_fund_net(code=code, start=start, end=end)
+        if df is not None and not df.empty:
+            df.dropna(subset=['net'], inplace=True)
+            df.rename(columns={'net_accumulate': 'net_acc', 'day_grow_rate': 'rise'}, inplace=True)
+            df['net_acc'] = df['net_acc'].fillna(df['net'])
+            df = df[['code', 'trade_date', 'net', 'net_acc', 'rise', 'apply_status', 'redeem_status']]
+            df = df.reset_index(drop=True)
+        self.log.debug('获取天天基金净值信息, count={}'.format(self.df_size(df)))
+        return df
+
 
 if __name__ == '__main__':
     aks = MyFetch()
 
-    # tdf = aks.fetch_stock_concept(start=datetime(year=2022, month=1, day=5))
+    # tdf = aks.fetch_stock_concept_name(start=datetime(year=2022, month=1, day=5))
     # print(tdf)
 
     # tdf = aks.fetch_stock_listing_date(code='sz000001')
@@ -0,0 +1,210 @@
+import asyncio
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Dict
+from urllib.parse import urlparse
+
+import requests
+
+import bbq.log as log
+
+
+class TokenBucket:
+    """
+    令牌桶, 速率按AIMD调整: 成功加性增加, 失败(403/429/连接异常等)乘性减少
+    令牌允许为负(预占), acquire返回需要等待的时间, 同时适用于线程和协程
+    """
+
+    def __init__(self, rate: float, max_rate: float, min_rate: float = 0.2, burst: float = 1.0,
+                 incr: float = 0.1, decr: float = 0.5):
+        """
+        :param rate: 初始速率(次/秒)
+        :param max_rate: 最大速率
+        :param min_rate: 最小速率
+        :param burst: 桶容量
+        :param incr: 每次成功增加的速率
+        :param decr: 每次失败速率乘以的系数
+        """
+        self.rate = rate
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.burst = burst
+        self.incr = incr
+        self.decr = decr
+
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+        self.success = 0
+        self.fail = 0
+        self.wait_time = 0.0
+
+    def reserve(self) -> float:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens = self.tokens - 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.wait_time = self.wait_time + wait
+            return wait
+
+    def feedback(self, ok: bool):
+        with self.lock:
+            if ok:
+                self.success = self.success + 1
+                self.rate = min(self.max_rate, self.rate + self.incr)
+            else:
+                self.fail = self.fail + 1
+                self.rate = max(self.min_rate, self.rate * self.decr)
+                # 失败后清空积累的令牌, 避免突发
+                self.tokens = min(self.tokens, 0)
+
+    def stat(self) -> Dict:
+        with self.lock:
+            return dict(rate=round(self.rate, 3), success=self.success, fail=self.fail,
+                        wait_time=round(self.wait_time, 3))
+
+
+class RateLimiter:
+    """
+    按上游(eastmoney/sina/xueqiu/ths等)限速, 未配置的上游使用default
+    """
+    _hosts = {
+        'eastmoney.com': 'eastmoney',
+        'sina.com.cn': 'sina',
+        'sinajs.cn': 'sina',
+        'xueqiu.com': 'xueqiu',
+        '10jqka.com.cn': 'ths',
+        'legulegu.com': 'legulegu',
+        'sse.com.cn': 'exchange',
+        'szse.cn': 'exchange',
+        'swsindex.com': 'sw',
+        'gitee.com': 'gitee',
+    }
+    _conf = {
+        'eastmoney': dict(rate=5, max_rate=20),
+        'sina': dict(rate=2, max_rate=5),
+        'xueqiu': dict(rate=3, max_rate=10),
+        'ths': dict(rate=1, max_rate=3),
+        'default': dict(rate=5, max_rate=20),
+    }
+
+    def __init__(self, conf: Dict[str, Dict] = None):
+        """
+        :param conf: 上游 -> TokenBucket参数, 覆盖默认配置
+        """
+        self.log = log.get_logger(self.__class__.__name__)
+        self.conf = dict(self._conf)
+        if conf is not None:
+            self.conf.update(conf)
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.lock = threading.Lock()
+
+    def host_key(self, url_or_key: str) -> str:
+        """
+        url转换为上游名称, 非url原样返回
+        """
+        if '://' not in url_or_key:
+            return url_or_key
+        host = urlparse(url_or_key).hostname or ''
+        for suffix, key in self._hosts.items():
+            if host == suffix or host.endswith('.' + suffix):
+                return key
+        return host
+
+    def bucket(self, key: str) -> TokenBucket:
+        key = self.host_key(key)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            with self.lock:
+                bucket = self.buckets.get(key)
+                if bucket is None:
+                    bucket = TokenBucket(**self.conf.get(key, self.conf['default']))
+                    self.buckets[key] = bucket
+        return bucket
+
+    def acquire(self, key: str):
+        wait = self.bucket(key).reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, key: str):
+        wait = self.bucket(key).reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def feedback(self, key: str, ok: bool):
+        bucket = self.bucket(key)
+        bucket.feedback(ok)
+        if not ok:
+            self.log.debug('上游{}请求失败, 限速降为{:.2f}次/秒'.format(self.host_key(key), bucket.rate))
+
+    @staticmethod
+    def is_ok_status(status: int) -> bool:
+        # 456: 新浪封IP
+        return status not in (403, 429, 456) and status < 500
+
+    @contextmanager
+    def limit(self, key: str):
+        """
+        同步调用限速, 异常视为失败
+        用法: with rate_limiter.limit('sina'): ...
+        """
+        self.acquire(key)
+        try:
+            yield
+        except Exception:
+            self.feedback(key, False)
+            raise
+        self.feedback(key, True)
+
+    def __call__(self, key: str):
+        """
+        装饰器: @rate_limiter('sina')
+        """
+
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.limit(key):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def stat(self) -> Dict[str, Dict]:
+        return {key: bucket.stat() for key, bucket in self.buckets.items()}
+
+
+def install_requests_limiter(limiter: RateLimiter):
+    """
+    requests(hiakshare/akshare/StockEastmoney等)的每个http请求按上游限速, 按状态码/异常反馈,
+    方法内部捕获异常返回None的fetch也能降速, 一个方法多次请求时每次请求各占一个令牌
+    会替换进程内全局的requests.Session.request, 只由同步入口(setup_fetch_cache)调用, 需在开启http缓存之前调用
+    """
+    request = requests.Session.request
+    if getattr(request, 'rate_limiter', None) is not None:
+        request = request.origin
+
+    @wraps(request)
+    def limited_request(self, method, url, *args, **kwargs):
+        limiter.acquire(url)
+        try:
+            resp = request(self, method, url, *args, **kwargs)
+        except Exception:
+            limiter.feedback(url, False)
+            raise
+        limiter.feedback(url, limiter.is_ok_status(resp.status_code))
+        return resp
+
+    limited_request.rate_limiter = limiter
+    limited_request.origin = request
+    requests.Session.request = limited_request
+
+
+rate_limiter = RateLimiter()
@@ -1,5 +1,5 @@
 from urllib.request import Request, urlopen
-import aiohttp
+from bbq.fetch.http_client import http_client
 import re
 import datetime
 from typing import Any, Dict
@@ -12,7 +12,7 @@ class Sina:
     async def _get_quot(self, code_list) -> Dict[str, Dict[str, Any]]:
         url = self.url + code_list
 
-        async with aiohttp.request('get', url, headers={
+        async with http_client.request('GET', url, headers={
             'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_6) AppleWebKit/537.36 (KHTML, '
                           'like Gecko) Chrome/73.0.3683.86 Safari/537.36'
         }) as req:
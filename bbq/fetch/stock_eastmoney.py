@@ -1,3 +1,5 @@
+import asyncio
+import math
 from datetime import datetime
 import requests
 import pandas as pd
@@ -5,6 +7,8 @@ from typing import Optional
 import random
 import json
 
+from bbq.fetch.http_client import http_client
+
 
 class BaseRequest:
     def __init__(self):
@@ -25,7 +29,7 @@ class BaseRequest:
         return self.session.cookies
 
     def do_request(self, url, param=None, method="GET", typ="text", encoding=None, json=None, **kwargs):
-
+        # 限速在requests层(install_requests_limiter)
         if method == "GET":
             res = self.session.get(url, params=param, **kwargs)
         else:
@@ -33,6 +37,7 @@ class BaseRequest:
                 res = self.session.post(url, json=json, **kwargs)
             else:
                 res = self.session.post(url, data=param, **kwargs)
+        http_client.http_stat.add_bytes(len(res.content))
 
         if res.status_code != 200:
             return None
@@ -50,16 +55,79 @@ class BaseRequest:
         else:
             return None
 
+    async def do_request_async(self, url, param=None, method="GET", typ="text", json=None, cookies=None):
+        """
+        do_request的aiohttp版本, 使用共享连接池http_client
+        """
+        kwargs = dict(headers={'User-Agent': self.user_agent}, cookies=cookies)
+        if method == "GET":
+            kwargs['params'] = param
+        elif json is not None:
+            kwargs['json'] = json
+        else:
+            kwargs['data'] = param
+        async with http_client.request(method, url, **kwargs) as res:
+            if res.status != 200:
+                return None
+            if typ == 'text':
+                return await res.text()
+            return await res.read()
+
+    async def prepare_cookies_async(self, url):
+        async with http_client.request('GET', url, headers={'User-Agent': self.user_agent}) as res:
+            if res.status != 200:
+                return None
+            return {key: morsel.value for key, morsel in res.cookies.items()}
+
+    @staticmethod
+    async def gather_pages(fetch_page, pages, concurrency: int = 5):
+        """
+        并发获取剩余分页, 按页码顺序返回
+        :param fetch_page: async fetch_page(page)
+        :param pages: 页码
+        :param concurrency: 并发数
+        """
+        sem = asyncio.Semaphore(concurrency)
+
+        async def fetch(page):
+            async with sem:
+                return await fetch_page(page)
+
+        return await asyncio.gather(*[fetch(page) for page in pages])
+
 
 class StockEastmoney(BaseRequest):
     def __init__(self):
         super().__init__()
 
-    def get_stock_margin_code(self) -> Optional[pd.DataFrame]:
-        def get_url(p, ps):
-            url = r'https://push2.eastmoney.com/api/qt/clist/get?cb=jQuery1123017621166317571624_1639204790874&fid=f62&po=1&pz={page_size}&pn={page}&np=1&fltt=2&invt=2&ut=b2884a393a59ad64002292a3e90d46a5&fs=b%3ABK0596&fields=f12'
-            return url.format(page=p, page_size=ps)
+    @staticmethod
+    def _margin_code_url(p, ps):
+        url = r'https://push2.eastmoney.com/api/qt/clist/get?cb=jQuery1123017621166317571624_1639204790874&fid=f62&po=1&pz={page_size}&pn={page}&np=1&fltt=2&invt=2&ut=b2884a393a59ad64002292a3e90d46a5&fs=b%3ABK0596&fields=f12'
+        return url.format(page=p, page_size=ps)
 
+    @staticmethod
+    def _parse_margin_code(data):
+        """
+        :return: (DataFrame, total), 失败返回(None, 0)
+        """
+        if data is None:
+            return None, 0
+        data = data[data.index("{"):-2]
+        data = json.loads(data)
+        if data['rc'] != 0:
+            return None, 0
+        return pd.DataFrame(data['data']['diff']), data['data']['total']
+
+    @staticmethod
+    def _margin_code_frame(df):
+        if not df.empty:
+            df.rename(columns={'f12': 'code'}, inplace=True)
+            df['code'] = df['code'].apply(lambda x: 'sh' + x if x[0] == '6' else 'sz' + x)
+            df['is_margin'] = int(1)
+
+        return df.reset_index(drop=True)
+
+    def get_stock_margin_code(self) -> Optional[pd.DataFrame]:
         pre_url = r'https://data.eastmoney.com/bkzj/596.html'
         cookies = self.prepare_cookies(pre_url)
 
@@ -67,28 +135,93 @@ class StockEastmoney(BaseRequest):
         page_size = 2000
         page = 1
         while True:
-            req_url = get_url(p=page, ps=page_size)
-            data = self.do_request(url=req_url, cookies=cookies)
-            if data is None:
-                break
-            data = data[data.index("{"):-2]
-            data = json.loads(data)
-            if data['rc'] != 0:
+            data = self.do_request(url=self._margin_code_url(p=page, ps=page_size), cookies=cookies)
+            df_tmp, total = self._parse_margin_code(data)
+            if df_tmp is None:
                 break
 
-            df_tmp = pd.DataFrame(data['data']['diff'])
             if not df_tmp.empty:
                 df = pd.concat((df, df_tmp))
 
-            total = data['data']['total']
             if df.shape[0] >= total:
                 break
             page = page + 1
 
+        return self._margin_code_frame(df)
+
+    async def get_stock_margin_code_async(self, concurrency: int = 5) -> Optional[pd.DataFrame]:
+        """
+        get_stock_margin_code的异步版本: 先取第一页得到总数, 剩余分页并发获取
+        """
+        pre_url = r'https://data.eastmoney.com/bkzj/596.html'
+        cookies = await self.prepare_cookies_async(pre_url)
+
+        page_size = 2000
+        data = await self.do_request_async(url=self._margin_code_url(p=1, ps=page_size), cookies=cookies)
+        df, total = self._parse_margin_code(data)
+        if df is None:
+            return self._margin_code_frame(pd.DataFrame())
+
+        async def fetch_page(page):
+            return await self.do_request_async(url=self._margin_code_url(p=page, ps=page_size), cookies=cookies)
+
+        pages = math.ceil(total / page_size)
+        frames = [df]
+        for data in await self.gather_pages(fetch_page, range(2, pages + 1), concurrency):
+            df_tmp, _ = self._parse_margin_code(data)
+            if df_tmp is None:
+                break
+            frames.append(df_tmp)
+
+        return self._margin_code_frame(pd.concat(frames))
+
+    @staticmethod
+    def _margin_url(code, p, ps):
+        table = 'datatable' + ''.join([str(random.randint(0, 9)) for _ in range(7)])
+        url = r'https://datacenter-web.eastmoney.com/api/data/get?callback={table}&type=RPTA_WEB_RZRQ_GGMX&sty=ALL&source=WEB&st=date&sr=-1&p={page}&ps={page_size}&filter=(scode="{code}")&pageNo={page}&pageNum={page}&pageNumber={page}&_={tm}'
+        if p == 1:
+            url = r'https://datacenter-web.eastmoney.com/api/data/get?callback={table}&type=RPTA_WEB_RZRQ_GGMX&sty=ALL&source=WEB&st=date&sr=-1&p={page}&ps={page_size}&filter=(scode="{code}")&_={tm}'
+        url = url.format(table=table, code=code, page_size=ps, page=p,
+                         tm=str(datetime.now().timestamp())[:-3].replace('.', ''))
+        return url, table
+
+    @staticmethod
+    def _parse_margin(data, tab, org_code):
+        """
+        :return: (DataFrame, pages), 失败返回(None, 0)
+        """
+        if data is None:
+            return None, 0
+        data = data[len(tab) + 1:-2]
+        data = json.loads(data)
+        if data['code'] != 0:
+            return None, 0
+
+        df = pd.DataFrame(data['result']['data'])
+        df['CODE'] = org_code
+        df['NAME'] = df['SECNAME']
+        df['DATE'] = pd.to_datetime(df['DATE'], format='%Y-%m-%d %H:%M:%S')
+        return df, data['result']['pages']
+
+    @staticmethod
+    def _margin_frame(df, start: datetime = None, end: datetime = None):
+        if start is not None and not df.empty:
+            df = df[df['DATE'] >= start]
+
+        if end is not None and not df.empty:
+            df = df[df['DATE'] <= end]
+
         if not df.empty:
-            df.rename(columns={'f12': 'code'}, inplace=True)
-            df['code'] = df['code'].apply(lambda x: 'sh' + x if x[0] == '6' else 'sz' + x)
-            df['is_margin'] = int(1)
+            df = df[['CODE', 'NAME',
+                     'DATE', 'SPJ', 'ZDF',
+                     'RZYE', 'RZYEZB', 'RZMRE', 'RZCHE', 'RZJME',
+                     'RQYE', 'RQYL', 'RQMCL', 'RQCHL', 'RQJMG',
+                     'RZRQYE', 'RZRQYECZ']]
+            df.rename(columns={'CODE': 'code', 'NAME': 'name',
+                               'DATE': 'trade_date', 'SPJ': 'spj', 'ZDF': 'zdf',
+                               'RZYE': 'rzye', 'RZYEZB': 'rzyezb', 'RZMRE': 'rzmre', 'RZCHE': 'rzche', 'RZJME': 'rzjme',
+                               'RQYE': 'rqye', 'RQYL': 'rqyl', 'RQMCL': 'rqmcl', 'RQCHL': 'rqchl', 'RQJMG': 'rqjmg',
+                               'RZRQYE': 'rzrqye', 'RZRQYECZ': 'rzrqyecz'}, inplace=True)
 
         return df.reset_index(drop=True)
 
@@ -104,15 +237,6 @@ class StockEastmoney(BaseRequest):
         if code.startswith('sh') or code.startswith('sz'):
             code = code[2:]
 
-        def get_url(p, ps):
-            table = 'datatable' + ''.join([str(random.randint(0, 9)) for _ in range(7)])
-            url = r'https://datacenter-web.eastmoney.com/api/data/get?callback={table}&type=RPTA_WEB_RZRQ_GGMX&sty=ALL&source=WEB&st=date&sr=-1&p={page}&ps={page_size}&filter=(scode="{code}")&pageNo={page}&pageNum={page}&pageNumber={page}&_={tm}'
-            if p == 1:
-                url = r'https://datacenter-web.eastmoney.com/api/data/get?callback={table}&type=RPTA_WEB_RZRQ_GGMX&sty=ALL&source=WEB&st=date&sr=-1&p={page}&ps={page_size}&filter=(scode="{code}")&_={tm}'
-            url = url.format(table=table, code=code, page_size=ps, page=p,
-                             tm=str(datetime.now().timestamp())[:-3].replace('.', ''))
-            return url, table
-
         pre_url = r'https://data.eastmoney.com/rzrq/detail/{}.html'.format(code)
         cookies = self.prepare_cookies(pre_url)
 
@@ -120,19 +244,12 @@ class StockEastmoney(BaseRequest):
         page_size = 800
         page = 1
         while True:
-            req_url, tab = get_url(p=page, ps=page_size)
+            req_url, tab = self._margin_url(code=code, p=page, ps=page_size)
             data = self.do_request(url=req_url, cookies=cookies)
-            if data is None:
-                break
-            data = data[len(tab) + 1:-2]
-            data = json.loads(data)
-            if data['code'] != 0:
+            df_tmp, pages = self._parse_margin(data, tab, org_code)
+            if df_tmp is None:
                 break
 
-            df_tmp = pd.DataFrame(data['result']['data'])
-            df_tmp['CODE'] = org_code
-            df_tmp['NAME'] = df_tmp['SECNAME']
-            df_tmp['DATE'] = pd.to_datetime(df_tmp['DATE'], format='%Y-%m-%d %H:%M:%S')
             if not df_tmp.empty:
                 df = pd.concat((df, df_tmp))
             if start is not None:
@@ -140,28 +257,89 @@ class StockEastmoney(BaseRequest):
                 if start >= m:
                     break
 
-            pages = data['result']['pages']
             if page >= pages:
                 break
             page = page + 1
 
-        if start is not None and not df.empty:
-            df = df[df['DATE'] >= start]
+        return self._margin_frame(df, start=start, end=end)
 
-        if end is not None and not df.empty:
-            df = df[df['DATE'] <= end]
+    async def get_stock_margin_async(self, code: str, start: datetime = None, end: datetime = None,
+                                     concurrency: int = 5) -> Optional[pd.DataFrame]:
+        """
+        get_stock_margin的异步版本: 先取第一页得到总页数, 第一页未覆盖start时剩余分页并发获取
+        """
+        org_code = code
+        if code.startswith('sh') or code.startswith('sz'):
+            code = code[2:]
 
-        if not df.empty:
-            df = df[['CODE', 'NAME',
-                     'DATE', 'SPJ', 'ZDF',
-                     'RZYE', 'RZYEZB', 'RZMRE', 'RZCHE', 'RZJME',
-                     'RQYE', 'RQYL', 'RQMCL', 'RQCHL', 'RQJMG',
-                     'RZRQYE', 'RZRQYECZ']]
-            df.rename(columns={'CODE': 'code', 'NAME': 'name',
-                               'DATE': 'trade_date', 'SPJ': 'spj', 'ZDF': 'zdf',
-                               'RZYE': 'rzye', 'RZYEZB': 'rzyezb', 'RZMRE': 'rzmre', 'RZCHE': 'rzche', 'RZJME': 'rzjme',
-                               'RQYE': 'rqye', 'RQYL': 'rqyl', 'RQMCL': 'rqmcl', 'RQCHL': 'rqchl', 'RQJMG': 'rqjmg',
-                               'RZRQYE': 'rzrqye', 'RZRQYECZ': 'rzrqyecz'}, inplace=True)
+        pre_url = r'https://data.eastmoney.com/rzrq/detail/{}.html'.format(code)
+        cookies = await self.prepare_cookies_async(pre_url)
+
+        page_size = 800
+
+        async def fetch_page(page):
+            req_url, tab = self._margin_url(code=code, p=page, ps=page_size)
+            return await self.do_request_async(url=req_url, cookies=cookies), tab
+
+        data, tab = await fetch_page(1)
+        df, pages = self._parse_margin(data, tab, org_code)
+        if df is None:
+            return self._margin_frame(pd.DataFrame())
+
+        frames = [df]
+        # 按日期倒序, 第一页已覆盖start则不需要再取
+        if start is None or df.empty or start < df['DATE'].min():
+            for data, tab in await self.gather_pages(fetch_page, range(2, pages + 1), concurrency):
+                df_tmp, _ = self._parse_margin(data, tab, org_code)
+                if df_tmp is None:
+                    break
+                frames.append(df_tmp)
+
+        return self._margin_frame(pd.concat(frames), start=start, end=end)
+
+    def get_stock_spot(self) -> Optional[pd.DataFrame]:
+        """
+        沪深A股全市场最新交易日行情快照
+        代码(f12) 最新价(f2) 开盘(f17) 最高(f15) 最低(f16) 昨收(f18, 已除权) 成交量(手)(f5) 换手率(%)(f8) 更新时间(f124)
+        """
+
+        def get_url(p, ps):
+            url = r'https://82.push2.eastmoney.com/api/qt/clist/get?pn={page}&pz={page_size}&po=1&np=1&ut=bd1d9ddb04089700cf9c27f6f7426281&fltt=2&invt=2&fid=f12&fs=m:0+t:6,m:0+t:80,m:1+t:2,m:1+t:23,m:0+t:81+s:2048&fields=f2,f5,f8,f12,f15,f16,f17,f18,f124'
+            return url.format(page=p, page_size=ps)
+
+        df = pd.DataFrame()
+        page_size = 5000
+        page = 1
+        while True:
+            data = self.do_request(url=get_url(p=page, ps=page_size))
+            if data is None:
+                break
+            data = json.loads(data)
+            if data['rc'] != 0 or data['data'] is None:
+                break
+
+            df_tmp = pd.DataFrame(data['data']['diff'])
+            if not df_tmp.empty:
+                df = pd.concat((df, df_tmp))
+
+            total = data['data']['total']
+            if df.shape[0] >= total or df_tmp.empty:
+                break
+            page = page + 1
+
+        if df.empty:
+            return None
+
+        df.rename(columns={'f12': 'code', 'f2': 'close', 'f17': 'open', 'f15': 'high', 'f16': 'low',
+                           'f18': 'pre_close', 'f5': 'volume', 'f8': 'turnover', 'f124': 'update_time'}, inplace=True)
+        # 停牌等无行情数据为 '-'
+        for col in ['close', 'open', 'high', 'low', 'pre_close', 'volume', 'turnover']:
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+        df['code'] = df['code'].apply(lambda x: 'sh' + x if x[0] == '6' else 'sz' + x)
+        df['volume'] = df['volume'] * 100
+        df['trade_date'] = pd.to_datetime(df['update_time'], unit='s', utc=True) \
+            .dt.tz_convert('Asia/Shanghai').dt.normalize().dt.tz_localize(None)
+        df.drop(columns=['update_time'], inplace=True)
 
         return df.reset_index(drop=True)
 
@@ -1,9 +1,19 @@
+import asyncio
 import traceback
 import time
 import types
 from functools import wraps, partial
 import bbq.log as log
 
+_retry_count = {}
+
+
+def retry_stat():
+    """
+    :return: 函数名 -> 重试次数
+    """
+    return dict(_retry_count)
+
 
 def retry(func=None, *, attempts=3, sleep=5, name=None, prefix=None):
     if func is None:
@@ -19,20 +29,48 @@ def retry(func=None, *, attempts=3, sleep=5, name=None, prefix=None):
             except Exception as e:
                 msg = traceback.format_exc()
                 logger.error('请求 {}, args={}, kwargs={}, 异常: \n{}'.format(func.__name__, args, kwargs, msg))
-                if i + 1 == attempts:
+                if i + 1 == attempts or not getattr(e, 'retryable', True):
                     break
                 backoff = sleep ** (i + 1)
                 logger.debug('请求 {} {}s后重试.'.format(func.__name__, backoff))
+                _retry_count[func.__name__] = _retry_count.get(func.__name__, 0) + 1
                 time.sleep(backoff)
         return None
 
-    @wraps(func)
-    def wrapper_func(*args, **kwargs):
-        return retry_call(None, *args, **kwargs)
+    async def retry_call_async(arg0, *args, **kwargs):
+        logger = log.get_logger(name=name, prefix=prefix)
+        for i in range(attempts):
+            try:
+                if arg0 is None:
+                    return await func(*args, **kwargs)
+                return await func(arg0, *args, **kwargs)
+            except Exception as e:
+                msg = traceback.format_exc()
+                logger.error('请求 {}, args={}, kwargs={}, 异常: \n{}'.format(func.__name__, args, kwargs, msg))
+                if i + 1 == attempts or not getattr(e, 'retryable', True):
+                    break
+                backoff = sleep ** (i + 1)
+                logger.debug('请求 {} {}s后重试.'.format(func.__name__, backoff))
+                _retry_count[func.__name__] = _retry_count.get(func.__name__, 0) + 1
+                await asyncio.sleep(backoff)
+        return None
+
+    if asyncio.iscoroutinefunction(func):
+        @wraps(func)
+        async def wrapper_func(*args, **kwargs):
+            return await retry_call_async(None, *args, **kwargs)
+
+        @wraps(func)
+        async def wrapper_cls(self, *args, **kwargs):
+            return await retry_call_async(self, *args, **kwargs)
+    else:
+        @wraps(func)
+        def wrapper_func(*args, **kwargs):
+            return retry_call(None, *args, **kwargs)
 
-    @wraps(func)
-    def wrapper_cls(self, *args, **kwargs):
-        return retry_call(self, *args, **kwargs)
+        @wraps(func)
+        def wrapper_cls(self, *args, **kwargs):
+            return retry_call(self, *args, **kwargs)
 
     if isinstance(func, types.FunctionType) and len(func.__qualname__.split('.')) > 1:
         return wrapper_cls
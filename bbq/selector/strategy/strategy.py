@@ -5,7 +5,7 @@ from typing import Optional
 from bbq.data.stockdb import StockDB
 from datetime import datetime, timedelta
 from bbq.analyse.plot import my_plot
-from bbq.fetch.my_trade_date import is_trade_date
+from bbq.fetch.my_trade_date import trade_cal
 from bbq.analyse.plot import up_color
 from tqdm import tqdm
 import os
@@ -162,9 +162,7 @@ class Strategy:
             marks = []
 
         if self.test_end_date is not None:
-            trade_date = self.test_end_date
-            while not is_trade_date(trade_date):
-                trade_date = trade_date + timedelta(days=-1)
+            trade_date = trade_cal.prev_trade_date(self.test_end_date, include=True)
 
             tip = ''
             if s_data is not None:
@@ -232,18 +230,40 @@ class Strategy:
         kdata = await load_daily_func(**kwargs)
 
         if kdata is not None and with_rise:
-            # test_data = kdata[::]
-            test_data = kdata
-            test_data = test_data.sort_values(by='trade_date')
-            test_data['diff'] = test_data['close'].diff()
-            test_data['diff'] = test_data['diff'].fillna(value=0.0)
-            test_data['rise'] = (test_data['diff'] * 100) / (test_data['close'] - test_data['diff'])
-            test_data['rise'] = test_data['rise'].apply(lambda x: round(x, 2))
-            test_data = test_data[['trade_date', 'diff', 'rise']]
-            kdata = kdata.merge(test_data, on='trade_date')
+            kdata = self.calc_rise(kdata)
 
         return kdata
 
+    async def load_kdata_many(self, codes, with_rise=True, **kwargs):
+        """
+        批量加载日线, 一次$in查询代替逐个代码load_kdata
+        :param codes: 代码列表
+        :param with_rise: 是否计算涨幅
+        :param kwargs: start=None, end=None, limit=0, projection=None, chunk_size=500, 股票可用fq
+        :return: dict(code -> DataFrame(按trade_date升序))
+        """
+        load_many_func = self.db.load_stock_daily_many
+        if not isinstance(self.db, StockDB):
+            load_many_func = self.db.load_fund_daily_many
+        data = await load_many_func(codes=codes, **kwargs)
+
+        if data is not None and with_rise:
+            data = {code: self.calc_rise(kdata) for code, kdata in data.items()}
+
+        return data
+
+    @staticmethod
+    def calc_rise(kdata):
+        # test_data = kdata[::]
+        test_data = kdata
+        test_data = test_data.sort_values(by='trade_date')
+        test_data['diff'] = test_data['close'].diff()
+        test_data['diff'] = test_data['diff'].fillna(value=0.0)
+        test_data['rise'] = (test_data['diff'] * 100) / (test_data['close'] - test_data['diff'])
+        test_data['rise'] = test_data['rise'].apply(lambda x: round(x, 2))
+        test_data = test_data[['trade_date', 'diff', 'rise']]
+        return kdata.merge(test_data, on='trade_date')
+
     @staticmethod
     def is_long_leg(df, ratio, side=None) -> bool:
         close, high, low, open_ = df['close'], df['high'], df['low'], df['open']
@@ -297,27 +317,14 @@ class Strategy:
         now = datetime(year=now.year, month=now.month, day=now.day)
 
         rise_dict = {'1day': None, '2day': None, '3day': None, '4day': None, '5day': None, '10day': None, 'now': None}
-        trade_days = 0
-        test_date = self.test_end_date + timedelta(days=1)
-        while test_date <= now:
-            if is_trade_date(test_date):
-                trade_days = trade_days + 1
-                if trade_days == 1:
-                    rise_dict['1day'] = test_date
-                if trade_days == 2:
-                    rise_dict['2day'] = test_date
-                if trade_days == 3:
-                    rise_dict['3day'] = test_date
-                if trade_days == 4:
-                    rise_dict['4day'] = test_date
-                if trade_days == 5:
-                    rise_dict['5day'] = test_date
-                if trade_days == 10:
-                    rise_dict['10day'] = test_date
-            test_date = test_date + timedelta(days=1)
+        trade_dates = trade_cal.trade_dates_between(self.test_end_date + timedelta(days=1), now)
+        for key, trade_days in [('1day', 1), ('2day', 2), ('3day', 3), ('4day', 4), ('5day', 5), ('10day', 10)]:
+            if len(trade_dates) >= trade_days:
+                rise_dict[key] = trade_dates[trade_days - 1]
         rise_dict['latest'] = now
 
-        db_load_func = self.db.load_stock_daily if isinstance(self.db, StockDB) else self.db.load_fund_daily
+        kdatas = await self.load_kdata_many(codes=data['code'].to_list(), with_rise=False,
+                                            start=self.test_end_date, end=now, projection=['close'])
 
         add_list = []
         proc_bar = tqdm(data.to_dict('records'))
@@ -325,11 +332,10 @@ class Strategy:
             proc_bar.set_description('统计 {}'.format(item['code']))
 
             add_dict = {'code': item['code']}
+            code_kdata = kdatas.get(item['code']) if kdatas is not None else None
             for key, val in rise_dict.items():
                 if val is not None:
-                    kdata = await db_load_func(filter={'code': item['code'],
-                                                       'trade_date': {'$gte': self.test_end_date, '$lte': val}},
-                                               sort=[('trade_date', -1)])
+                    kdata = code_kdata[code_kdata['trade_date'] <= val] if code_kdata is not None else None
                     if kdata is None:
                         # 可能停牌
                         add_dict[key] = 0
@@ -337,8 +343,7 @@ class Strategy:
                         if len(kdata) < 2:
                             add_dict[key] = 0
                         else:
-                            close, pre_close = kdata.iloc[0]['close'], kdata.iloc[-1]['close']
-                            # close, pre_close = kdata.iloc[0]['close'], kdata.iloc[1]['close']
+                            close, pre_close = kdata.iloc[-1]['close'], kdata.iloc[0]['close']
                             rise = round((close - pre_close) * 100 / pre_close, 2)
                             add_dict[key] = rise
 
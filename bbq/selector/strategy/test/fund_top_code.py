@@ -87,9 +87,16 @@ class FundTopCode(Strategy):
         day_mx = data.iloc[0]['trade_date']
         day_mx = datetime(year=day_mx.year, month=day_mx.month, day=day_mx.day)
         day_cond = day_mx + timedelta(days=-self.days)
-        data = await self.db.load_fund_net(filter={'trade_date': {'$gte': day_cond}}, sort=[('trade_date', -1)])
-
-        data['net_acc'] = data['net_acc'].apply(lambda x: float(x))
+        chunks = []
+        async for chunk in self.db.iter_fund_net(filter={'trade_date': {'$gte': day_cond}},
+                                                 projection=['code', 'trade_date', 'net_acc'],
+                                                 sort=[('trade_date', -1)]):
+            chunk['net_acc'] = chunk['net_acc'].apply(lambda x: float(x))
+            chunks.append(chunk)
+        if len(chunks) == 0:
+            self.log.error('数据为空')
+            return None
+        data = pd.concat(chunks, ignore_index=True)
 
         group_data = data.groupby('code')
         select = []
@@ -146,11 +146,13 @@ class Account(BaseObj):
             filter={'account_id': self.account_id,
                     '$or': [{'status': 'init'}, {'status': 'commit'}, {'status': 'part_deal'}],
                     'time': {'$lt': trade_date}})
+        cancels = []
         for entrust_dict in entrusts:
             entrust = Entrust(entrust_id=entrust_dict['entrust_id'], account=self)
             entrust.from_dict(entrust_dict)
             entrust.status = entrust.stat_cancel
-            await entrust.sync_to_db()
+            cancels.append(entrust)
+        await self.sync_entrusts_to_db(cancels)
 
         return True
 
@@ -193,6 +195,24 @@ class Account(BaseObj):
         await self.db_trade.save_account(data=data)
         return True
 
+    @BaseObj.discard_saver
+    async def sync_positions_to_db(self, positions: List[Position]) -> bool:
+        """
+        多个持仓一次批量保存
+        """
+        if len(positions) > 0:
+            await self.db_trade.save_position(data=[position.to_db_dict() for position in positions])
+        return True
+
+    @BaseObj.discard_saver
+    async def sync_entrusts_to_db(self, entrusts: List[Entrust]) -> bool:
+        """
+        多个委托一次批量保存
+        """
+        if len(entrusts) > 0:
+            await self.db_trade.save_entrust(data=[entrust.to_db_dict() for entrust in entrusts])
+        return True
+
     async def on_quot(self, evt, payload):
         # evt_start(backtest)
         # evt_morning_start evt_quotation evt_morning_end
@@ -208,15 +228,18 @@ class Account(BaseObj):
         if evt == consts.evt_noon_end:
             self.end_time = payload['day_time']
 
+            positions, entrusts = [], []
             for position in self.position.values():
                 if position.volume != position.volume_available:
                     position.volume_frozen = 0
                     position.volume_available = position.volume
-                    await position.sync_to_db()
+                    positions.append(position)
             for entrust in self.entrust.values():
                 if entrust.status == entrust.stat_commit:
                     entrust.status = entrust.stat_cancel
-                    await entrust.sync_to_db()
+                    entrusts.append(entrust)
+            await self.sync_positions_to_db(positions)
+            await self.sync_entrusts_to_db(entrusts)
             self.cash_available += self.cash_frozen
             await self.sync_to_db()
 
@@ -1,5 +1,6 @@
 from bbq.trade.base_obj import BaseObj
 from datetime import datetime
+from typing import Dict
 
 
 class Entrust(BaseObj):
@@ -41,7 +42,11 @@ class Entrust(BaseObj):
 
     @BaseObj.discard_saver
     async def sync_to_db(self) -> bool:
-        data = {'account_id': self.account.account_id,
+        await self.db_trade.save_entrust(data=self.to_db_dict())
+        return True
+
+    def to_db_dict(self) -> Dict:
+        return {'account_id': self.account.account_id,
                 'entrust_id': self.entrust_id,
                 'broker_entrust_id': self.broker_entrust_id,
                 'name': self.name,
@@ -53,8 +58,6 @@ class Entrust(BaseObj):
                 'volume_cancel': self.volume_cancel,
                 'status': self.status,
                 'time': self.time}
-        await self.db_trade.save_entrust(data=data)
-        return True
 
     def from_dict(self, data):
         self.name = data['name']
@@ -4,6 +4,7 @@ import asyncio
 import json
 import bbq.log as log
 import yaml
+from bbq.fetch.http_client import http_client
 
 
 class MsgGitee:
@@ -28,14 +29,13 @@ class MsgGitee:
     async def retry_http_do(self, method, url, data=None):
         for i in range(3):
             try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.request(method=method, url=url, data=data, headers=self.headers) as req:
-                        js = await req.json()
-                        if isinstance(js, dict):
-                            if 'message' in js:
-                                self.log.error('request={}, error={}'.format(url, js['message']))
-                                return None
-                        return js
+                async with http_client.request(method, url, data=data, headers=self.headers) as req:
+                    js = await req.json()
+                    if isinstance(js, dict):
+                        if 'message' in js:
+                            self.log.error('request={}, error={}'.format(url, js['message']))
+                            return None
+                    return js
             except aiohttp.ClientConnectorError as e:
                 print('连接错误, url={}, 第{}次重试'.format(url, i + 1))
                 await asyncio.sleep(5 * (i + 1))
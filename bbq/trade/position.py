@@ -1,5 +1,6 @@
 from bbq.trade.base_obj import BaseObj
 from datetime import datetime
+from typing import Dict
 import sys
 
 
@@ -66,7 +67,11 @@ class Position(BaseObj):
 
     @BaseObj.discard_saver
     async def sync_to_db(self) -> bool:
-        data = {'account_id': self.account.account_id,
+        await self.db_trade.save_position(data=self.to_db_dict())
+        return True
+
+    def to_db_dict(self) -> Dict:
+        return {'account_id': self.account.account_id,
                 'position_id': self.position_id, 'name': self.name, 'code': self.code,
                 'volume': self.volume, 'volume_available': self.volume_available,
                 'fee': self.fee, 'price': self.price,
@@ -77,8 +82,6 @@ class Position(BaseObj):
                 'max_profit_time': self.max_profit_time, 'min_profit_time': self.min_profit_time,
                 'time': self.time
                 }
-        await self.db_trade.save_position(data=data)
-        return True
 
     def from_dict(self, data):
         self.name = data['name']
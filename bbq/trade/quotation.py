@@ -1,6 +1,6 @@
 from abc import ABC
 from collections import OrderedDict
-from datetime import datetime, timedelta, date
+from datetime import datetime, date
 from typing import Dict, Optional, Tuple, Sequence
 import bbq.fetch as fetch
 import bbq.log as log
@@ -240,7 +240,7 @@ class Quotation(ABC):
         if len(self.quot_date) == 0 or date_now not in self.quot_date:
             self.trade_date = None
             self.quot_date.clear()
-            is_open = fetch.is_trade_date(date_now)
+            is_open = fetch.trade_cal.is_trade_date(date_now)
 
             self.quot_date[date_now] = dict(is_open=is_open,
                                             evt_morning_start=False,
@@ -323,17 +323,11 @@ class BacktestQuotation(Quotation):
 
     @staticmethod
     def pre_trade_date(start):
-        while True:
-            pre_start = start + timedelta(days=-1)
-            if fetch.is_trade_date(pre_start):
-                return pre_start
+        return fetch.trade_cal.prev_trade_date(start)
 
     @staticmethod
     def next_trade_date(start):
-        while True:
-            next_start = start + timedelta(days=1)
-            if fetch.is_trade_date(start):
-                return next_start
+        return fetch.trade_cal.next_trade_date(start)
 
     async def add_code(self, codes) -> bool:
         if len(codes) > 0:
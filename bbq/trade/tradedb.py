@@ -1,5 +1,5 @@
 from bbq.data.mongodb import MongoDB
-from typing import List, Dict
+from typing import List, Dict, Union
 
 
 class TradeDB(MongoDB):
@@ -66,8 +66,18 @@ class TradeDB(MongoDB):
 
     _db = 'bbq_trade_db'  # 交易数据库
 
-    def __init__(self, uri='mongodb://localhost:27017/', pool=5):
-        super().__init__(uri, pool)
+    _indexes = {
+        'account_info': [dict(keys=[('account_id', 1)], unique=True), dict(keys=[('status', 1), ('category', 1)])],
+        'account_info_his': [dict(keys=[('account_id', 1), ('end_time', -1)], unique=True)],
+        'signal_info': [dict(keys=[('signal_id', 1)], unique=True), dict(keys=[('account_id', 1), ('time', -1)])],
+        'entrust_info': [dict(keys=[('entrust_id', 1)], unique=True), dict(keys=[('account_id', 1), ('time', -1)])],
+        'deal_info': [dict(keys=[('deal_id', 1)], unique=True), dict(keys=[('account_id', 1), ('time', -1)])],
+        'position_info': [dict(keys=[('position_id', 1)], unique=True), dict(keys=[('account_id', 1)])],
+        'strategy_info': [dict(keys=[('account_id', 1)], unique=True)]
+    }
+
+    def __init__(self, uri='mongodb://localhost:27017/', pool=5, **kwargs):
+        super().__init__(uri, pool, **kwargs)
 
     @property
     def account_info(self):
@@ -97,16 +107,25 @@ class TradeDB(MongoDB):
     def strategy_info(self):
         return self.get_coll(self._db, 'strategy_info')
 
+    async def _save(self, coll, keys: List[str], data: Union[Dict, List[Dict]]):
+        """
+        按keys upsert, 多条记录(list)一次bulk_write
+        :param keys: 唯一键字段
+        """
+        if isinstance(data, list):
+            return await self.do_bulk_upsert(coll=coll, items=[({key: item[key] for key in keys}, item)
+                                                               for item in data])
+        return await self.do_update(coll=coll, filter={key: data[key] for key in keys}, update=data)
+
     async def load_account(self, **kwargs) -> List:
         self.log.debug('查询账户, kwargs={} ...'.format(kwargs))
         data = await self.do_load(self.account_info, to_frame=False, **kwargs)
         self.log.debug('查询账户成功 data={}'.format(data))
         return data
 
-    async def save_account(self, data: Dict):
+    async def save_account(self, data: Union[Dict, List[Dict]]):
         self.log.debug('保存账户信息, data = {}'.format(data))
-        inserted_ids = await self.do_update(coll=self.account_info,
-                                            filter={'account_id': data['account_id']}, update=data)
+        inserted_ids = await self._save(self.account_info, ['account_id'], data)
         self.log.debug('保存账户信息成功')
         return inserted_ids
 
@@ -116,12 +135,9 @@ class TradeDB(MongoDB):
         self.log.debug('查询账户日结成功 data={}'.format(data))
         return data
 
-    async def save_account_his(self, data: Dict):
+    async def save_account_his(self, data: Union[Dict, List[Dict]]):
         self.log.debug('保存账户日结信息, data = {}'.format(data))
-        inserted_ids = await self.do_update(coll=self.account_info_his,
-                                            filter={'account_id': data['account_id'],
-                                                    'end_time': data['end_time']},
-                                            update=data)
+        inserted_ids = await self._save(self.account_info_his, ['account_id', 'end_time'], data)
         self.log.debug('保存账户日结信息成功')
         return inserted_ids
 
@@ -131,10 +147,9 @@ class TradeDB(MongoDB):
         self.log.debug('查询信号信息成功 data={}'.format(data))
         return data
 
-    async def save_signal(self, data: Dict):
+    async def save_signal(self, data: Union[Dict, List[Dict]]):
         self.log.debug('保存信号信息, data = {}'.format(data))
-        inserted_ids = await self.do_update(coll=self.signal_info,
-                                            filter={'signal_id': data['signal_id']}, update=data)
+        inserted_ids = await self._save(self.signal_info, ['signal_id'], data)
         self.log.debug('保存信号信息成功')
         return inserted_ids
 
@@ -144,10 +159,9 @@ class TradeDB(MongoDB):
         self.log.debug('查询委托信息成功 data={}'.format(data))
         return data
 
-    async def save_entrust(self, data: Dict):
+    async def save_entrust(self, data: Union[Dict, List[Dict]]):
         self.log.debug('保存委托信息, data = {}'.format(data))
-        inserted_ids = await self.do_update(coll=self.entrust_info,
-                                            filter={'entrust_id': data['entrust_id']}, update=data)
+        inserted_ids = await self._save(self.entrust_info, ['entrust_id'], data)
         self.log.debug('保存委托信息成功')
         return inserted_ids
 
@@ -157,10 +171,9 @@ class TradeDB(MongoDB):
         self.log.debug('查询成交历史成功 data={}'.format(data))
         return data
 
-    async def save_deal(self, data: Dict):
+    async def save_deal(self, data: Union[Dict, List[Dict]]):
         self.log.debug('保存成交历史, data = {}'.format(data))
-        inserted_ids = await self.do_update(coll=self.deal_info,
-                                            filter={'deal_id': data['deal_id']}, update=data)
+        inserted_ids = await self._save(self.deal_info, ['deal_id'], data)
         self.log.debug('保存成交历史成功')
         return inserted_ids
 
@@ -170,10 +183,9 @@ class TradeDB(MongoDB):
         self.log.debug('查询持仓信息成功 data={}'.format(data))
         return data
 
-    async def save_position(self, data: Dict):
+    async def save_position(self, data: Union[Dict, List[Dict]]):
         self.log.debug('保存持仓信息, data = {}'.format(data))
-        inserted_ids = await self.do_update(coll=self.position_info,
-                                            filter={'position_id': data['position_id']}, update=data)
+        inserted_ids = await self._save(self.position_info, ['position_id'], data)
         self.log.debug('保存持仓信息成功')
         return inserted_ids
 
@@ -190,10 +202,9 @@ class TradeDB(MongoDB):
         self.log.debug('查询策略信息成功 data={}'.format(data))
         return data
 
-    async def save_strategy(self, data: Dict):
+    async def save_strategy(self, data: Union[Dict, List[Dict]]):
         self.log.debug('保存策略信息, data = {}'.format(data))
-        inserted_ids = await self.do_update(coll=self.strategy_info,
-                                            filter={'account_id': data['account_id']}, update=data)
+        inserted_ids = await self._save(self.strategy_info, ['account_id'], data)
         self.log.debug('保存策略信息成功')
         return inserted_ids
 